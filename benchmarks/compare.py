@@ -0,0 +1,49 @@
+"""
+Compare median latency of two benchmark runs
+
+Usage: python -m benchmarks.compare OLD.json NEW.json
+"""
+import json
+import sys
+
+_METRICS = ('runs', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms', 'flush_ms',
+            'memory_mb')
+
+
+def _key(res):
+    """Benchmark case is identified by suite, case and its parameters"""
+    return tuple(sorted((key, str(value)) for key, value in res.items()
+                        if key not in _METRICS))
+
+
+def _label(key):
+    params = dict(key)
+    rest = ' '.join(f'{name}={value}' for name, value in key
+                    if name not in ('suite', 'case'))
+    return f'{params["suite"]}.{params["case"]} {rest}'
+
+
+def compare(old, new):
+    """:returns list of (case label, old p50 ms, new p50 ms)"""
+    old_res = {_key(res): res for res in old['results']}
+    rows = []
+    for res in new['results']:
+        prev = old_res.get(_key(res))
+        if prev is not None:
+            rows.append((_label(_key(res)), prev['p50_ms'], res['p50_ms']))
+    return rows
+
+
+def main(old_path, new_path):
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f'{old["commit"]} -> {new["commit"]}')
+    for label, old_ms, new_ms in compare(old, new):
+        change = (new_ms / old_ms - 1) * 100 if old_ms else 0
+        print(f'{label:<60} {old_ms:>10.3f} {new_ms:>10.3f} {change:>+7.1f}%')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,156 @@
+"""
+Measure DataBase access paths on generated data
+
+Requires a local Postgres database dedicated to benchmarks,
+ALL ITS TASKS AND REMINDERS ARE DELETED:
+    BENCH_DATABASE_URL=postgres://localhost/taskbot_bench \
+    python -m benchmarks.db_access [TASKS ...]
+"""
+import hashlib
+import os
+import random
+import sys
+
+import db_connector
+from benchmarks import fakes
+from benchmarks.timing import measure, print_results
+from bot_handler import delivery, reminders, response
+
+SIZES = (10000, 100000, 1000000)
+# Tasks per chat and per user
+CHAT_TASKS = 50
+USER_TASKS = 10
+# Reminders due on every send_reminders tick
+OVERDUE = 100
+# Every task text contains one of the words
+WORDS = ('отчёт', 'релиз', 'встреча', 'договор', 'презентация')
+
+_SEED_SQL = '''
+TRUNCATE reminders, tasks RESTART IDENTITY;
+INSERT INTO tasks (chat_id, creator_id, task_text, marked, deadline,
+                   workers, assigned, closed)
+SELECT -(i %% %(chats)s) - 1, i %% %(users)s + 1,
+       'Task ' || i || ' ' || (%(words)s::text[])[i %% 5 + 1] || ' '
+       || md5(i::text), i %% 10 = 0,
+       CASE WHEN i %% 3 = 0 THEN now() + (i %% 100) * interval '1 hour' END,
+       CASE WHEN i %% 2 = 0 THEN ARRAY[(i %% %(users)s + 1)::BigInt]
+            ELSE '{}' END,
+       i %% 2 = 0, i %% 4 = 0
+FROM generate_series(1, %(tasks)s) AS i;
+INSERT INTO reminders (task_id, user_id, datetime, canceled)
+SELECT i * 10, i %% %(users)s + 1,
+       CASE WHEN i <= %(overdue)s THEN now() - interval '1 minute'
+            ELSE now() + i * interval '1 minute' END,
+       i > %(overdue)s AND i %% 5 = 0
+FROM generate_series(1, %(tasks)s / 10) AS i;
+ANALYZE tasks;
+ANALYZE reminders;
+'''
+
+
+def seed(handler, tasks):
+    """Replace all tasks and reminders with generated ones"""
+    params = {'tasks': tasks, 'chats': max(tasks // CHAT_TASKS, 1),
+              'users': max(tasks // USER_TASKS, 1), 'overdue': OVERDUE,
+              'words': list(WORDS)}
+    handler._commit(_SEED_SQL, params)
+    return params
+
+
+def _reopen_overdue(handler):
+    handler._commit('UPDATE reminders SET canceled = FALSE WHERE id <= %s',
+                    (OVERDUE, ))
+
+
+def bench_size(handler, tasks):
+    params = seed(handler, tasks)
+    rand = random.Random(tasks)
+    results = []
+
+    def record(case, res):
+        res.update({'suite': 'db', 'case': case, 'tasks': tasks})
+        results.append(res)
+
+    # Task cache is dropped, so every call reaches the DataBase
+    record('get_tasks', measure(
+        lambda: handler.get_tasks(-rand.randrange(params['chats']) - 1),
+        setup=handler._cache.clear))
+    record('get_user_tasks', measure(
+        lambda: handler.get_user_tasks(rand.randrange(params['users']) + 1),
+        setup=handler._cache.clear))
+    # Pages are fetched as the list shows them: one extra task
+    # tells whether the next page exists
+    limit = response._PAGE_TASKS_LIM + 1
+    record('get_tasks_page', measure(
+        lambda: handler.get_tasks_page(-rand.randrange(params['chats']) - 1,
+                                       limit=limit),
+        setup=handler._cache.clear))
+    page = {}
+
+    def first_page():
+        """Cursor of the second page of a random chat"""
+        handler._cache.clear()
+        chat_id = -rand.randrange(params['chats']) - 1
+        rows = handler.get_tasks_page(chat_id, limit=limit)
+        handler._cache.clear()
+        page['args'] = (chat_id, db_connector.task_cursor(rows[-2])
+                        if len(rows) > 1 else None)
+    record('get_tasks_page_next', measure(
+        lambda: handler.get_tasks_page(*page['args'], limit=limit),
+        setup=first_page))
+    record('get_user_tasks_page', measure(
+        lambda: handler.get_user_tasks_page(
+            rand.randrange(params['users']) + 1, limit=limit),
+        setup=handler._cache.clear))
+    # Common word is in a fifth of the chat tasks, rare one in a single task
+    record('search_tasks_common', measure(
+        lambda: handler.search_tasks(-rand.randrange(params['chats']) - 1,
+                                     rand.choice(WORDS))))
+
+    def search_rare():
+        task_id = rand.randrange(tasks) + 1
+        handler.search_tasks(-(task_id % params['chats']) - 1,
+                             hashlib.md5(str(task_id).encode()).hexdigest())
+    record('search_tasks_rare', measure(search_rare))
+    record('get_overdue_reminders', measure(
+        handler.get_overdue_reminders, setup=lambda: _reopen_overdue(handler)))
+
+    # Delivery rate limits are lifted to measure the bot's own overhead
+    context = fakes.FakeContext(fakes.FakeBot())
+    saved = reminders.DELIVERY
+    reminders.DELIVERY = delivery.Delivery(global_rate=1e6, chat_rate=1e6)
+    try:
+        record('send_reminders', measure(
+            lambda: reminders.send_reminders(context), runs=10,
+            setup=lambda: _reopen_overdue(handler)))
+    finally:
+        reminders.DELIVERY = saved
+    return results
+
+
+def connect():
+    """
+    Use the benchmark DataBase for all DataBaseConnector instances
+    :returns DataBaseConnector
+    """
+    if not os.environ.get('BENCH_DATABASE_URL'):
+        raise SystemExit('BENCH_DATABASE_URL is not set')
+    # Connection pool is configured from the environment on first use
+    os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+    os.environ.setdefault('DB_SSLMODE', 'prefer')
+    handler = db_connector.DataBaseConnector()
+    handler.apply_migrations()
+    return handler
+
+
+def main(sizes):
+    handler = connect()
+    results = []
+    for tasks in sizes:
+        results += bench_size(handler, tasks)
+    print_results(results)
+    return results
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,183 @@
+"""
+Telegram stand-ins for benchmarks
+
+FakeBot is a minimal object for code which only looks up chats and members.
+FakeApi replaces the HTTP layer of the real telegram.Bot, so the whole bot
+can be driven offline: every Bot method works and returns real objects.
+"""
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter
+
+
+class FakeChat:
+    def __init__(self, chat_id, title=None):
+        self.id = chat_id
+        self.title = title
+        self.type = 'private' if chat_id > 0 else 'group'
+
+
+def fake_member(user_id):
+    """Chat member in the form bot reads it"""
+    return {'user': {'id': user_id, 'first_name': f'Name{user_id}',
+                     'last_name': f'Surname{user_id}',
+                     'username': f'user{user_id}'},
+            'status': 'member'}
+
+
+class FakeBot:
+    """Answers chat and member lookups instantly, counts requests"""
+
+    def __init__(self):
+        self.requests = 0
+        self.sent = []
+
+    def get_chat(self, chat_id, **kwargs):
+        self.requests += 1
+        return FakeChat(chat_id, title=f'Chat {chat_id}')
+
+    def get_chat_member(self, chat_id, user_id, **kwargs):
+        self.requests += 1
+        return fake_member(user_id)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.requests += 1
+        self.sent.append((chat_id, text))
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat_data = {}
+        self.user_data = {}
+
+
+def make_rows(tasks, workers=1, chat_id=None, seed=0):
+    """
+    Task rows as returned by the DataBaseConnector
+    :param workers: number of workers of every assigned task,
+    half of the tasks are vacant if workers > 0
+    :param chat_id: rows of the user task list (with chat_id key)
+    are made if given
+    """
+    rand = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    rows = []
+    for task_id in range(1, tasks + 1):
+        row = {'id': task_id, 'creator_id': rand.randrange(1, 100),
+               'task_text': f'Task {task_id} ' + 'x' * rand.randrange(60),
+               'marked': rand.random() < 0.1,
+               'deadline': (now + timedelta(hours=rand.randrange(1, 500))
+                            if rand.random() < 0.5 else None),
+               'workers': ([rand.randrange(1, 1000) for _ in range(workers)]
+                           if workers and rand.random() < 0.5 else [])}
+        if chat_id is not None:
+            row['chat_id'] = chat_id - task_id % 5
+        rows.append(row)
+    return rows
+
+
+class FakeApi:
+    """
+    In-memory Bot API, used as the request object of telegram.Bot
+    Every request takes latency (+ random jitter) seconds,
+    flood_rate of requests are answered with 429 (RetryAfter)
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, flood_rate=0.0,
+                 retry_after=1, admins=(), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.admins = set(admins)  # ids of administrators of every group
+        self.calls = Counter()
+        self.floods = 0
+        self._rand = random.Random(seed)
+        self._msg_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._methods = {
+            'getMe': self._get_me,
+            'sendMessage': self._send_message,
+            'editMessageText': self._edit_message,
+            'editMessageReplyMarkup': self._edit_message,
+            'deleteMessage': lambda data: True,
+            'getChat': lambda data: self._chat(data['chat_id']),
+            'getChatMember': lambda data: self._member(data['user_id']),
+            'getChatAdministrators': self._get_admins,
+            'answerCallbackQuery': lambda data: True,
+        }
+
+    def _wait(self):
+        with self._lock:
+            delay = self.latency + self._rand.random() * self.jitter
+            flood = self._rand.random() < self.flood_rate
+            if flood:
+                self.floods += 1
+        if delay:
+            time.sleep(delay)
+        if flood:
+            raise RetryAfter(self.retry_after)
+
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+        self._wait()
+        if method not in self._methods:
+            raise BadRequest(f'Method {method} is not supported')
+        return self._methods[method](data or {})
+
+    def get(self, url, timeout=None):
+        return self.post(url)
+
+    def stop(self):
+        pass
+
+    @staticmethod
+    def _chat(chat_id):
+        chat_id = int(chat_id)
+        if chat_id > 0:
+            return {'id': chat_id, 'type': 'private',
+                    'first_name': f'Name{chat_id}'}
+        return {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'}
+
+    @staticmethod
+    def _member(user_id, status='member'):
+        member = fake_member(int(user_id))
+        member['user']['is_bot'] = False
+        member['status'] = status
+        return member
+
+    def _get_me(self, data):
+        return {'id': 1, 'is_bot': True, 'first_name': 'Task-O-bot',
+                'username': 'task_o_bot'}
+
+    def _message(self, chat_id, text, message_id=None):
+        return {'message_id': message_id or next(self._msg_ids),
+                'date': int(time.time()), 'chat': self._chat(chat_id),
+                'from': self._get_me(None), 'text': text}
+
+    def _send_message(self, data):
+        return self._message(data['chat_id'], data['text'])
+
+    def _edit_message(self, data):
+        if 'inline_message_id' in data:
+            return True
+        return self._message(data['chat_id'], data.get('text', ''),
+                             data['message_id'])
+
+    def _get_admins(self, data):
+        return [self._member(user_id, 'administrator')
+                for user_id in sorted(self.admins)]
+
+
+def fake_bot(api=None):
+    """:returns telegram.Bot which sends all requests to the FakeApi"""
+    return Bot('123456:fake-token', request=api or FakeApi())
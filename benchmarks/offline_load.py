@@ -0,0 +1,139 @@
+"""
+Replay synthetic users through the bot handlers with the offline Bot API
+
+Every user creates a task in one of the group chats and takes it, which
+closes the task menu, opens the menu again with /act_<id> to mark the task,
+leaves the menu and requests the task list. Telegram is replaced with
+FakeApi, tasks are stored in the benchmark DataBase,
+ALL ITS TASKS AND REMINDERS ARE DELETED:
+    BENCH_DATABASE_URL=postgres://localhost/taskbot_bench \
+    python -m benchmarks.offline_load [USERS] [CHATS] [WORKERS] \
+    [LATENCY_MS] [FLOOD_RATE]
+WORKERS > 1 processes updates of different chats in parallel
+"""
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import CommandHandler, Dispatcher
+
+import instrumentation
+from benchmarks import db_access, fakes
+from benchmarks.webhook_load import make_update
+from bot_handler import conversations, dispatching, persistence, response
+
+# Command opening the menu of the task created by the user
+ACT = '/act_{task_id}'
+# Messages sent by every user, in order
+SCENARIO = ('/add', 'Synthetic task', 'Взять', ACT, 'Отметить',
+            'Покинуть меню', '/list')
+
+
+def make_updates(users, chats):
+    """
+    Updates of all users, one step of the scenario for every user at a time
+    :returns list of update dicts
+    """
+    updates = []
+    for text in SCENARIO:
+        for user_id in range(1, users + 1):
+            chat_id = -(user_id % chats) - 1
+            update = make_update(len(updates) + 1, chat_id, text)
+            update['message']['chat'].update(type='group',
+                                             title=f'Chat {chat_id}')
+            update['message']['from']['id'] = user_id
+            updates.append(update)
+    return updates
+
+
+def build_dispatcher(bot, states):
+    dispatcher = Dispatcher(bot, Queue(), persistence=states,
+                            use_context=True)
+    dispatcher.add_handler(conversations.act_handler)
+    dispatcher.add_handler(CommandHandler('list', response.get_list))
+    errors = []
+    dispatcher.add_error_handler(
+        lambda update, context: errors.append(context.error))
+    return dispatcher, errors
+
+
+def run(users=1000, chats=100, workers=1, latency=0.0, flood_rate=0.0):
+    """:returns dict with throughput, update and handler latency"""
+    api = fakes.FakeApi(latency=latency, flood_rate=flood_rate)
+    bot = fakes.fake_bot(api)
+    instrumentation.instrument_bot(bot)
+    instrumentation.REGISTRY.clear()
+    with tempfile.TemporaryDirectory() as path:
+        states = persistence.SQLitePersistence(
+            os.path.join(path, 'states.sqlite'))
+        dispatcher, errors = build_dispatcher(bot, states)
+        updates = [Update.de_json(update, bot)
+                   for update in make_updates(users, chats)]
+
+        latencies = []
+        lock = threading.Lock()
+        finished = threading.Event()
+        # Task ids are known only after the tasks are created
+        task_ids = {}
+
+        def process(update, queued_at):
+            user_id = update.effective_user.id
+            try:
+                if update.message.text == ACT:
+                    update.message.text = ACT.format(
+                        task_id=task_ids.get(user_id, 0))
+                dispatcher.process_update(update)
+                task_id = dispatcher.user_data[user_id].get('task id')
+                if task_id is not None:
+                    task_ids[user_id] = task_id
+            finally:
+                with lock:
+                    latencies.append(time.perf_counter() - queued_at)
+                    if len(latencies) == len(updates):
+                        finished.set()
+
+        executor = dispatching.KeyedExecutor(workers)
+        started = time.perf_counter()
+        for update in updates:
+            executor.submit(dispatching.update_keys(update), process,
+                            update, time.perf_counter())
+        finished.wait()
+        elapsed = time.perf_counter() - started
+        executor.shutdown()
+        states.flush()
+
+    ops, _ = instrumentation.REGISTRY.snapshot()
+    latencies.sort()
+    return {'users': users, 'chats': chats, 'workers': workers,
+            'latency_ms': latency * 1000, 'flood_rate': flood_rate,
+            'updates': len(updates), 'errors': len(errors),
+            'floods': api.floods,
+            'updates_per_sec': len(updates) / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+            'api_calls': dict(api.calls),
+            'handlers': {name: {key: snap[key] for key in
+                                ('count', 'errors', 'p50', 'p99')}
+                         for name, snap in sorted(ops.items())}}
+
+
+def main(args):
+    db_access.seed(db_access.connect(), 0)
+    params = [int(arg) for arg in args[:3]]
+    if len(args) > 3:
+        params.append(float(args[3]) / 1000)
+    if len(args) > 4:
+        params.append(float(args[4]))
+    result = run(*params)
+    print(json.dumps(result, indent=1, ensure_ascii=False))
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
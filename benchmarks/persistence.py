@@ -0,0 +1,92 @@
+"""
+Compare latency of saving conversation states:
+PicklePersistence (as it was used by the bot) vs SQLitePersistence
+
+Usage: python -m benchmarks.persistence [CHATS ...]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from telegram.ext import PicklePersistence
+
+from bot_handler.persistence import SQLitePersistence
+
+_UPDATES = 50
+
+
+def _chat_data(chat_id):
+    """Typical chat_data of the chat with opened task list"""
+    return {'list': {'task ids': list(range(chat_id, chat_id + 60)),
+                     'page starts': [0, 6, 12], 'page ind': 0,
+                     'for user': False},
+            'list msg': {'id': chat_id, 'digest': '0' * 32}}
+
+
+def _fill(states, chats):
+    states.get_user_data()
+    states.get_chat_data()
+    states.get_conversations('Task act menu handler')
+    for chat_id in range(chats):
+        states.update_chat_data(chat_id, _chat_data(chat_id))
+        states.update_user_data(chat_id, {'task id': chat_id})
+        states.update_conversation('Task act menu handler',
+                                   (chat_id, chat_id), 0)
+
+
+def _measure(states, chats):
+    """:returns list of single update latencies and flush latency"""
+    timings = []
+    for i in range(_UPDATES):
+        chat_id = random.randrange(chats)
+        data = _chat_data(chat_id)
+        data['list']['page ind'] = i + 1
+        started = time.perf_counter()
+        states.update_chat_data(chat_id, data)
+        timings.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    states.flush()
+    return timings, time.perf_counter() - started
+
+
+def bench_pickle(chats, path):
+    states = PicklePersistence(os.path.join(path, 'states.pickle'),
+                               on_flush=True)
+    _fill(states, chats)
+    states.flush()
+    states.on_flush = False  # Bot saves file on every update
+    return _measure(states, chats)
+
+
+def bench_sqlite(chats, path):
+    states = SQLitePersistence(os.path.join(path, 'states.sqlite'))
+    _fill(states, chats)
+    states.flush()
+    return _measure(states, chats)
+
+
+def main(sizes):
+    print(f'{"backend":<8} {"chats":>7} {"p50 ms":>9} {"p99 ms":>9} '
+          f'{"flush ms":>9}')
+    results = []
+    for chats in sizes:
+        for name, bench in (('pickle', bench_pickle),
+                            ('sqlite', bench_sqlite)):
+            with tempfile.TemporaryDirectory() as path:
+                timings, flush = bench(chats, path)
+            timings.sort()
+            res = {'backend': name, 'chats': chats,
+                   'p50_ms': statistics.median(timings) * 1000,
+                   'p99_ms': timings[int(len(timings) * 0.99)] * 1000,
+                   'flush_ms': flush * 1000}
+            results.append(res)
+            print(f'{name:<8} {chats:>7} {res["p50_ms"]:>9.3f} '
+                  f'{res["p99_ms"]:>9.3f} {res["flush_ms"]:>9.3f}')
+    return results
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
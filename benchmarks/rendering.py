@@ -0,0 +1,64 @@
+"""
+Measure rendering of task lists with fake Telegram objects
+
+Usage: python -m benchmarks.rendering
+"""
+import db_connector
+from benchmarks import fakes
+from benchmarks.timing import measure, print_results
+from bot_handler import resolver, response
+
+TASKS = (10, 100, 1000)
+WORKERS = (0, 1, 3)
+
+
+def _compile_pages(rows, chat, bot, for_user):
+    """Render every page of the sorted rows as paging through the list does"""
+    while rows:
+        _, count = response._compile_page(rows[:response._PAGE_TASKS_LIM],
+                                          chat, bot, for_user)
+        rows = rows[count:]
+
+
+def bench_compile_pages(tasks, workers, for_user=False, cold=True):
+    """
+    :param cold: drop resolver cache before every run,
+    so every worker and chat is requested from the fake bot
+    """
+    chat = fakes.FakeChat(-100)
+    rows = sorted(fakes.make_rows(tasks, workers,
+                                  chat_id=-100 if for_user else None),
+                  key=db_connector.task_sort_key)
+    bot = fakes.FakeBot()
+    setup = resolver.RESOLVER.clear if cold else None
+    res = measure(lambda: _compile_pages(rows, chat, bot, for_user),
+                  runs=10 if tasks >= 1000 else 30, setup=setup)
+    res.update({'suite': 'rendering', 'case': 'compile_pages',
+                'tasks': tasks, 'workers': workers, 'for_user': for_user,
+                'cold': cold})
+    return res
+
+
+def bench_sort(tasks):
+    rows = fakes.make_rows(tasks)
+    res = measure(lambda: sorted(rows, key=db_connector.task_sort_key), runs=30)
+    res.update({'suite': 'rendering', 'case': 'task_sort_key',
+                'tasks': tasks})
+    return res
+
+
+def main():
+    results = []
+    for tasks in TASKS:
+        for workers in WORKERS:
+            results.append(bench_compile_pages(tasks, workers))
+        results.append(bench_compile_pages(tasks, 1, cold=False))
+        results.append(bench_compile_pages(tasks, 1, for_user=True))
+    for tasks in TASKS + (10000, ):
+        results.append(bench_sort(tasks))
+    print_results(results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare memory and speed of compact Row objects and dict rows
+
+Without the DataBase rows are built from tuples in memory.
+With BENCH_DATABASE_URL set 100k tasks are fetched with RealDictCursor
+and with the plain cursor converted to Row,
+ALL TASKS AND REMINDERS OF THE DATABASE ARE DELETED:
+    BENCH_DATABASE_URL=postgres://localhost/taskbot_bench \
+    python -m benchmarks.row_objects [ROWS]
+"""
+import os
+import sys
+import tracemalloc
+
+from psycopg2.extras import RealDictCursor
+
+import db_connector
+from benchmarks import db_access, fakes
+from benchmarks.timing import measure, print_results
+from db_connector.rows import make_rows
+
+ROWS = 100000
+_FETCH_SQL = '''
+SELECT id, chat_id, creator_id, task_text, marked, deadline, workers
+FROM tasks LIMIT (%s)
+'''
+
+
+class _Description:
+    """Cursor stand-in for make_rows"""
+
+    def __init__(self, fields):
+        self.description = [type('Column', (), {'name': name})
+                            for name in fields]
+
+
+def _memory(build):
+    """:returns MB held by the result of build"""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size / 2 ** 20
+
+
+def _record(results, case, build, rows, **params):
+    res = measure(build, runs=5)
+    res.update({'suite': 'rows', 'case': case, 'rows': rows,
+                'memory_mb': _memory(build)}, **params)
+    results.append(res)
+    # Sorting of task lists touches the sort fields of every row
+    built = build()
+    res = measure(lambda: sorted(built, key=db_connector.task_sort_key),
+                  runs=5)
+    res.update({'suite': 'rows', 'case': case + '_sort', 'rows': rows},
+               **params)
+    results.append(res)
+
+
+def bench_memory(rows):
+    """Rows are built from already fetched tuples"""
+    fields = ('id', 'chat_id', 'creator_id', 'task_text', 'marked',
+              'deadline', 'workers')
+    values = [tuple(row[name] for name in fields)
+              for row in fakes.make_rows(rows, chat_id=-1)]
+    cursor = _Description(fields)
+    results = []
+    _record(results, 'dict', lambda: [dict(zip(fields, row))
+                                      for row in values], rows)
+    _record(results, 'row', lambda: make_rows(cursor, values), rows)
+    return results
+
+
+def bench_fetch(rows):
+    """Rows are fetched from the DataBase"""
+    handler = db_access.connect()
+    db_access.seed(handler, rows)
+
+    def fetch(dict_rows):
+        with handler._pool.connection() as conn:
+            if dict_rows:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(_FETCH_SQL, (rows, ))
+                    fetched = cur.fetchall()
+            else:
+                with conn.cursor() as cur:
+                    cur.execute(_FETCH_SQL, (rows, ))
+                    fetched = make_rows(cur, cur.fetchall())
+            conn.commit()
+        return fetched
+
+    results = []
+    _record(results, 'fetch_dict', lambda: fetch(True), rows, db=True)
+    _record(results, 'fetch_row', lambda: fetch(False), rows, db=True)
+    return results
+
+
+def main(rows=ROWS):
+    results = bench_memory(rows)
+    if os.environ.get('BENCH_DATABASE_URL'):
+        results += bench_fetch(rows)
+    print_results(results)
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
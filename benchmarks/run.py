@@ -0,0 +1,79 @@
+"""
+Run benchmark suites and save results to JSON for comparison between commits
+
+Usage:
+    python -m benchmarks.run [--suites rendering,db,persistence,rows]
+                             [--db-sizes 10000,100000] [--output PATH]
+Results are saved to benchmarks/results/<commit>.json by default,
+DataBase suite is skipped unless BENCH_DATABASE_URL is set.
+Compare two runs with: python -m benchmarks.compare OLD.json NEW.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+_RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_suites(suites, db_sizes):
+    results = []
+    if 'rendering' in suites:
+        from benchmarks import rendering
+        results += rendering.main()
+    if 'db' in suites:
+        if os.environ.get('BENCH_DATABASE_URL'):
+            from benchmarks import db_access
+            results += db_access.main(db_sizes)
+        else:
+            print('BENCH_DATABASE_URL is not set, DataBase suite skipped',
+                  file=sys.stderr)
+    if 'persistence' in suites:
+        from benchmarks import persistence
+        for res in persistence.main([1000, 10000]):
+            res.update({'suite': 'persistence', 'case': res['backend']})
+            results.append(res)
+    if 'rows' in suites:
+        from benchmarks import row_objects
+        results += row_objects.main()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run TaskBot benchmarks')
+    parser.add_argument('--suites',
+                        default='rendering,db,persistence,rows')
+    parser.add_argument('--db-sizes', default='10000,100000,1000000')
+    parser.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    commit = _commit()
+    results = run_suites(args.suites.split(','),
+                         [int(size) for size in args.db_sizes.split(',')])
+    report = {'commit': commit,
+              'date': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'results': results}
+    output = args.output or os.path.join(_RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f'Results saved to {output}')
+    return report
+
+
+if __name__ == '__main__':
+    main()
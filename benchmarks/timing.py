@@ -0,0 +1,37 @@
+import statistics
+import time
+
+
+def measure(func, runs=20, setup=None, warmup=1):
+    """
+    Call func several times and collect its latency
+    :param setup: called before every run, its time is not measured
+    :returns dict with keys: runs, mean_ms, p50_ms, p99_ms, max_ms
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        func()
+    timings = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {'runs': runs,
+            'mean_ms': statistics.mean(timings) * 1000,
+            'p50_ms': statistics.median(timings) * 1000,
+            'p99_ms': timings[min(int(runs * 0.99), runs - 1)] * 1000,
+            'max_ms': timings[-1] * 1000}
+
+
+def print_results(results):
+    """Print benchmark records as a table"""
+    for res in results:
+        params = ' '.join(f'{key}={value}' for key, value in res.items()
+                          if key not in ('suite', 'case', 'runs', 'mean_ms',
+                                         'p50_ms', 'p99_ms', 'max_ms'))
+        print(f'{res["suite"]:<10} {res["case"]:<22} {params:<28} '
+              f'p50 {res["p50_ms"]:>9.3f} ms  p99 {res["p99_ms"]:>9.3f} ms')
@@ -0,0 +1,90 @@
+"""
+Post synthetic updates to the bot webhook and measure throughput
+
+Bot must be started in webhook mode, e.g.
+    WEBHOOK_URL=https://example.com WEBHOOK_SECRET=secret python main.py 8443
+Usage:
+    python -m benchmarks.webhook_load URL [UPDATES] [CONCURRENCY] [CHATS]
+where URL is the local webhook address, e.g. http://127.0.0.1:8443/secret
+"""
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+
+def make_update(update_id, chat_id, text='/help'):
+    """Build update with the text message from the private chat"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load',
+                 'username': f'load_{chat_id}'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def post(url, update):
+    data = json.dumps(update).encode()
+    request = urllib.request.Request(
+        url, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as resp:
+        resp.read()
+
+
+def run(url, updates=1000, concurrency=8, chats=100):
+    """:returns dict with throughput and latency percentiles"""
+    counter = iter(range(1, updates + 1))
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                update_id = next(counter, None)
+            if update_id is None:
+                return
+            update = make_update(update_id, 1000 + update_id % chats)
+            started = time.perf_counter()
+            try:
+                post(url, update)
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {'updates': updates, 'concurrency': concurrency,
+            'errors': errors[0],
+            'updates_per_sec': len(latencies) / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000
+            if latencies else None,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000
+            if latencies else None}
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+    print(json.dumps(run(args[0], *[int(arg) for arg in args[1:]]),
+                     indent=2))
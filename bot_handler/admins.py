@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+from telegram import TelegramError
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# How long chat administrators list is considered valid, seconds
+ADMINS_TTL = int(os.environ.get('ADMINS_TTL', 600))
+
+
+class AdminCache:
+    """Caches ids of chat administrators for permission checks"""
+
+    def __init__(self, ttl=ADMINS_TTL):
+        self.ttl = ttl
+        self._admins = {}  # chat_id -> (expiration time, frozenset of ids)
+        self._lock = threading.Lock()
+
+    def get_admin_ids(self, bot, chat_id):
+        """
+        Get ids of the chat administrators
+        Private chats have no administrators
+        :returns frozenset of user ids, empty if Telegram request failed
+        """
+        if chat_id > 0:  # Private chat
+            return frozenset()
+        with self._lock:
+            entry = self._admins.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        try:
+            admins = bot.get_chat_administrators(chat_id)
+        except TelegramError:
+            _LOGGER.warning(f'Unable to get administrators of {chat_id}')
+            return frozenset()
+        admin_ids = frozenset(admin.user.id for admin in admins)
+        with self._lock:
+            self._admins[chat_id] = (time.monotonic() + self.ttl, admin_ids)
+        return admin_ids
+
+    def is_admin(self, bot, chat_id, user_id):
+        return user_id in self.get_admin_ids(bot, chat_id)
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._admins.pop(chat_id, None)
+
+
+ADMINS = AdminCache()
+
+
+def refresh_admins(update, context):
+    """Drop cached administrators when chat members change"""
+    ADMINS.invalidate(update.effective_chat.id)
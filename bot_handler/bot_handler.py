@@ -1,34 +1,124 @@
 import os
+import hashlib
 import locale
+import multiprocessing
+import pickle
+import threading
+from telegram import Update
 from telegram.ext import (Updater, CommandHandler, CallbackQueryHandler,
-                          PicklePersistence)
+                          MessageHandler, Filters)
 
+import db_connector
+import instrumentation
 import logger
-from bot_handler import conversations, response, reminders
+from bot_handler import (conversations, response, reminders, resolver,
+                         persistence, scheduler, admins, dispatching,
+                         pruning, sharding)
+
+
+def _make_updater(persistence=None):
+    # Pool of run_async handlers, updates are processed in parallel
+    # by OrderedDispatching (DISPATCH_WORKERS) instead
+    workers = 4
+    # Reserve HTTP connections for concurrent chat/member lookups
+    # and updates processed in parallel
+    request_kwargs = {'con_pool_size': workers + 4 +
+                      resolver.LOOKUP_WORKERS +
+                      dispatching.DISPATCH_WORKERS}
+    return Updater(os.environ['BOT_TOKEN'], use_context=True,
+                   workers=workers, request_kwargs=request_kwargs,
+                   persistence=persistence)
+
+
+def _metrics_port(shard=None):
+    """Front or single process serves METRICS_PORT, shards the next ones"""
+    if not instrumentation.METRICS_PORT:
+        return None
+    port = int(instrumentation.METRICS_PORT)
+    return port if shard is None else port + shard + 1
+
+
+def _start_webhook(updater, webhook_url, port=None):
+    """
+    Listen for updates on the secret path of the local HTTP server
+    Requests to any other path are rejected by the server
+    :returns port
+    """
+    if port is None:
+        port = int(os.environ.get('PORT', 8443))
+    secret = os.environ.get('WEBHOOK_SECRET')
+    if not secret:
+        token = os.environ['BOT_TOKEN'].encode()
+        secret = hashlib.sha256(token).hexdigest()
+    updater.start_webhook(listen='0.0.0.0', port=port, url_path=secret)
+    # SSL is terminated by the platform router, so the webhook
+    # has to be registered explicitly
+    updater.bot.set_webhook(url=f'{webhook_url.rstrip("/")}/{secret}')
+    return port
+
+
+def _receive_updates(updater, port=None):
+    """
+    Updates are received via webhook if WEBHOOK_URL is set,
+    otherwise long polling is used
+    :returns webhook port or None
+    """
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    if webhook_url:
+        return _start_webhook(updater, webhook_url, port)
+    updater.start_polling()
+    return None
+
+
+def _migrate(log):
+    """Update DataBase schema before handling any updates"""
+    applied = db_connector.DataBaseConnector().apply_migrations()
+    if applied:
+        log.info(f'DataBase migrated to version {applied[-1]}')
 
 
 class BotHandler:
-    def __init__(self):
-        # File to store conversation states
-        dump_fname = 'states.pickle'
-        self.updater = Updater(os.environ['BOT_TOKEN'], use_context=True,
-                               persistence=PicklePersistence(dump_fname))
+    def __init__(self, shard=None):
+        """
+        :param shard: number of the worker process in the sharded mode,
+        updates are received by ShardedBotHandler then
+        """
+        self.log = logger.get_logger(__name__)
+        self.shard = shard
+        if shard is None:
+            _migrate(self.log)
+            # File to store conversation states
+            states = self._load_states('states.sqlite', 'states.pickle')
+        else:  # Migrated by the front process
+            states = persistence.SQLitePersistence(
+                f'states-{shard}.sqlite')
+        self.updater = _make_updater(states)
 
         # Get the dispatcher to register handlers
         self.dp = self.updater.dispatcher
+        # Reminder jobs record messages to chat_data of the user
+        reminders.SHOWN.bind(self.dp.chat_data)
+        self.dispatching = None
+        if dispatching.DISPATCH_WORKERS > 1:
+            self.dispatching = dispatching.OrderedDispatching(self.dp)
+        self._instrument()
 
         # Answer on different commands
         self.dp.add_handler(conversations.act_handler)
         self.dp.add_handler(CommandHandler('add', response.add_task))
+        self.dp.add_handler(CommandHandler('close', response.close_tasks))
         self.dp.add_handler(CommandHandler(
             'free', lambda update, context: response.get_list(
                 update, context, free_only=True)))
+        self.dp.add_handler(CommandHandler('find', response.find_tasks))
         self.dp.add_handler(CommandHandler('help', response.help_msg))
         self.dp.add_handler(CommandHandler('list', response.get_list))
         self.dp.add_handler(CommandHandler(
             'my', lambda update, context: response.get_list(
                 update, context, for_user=True)))
         self.dp.add_handler(CommandHandler('start', response.start))
+        self.dp.add_handler(CommandHandler('stats', response.stats))
+        self.dp.add_handler(CommandHandler('take', response.take_tasks))
         self.dp.add_handler(CommandHandler('rem', reminders.get_list))
 
         self.dp.add_handler(CallbackQueryHandler(
@@ -38,26 +128,164 @@ class BotHandler:
         self.dp.add_handler(CallbackQueryHandler(
             response.list_nav, pattern='^nav:'))
 
+        # Bot API has no updates on admin changes, but members joining
+        # or leaving the chat are a good reason to reload admins list
+        self.dp.add_handler(MessageHandler(
+            Filters.status_update.new_chat_members
+            | Filters.status_update.left_chat_member,
+            admins.refresh_admins), group=1)
+        self.dp.add_handler(MessageHandler(
+            Filters.status_update.left_chat_member,
+            pruning.member_left), group=2)
+
         # Log all errors
-        self.log = logger.get_logger(__name__)
         self.dp.add_error_handler(self._error)
 
         # Set russian language
         self._localize()
 
+    def _instrument(self):
+        """Time Bot API requests and collect stats of shared resources"""
+        instrumentation.instrument_bot(self.updater.bot)
+        if self.shard is not None:  # Every shard has its own metrics
+            instrumentation.REGISTRY.set_labels(shard=self.shard)
+        db = db_connector.DataBaseConnector()
+        instrumentation.REGISTRY.add_source('pool', db.pool_stats)
+        instrumentation.REGISTRY.add_source('cache', db.cache_stats)
+        instrumentation.REGISTRY.add_source('pruning',
+                                            pruning.PRUNER.stats)
+        if self.dispatching:
+            instrumentation.REGISTRY.add_source('dispatch',
+                                                self.dispatching.stats)
+        port = _metrics_port(self.shard)
+        if port:
+            instrumentation.serve_metrics(port)
+
+    def _load_states(self, fname, legacy_fname):
+        """Open states storage, importing states of the pickle storage"""
+        states = persistence.SQLitePersistence(fname)
+        if states.is_empty() and os.path.exists(legacy_fname):
+            try:
+                states.import_pickle(legacy_fname)
+            except (OSError, pickle.UnpicklingError, KeyError):
+                self.log.exception('Unable to import states')
+        return states
+
     def _error(self, update, context):
         """Log Errors caused by Updates."""
         self.log.warning(f'Update "{update}" caused error "{context.error}"')
 
-    def start(self):
+    def start(self, port=None):
         """Start the bot."""
-        self.updater.start_polling()
-        self.updater.job_queue.run_repeating(reminders.send_reminders,
-                                             interval=60, first=0)
+        port = _receive_updates(self.updater, port)
+        if port is not None:
+            self.log.info(f'Listening for webhook updates on port {port}')
+        self._start_jobs()
         self.updater.idle()
 
+    def _start_jobs(self, reminder_jobs=True):
+        """
+        :param reminder_jobs: deliver reminders, only one process
+        of the sharded mode does it
+        """
+        if reminder_jobs:
+            # Deliver reminders missed while the bot was down
+            self.updater.job_queue.run_once(reminders.send_reminders, 0)
+            scheduler.SCHEDULER.start(self.updater.job_queue,
+                                      reminders.send_due_reminders,
+                                      reminders.send_reminders)
+        pruning.PRUNER.start(self.updater.job_queue)
+
+    def serve_shard(self, inbox):
+        """
+        Process updates routed to this shard by ShardedBotHandler
+        until None is received from the inbox
+        """
+        ready = threading.Event()
+        thread = threading.Thread(target=self.dp.start, name='dispatcher',
+                                  kwargs={'ready': ready})
+        thread.start()
+        # Dispatcher can't be stopped before it is running
+        ready.wait()
+        self.updater.job_queue.start()
+        self._start_jobs(reminder_jobs=self.shard == 0)
+        self.log.info(f'Shard {self.shard} started')
+        for kind, data in iter(inbox.get, None):
+            try:
+                self._receive(kind, data)
+            except Exception:
+                self.log.exception(f'Unable to process {kind} message')
+
+        # Dispatcher stops when all received updates are processed
+        self.updater.job_queue.stop()
+        self.dp.stop()
+        thread.join()
+        if self.dispatching:
+            self.dispatching.executor.shutdown()
+        self.dp.update_persistence()
+        self.dp.persistence.flush()
+        self.log.info(f'Shard {self.shard} stopped')
+
+    def _receive(self, kind, data):
+        """Handle message of the shard inbox"""
+        if kind == 'update':
+            self.dp.update_queue.put(Update.de_json(data, self.updater.bot))
+        elif kind == 'schedule':  # Reminder changes of other shards
+            method, *args = data
+            getattr(scheduler.SCHEDULER, method)(*args)
+        elif kind == 'shown':  # Reminders sent by shard 0
+            chat_id, *shown = data
+            reminders.ShownReminders.put(self.dp.chat_data[chat_id], *shown)
+        elif kind == 'cache':  # Tasks changed by other shards
+            db_connector.cache.get_cache().apply(*data)
+
     def _localize(self):
         try:
             locale.setlocale(locale.LC_ALL, 'ru_RU.utf8')
         except locale.Error as err:
             self.log.warning('Unable to set locale', err)
+
+
+class ShardedBotHandler:
+    """
+    Front process of the sharded mode
+
+    Receives updates and routes them by chat to worker processes,
+    which run the handlers. Every worker keeps conversations, user_data
+    and chat_data of its chats in its own states-<shard>.sqlite, so
+    user_data is not shared between chats of different shards.
+    Task cache is per process too: task lists of a group chat are cached
+    by its shard, lists of the user by the shard of the personal chat,
+    while the tasks may be changed by any shard (e.g. closed with /act_N
+    in the personal chat). Every shard passes its task changes to the
+    caches of the others through their inboxes; a change dropped
+    because an inbox stayed full is seen after TASK_CACHE_TTL seconds.
+    """
+
+    def __init__(self, shards=sharding.SHARDS):
+        self.log = logger.get_logger(__name__)
+        _migrate(self.log)
+        self.updater = _make_updater()
+        # Workers are spawned, so they don't inherit DataBase connections
+        context = multiprocessing.get_context('spawn')
+        inboxes = [context.Queue(sharding.SHARD_QUEUE)
+                   for _ in range(shards)]
+        self.workers = sharding.ShardWorkers(context, inboxes)
+        self.router = sharding.ShardRouter(self.updater.dispatcher, inboxes)
+        instrumentation.instrument_bot(self.updater.bot)
+        instrumentation.REGISTRY.set_labels(shard='front')
+        instrumentation.REGISTRY.add_source('shards', self.router.stats)
+        instrumentation.REGISTRY.add_source('workers', self.workers.stats)
+        port = _metrics_port()
+        if port:
+            instrumentation.serve_metrics(port)
+
+    def start(self, port=None):
+        """Start the workers, then receive updates until stopped"""
+        self.workers.start()
+        port = _receive_updates(self.updater, port)
+        if port is not None:
+            self.log.info(f'Listening for webhook updates on port {port}')
+        self.updater.idle()
+        # Updater is stopped, no updates are routed anymore
+        self.workers.stop()
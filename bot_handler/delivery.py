@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from telegram import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, \
+    TelegramError, TimedOut, Unauthorized
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Telegram limits: ~30 messages per second overall, 1 per second per chat
+GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.environ.get('TG_CHAT_RATE', 1))
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 8))
+
+# Rejected messages are never sent again, timed out ones may have been sent
+SENT, FAILED, UNREACHABLE, REJECTED, TIMED_OUT = range(5)
+_STATUS_NAMES = ('sent', 'failed', 'unreachable', 'rejected', 'timed_out')
+# Messages with these statuses must not be sent again
+DONE = (SENT, REJECTED, TIMED_OUT)
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Tokens are refilled with the given rate"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self):
+        """Take a token in advance. :returns seconds to wait for it"""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Block until token is available. :returns seconds waited"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """No tokens are given out for the next seconds"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def idle(self):
+        """Whether the bucket is full and may be dropped"""
+        with self._lock:
+            elapsed = time.monotonic() - self._last
+            return self._tokens + elapsed * self.rate >= self.capacity
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Delivery:
+    """
+    Sends batches of messages with a worker pool
+    Respects global and per-chat rate limits, pauses all sends
+    and retries when Telegram answers with RetryAfter
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS, global_rate=GLOBAL_RATE,
+                 chat_rate=CHAT_RATE, max_retries=3):
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='delivery')
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            if len(self._chats) > 10000:  # Drop buckets of inactive chats
+                self._chats = {key: bucket for key, bucket
+                               in self._chats.items() if not bucket.idle()}
+            if chat_id not in self._chats:
+                self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+            return self._chats[chat_id]
+
+    def _send(self, bot, msg, ready_at):
+        """
+        :param ready_at: monotonic time the chat token was reserved for
+        :returns (status, number of RetryAfter answers,
+        sent message, sent time)
+        """
+        throttled = 0
+        wait = ready_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._chat_bucket(msg['chat_id']).acquire()
+            self._global.acquire()
+            try:
+                sent = bot.send_message(chat_id=msg['chat_id'],
+                                        text=msg['text'],
+                                        reply_markup=msg.get('markup'),
+                                        parse_mode=ParseMode.HTML)
+                return SENT, throttled, sent, datetime.now(timezone.utc)
+            except RetryAfter as err:
+                # Flood limit is global, all workers wait for it
+                throttled += 1
+                self._global.pause(err.retry_after)
+            except Unauthorized:  # User has no chat with bot
+                return UNREACHABLE, throttled, None, None
+            except BadRequest:  # Chat not found, invalid markup etc.
+                _LOGGER.exception(f'Message to {msg["chat_id"]} rejected')
+                return REJECTED, throttled, None, None
+            except TimedOut:
+                # Message may be already sent, retry could duplicate it
+                _LOGGER.warning(f'Message to {msg["chat_id"]} timed out')
+                return TIMED_OUT, throttled, None, None
+            except NetworkError:
+                _LOGGER.warning(f'Unable to reach Telegram, attempt {attempt}')
+                time.sleep(2 ** attempt)
+            except TelegramError:
+                _LOGGER.exception('Unable to send message')
+                break
+        return FAILED, throttled, None, None
+
+    def send_batch(self, bot, messages):
+        """
+        Send messages concurrently
+        Chat tokens are reserved before the messages are queued,
+        so workers take them in the order they may be sent
+        and a busy chat does not hold the workers
+        :param messages: list of dicts with keys:
+        key, chat_id, text, markup (optional), scheduled (optional datetime)
+        :returns (dict: key of the message which must not be sent again ->
+        sent telegram.Message or None, batch metrics dict)
+        """
+        now = time.monotonic()
+        queue = sorted(
+            ((now + self._chat_bucket(msg['chat_id']).reserve(), ind, msg)
+             for ind, msg in enumerate(messages)), key=lambda item: item[:2])
+        futures = [(msg, self._executor.submit(self._send, bot, msg, ready_at))
+                   for ready_at, _, msg in queue]
+        delivered = {}
+        lags = []
+        stats = dict.fromkeys(_STATUS_NAMES + ('throttled', ), 0)
+        for msg, future in futures:
+            status, throttled, sent, sent_at = future.result()
+            stats['throttled'] += throttled
+            stats[_STATUS_NAMES[status]] += 1
+            if status in DONE:
+                delivered[msg['key']] = sent
+            if status == SENT and msg.get('scheduled'):
+                lags.append((sent_at - msg['scheduled']).total_seconds())
+        stats['lag_p50'] = _percentile(lags, 0.5)
+        stats['lag_p99'] = _percentile(lags, 0.99)
+        if messages:
+            _LOGGER.info(f'Delivery batch: {stats}')
+        return delivered, stats
+
+
+DELIVERY = Delivery()
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Number of updates processed in parallel, 1 keeps the default serial mode
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 1))
+# Max number of updates waiting to be processed
+DISPATCH_QUEUE = int(os.environ.get('DISPATCH_QUEUE', 1000))
+
+
+class _Task:
+    __slots__ = ('keys', 'func', 'args', 'queued_at')
+
+    def __init__(self, keys, func, args):
+        self.keys = keys
+        self.func = func
+        self.args = args
+        self.queued_at = time.monotonic()
+
+
+class KeyedExecutor:
+    """
+    Runs tasks on a thread pool in parallel, but tasks sharing any key
+    are run strictly one after another in the order of submission
+
+    Every key has FIFO queue of tasks, task starts when it is at
+    the head of all its queues. Since tasks are put to all their queues
+    at once, the order is consistent and tasks can't wait for each other.
+    """
+
+    def __init__(self, workers, max_queued=1000, wait_samples=1000):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='dispatch')
+        self._queues = {}  # key -> deque of tasks
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_queued)
+        self._queued = 0
+        self._waits = deque(maxlen=wait_samples)
+        self._done = 0
+
+    def _is_ready(self, task):
+        return all(self._queues[key][0] is task for key in task.keys)
+
+    def submit(self, keys, func, *args):
+        """Add task, blocks if there are too many queued tasks"""
+        self._slots.acquire()
+        task = _Task(tuple(set(keys)), func, args)
+        with self._lock:
+            self._queued += 1
+            for key in task.keys:
+                self._queues.setdefault(key, deque()).append(task)
+            ready = self._is_ready(task)
+        if ready:
+            self._pool.submit(self._run, task)
+
+    def _run(self, task):
+        wait = time.monotonic() - task.queued_at
+        try:
+            task.func(*task.args)
+        except Exception:
+            _LOGGER.exception('Unhandled error in the dispatched task')
+        finally:
+            ready = []
+            with self._lock:
+                self._waits.append(wait)
+                self._queued -= 1
+                self._done += 1
+                for key in task.keys:
+                    queue = self._queues[key]
+                    queue.popleft()
+                    if not queue:
+                        del self._queues[key]
+                    elif self._is_ready(queue[0]):
+                        ready.append(queue[0])
+            self._slots.release()
+            for next_task in ready:
+                self._pool.submit(self._run, next_task)
+
+    def stats(self):
+        """
+        :returns dict with keys: workers, queued, active_keys, done,
+        wait_p50, wait_p99, wait_max (seconds tasks waited for their turn)
+        """
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = {'workers': self.workers, 'queued': self._queued,
+                     'active_keys': len(self._queues), 'done': self._done}
+        stats['wait_p50'] = waits[len(waits) // 2] if waits else None
+        stats['wait_p99'] = waits[int(len(waits) * 0.99)] if waits else None
+        stats['wait_max'] = waits[-1] if waits else None
+        return stats
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+def update_keys(update):
+    """Updates of the same chat or the same user must not be reordered"""
+    keys = []
+    if update.effective_chat:
+        keys.append(('chat', update.effective_chat.id))
+    if update.effective_user:
+        keys.append(('user', update.effective_user.id))
+    return keys or [('update', update.update_id)]
+
+
+class OrderedDispatching:
+    """
+    Makes dispatcher process updates of different chats in parallel
+    Updates of one chat or one user are still processed in order,
+    which ConversationHandler and user_data rely on
+    """
+
+    def __init__(self, dispatcher, workers=DISPATCH_WORKERS,
+                 max_queued=DISPATCH_QUEUE):
+        self.executor = KeyedExecutor(workers, max_queued)
+        self._process_update = dispatcher.process_update
+        # Dispatcher loop calls process_update for every received update
+        dispatcher.process_update = self.process_update
+
+    def process_update(self, update):
+        if not isinstance(update, Update):  # Polling errors
+            self._process_update(update)
+            return
+        self.executor.submit(update_keys(update), self._process_update,
+                             update)
+
+    def stats(self):
+        return self.executor.stats()
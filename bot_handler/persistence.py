@@ -0,0 +1,147 @@
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+
+def _digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest() if blob else None
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence backed by SQLite database in WAL mode
+
+    Unlike PicklePersistence, which rewrites the whole file,
+    every update writes only the row of the changed chat, user
+    or conversation key. Unchanged data is not written at all.
+    """
+
+    def __init__(self, filename, store_user_data=True, store_chat_data=True):
+        super().__init__(store_user_data=store_user_data,
+                         store_chat_data=store_chat_data)
+        self.filename = filename
+        self._lock = threading.Lock()
+        # Digest of the last written value for each key,
+        # used to skip no-op writes
+        self._written = {}
+        self._conn = sqlite3.connect(filename, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS user_data '
+                           '(id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS chat_data '
+                           '(id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS conversations '
+                           '(name TEXT, key TEXT, state BLOB NOT NULL, '
+                           'PRIMARY KEY (name, key))')
+
+    def _load(self, table):
+        data = defaultdict(dict)
+        with self._lock:
+            rows = self._conn.execute(f'SELECT id, data FROM {table}')
+            for row_id, blob in rows:
+                data[row_id] = pickle.loads(blob)
+                self._written[(table, row_id)] = _digest(blob)
+        return data
+
+    def _write(self, table, row_id, data):
+        """Write data row if it has changed. Empty data is deleted"""
+        blob = pickle.dumps(data) if data else None
+        with self._lock:
+            if self._written.get((table, row_id)) == _digest(blob):
+                return
+            if blob is None:
+                self._conn.execute(f'DELETE FROM {table} WHERE id = ?',
+                                   (row_id, ))
+                self._written.pop((table, row_id), None)
+            else:
+                self._conn.execute(
+                    f'INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)',
+                    (row_id, blob))
+                self._written[(table, row_id)] = _digest(blob)
+
+    def get_user_data(self):
+        return self._load('user_data')
+
+    def get_chat_data(self):
+        return self._load('chat_data')
+
+    def get_conversations(self, name):
+        conversations = {}
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, state FROM conversations WHERE name = ?',
+                (name, ))
+            for key, blob in rows:
+                conversations[tuple(json.loads(key))] = pickle.loads(blob)
+                self._written[('conversations', name, key)] = _digest(blob)
+        return conversations
+
+    def update_conversation(self, name, key, new_state):
+        key = json.dumps(key)
+        blob = pickle.dumps(new_state) if new_state is not None else None
+        with self._lock:
+            if self._written.get(('conversations', name, key)) == _digest(blob):
+                return
+            if blob is None:
+                self._conn.execute(
+                    'DELETE FROM conversations WHERE name = ? AND key = ?',
+                    (name, key))
+                self._written.pop(('conversations', name, key), None)
+            else:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO conversations (name, key, state) '
+                    'VALUES (?, ?, ?)', (name, key, blob))
+                self._written[('conversations', name, key)] = _digest(blob)
+
+    def update_user_data(self, user_id, data):
+        self._write('user_data', user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._write('chat_data', chat_id, data)
+
+    def flush(self):
+        """Move WAL content to the main database file"""
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def is_empty(self):
+        with self._lock:
+            for table in ('user_data', 'chat_data', 'conversations'):
+                if self._conn.execute(f'SELECT 1 FROM {table} LIMIT 1') \
+                        .fetchone():
+                    return False
+        return True
+
+    def import_pickle(self, filename):
+        """
+        Copy states saved by single file PicklePersistence
+        :raises OSError: if unable to read the file
+        :raises pickle.UnpicklingError: if file is corrupted
+        """
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        with self._lock:
+            self._conn.execute('BEGIN')
+        try:
+            for user_id, user_data in data['user_data'].items():
+                self.update_user_data(user_id, user_data)
+            for chat_id, chat_data in data['chat_data'].items():
+                self.update_chat_data(chat_id, chat_data)
+            for name, conversations in data['conversations'].items():
+                for key, state in conversations.items():
+                    self.update_conversation(name, key, state)
+        finally:
+            with self._lock:
+                self._conn.execute('COMMIT')
+        _LOGGER.info(f'States imported from {filename}')
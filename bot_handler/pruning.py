@@ -0,0 +1,82 @@
+import os
+import threading
+
+import db_connector
+import logger
+from bot_handler import resolver
+
+_LOGGER = logger.get_logger(__name__)
+
+# How often stale workers are removed from tasks, seconds
+PRUNE_INTERVAL = int(os.environ.get('WORKER_PRUNE_INTERVAL', 60))
+# Max number of (chat, worker) pairs removed by one statement
+PRUNE_BATCH = int(os.environ.get('WORKER_PRUNE_BATCH', 500))
+
+
+class WorkerPruner:
+    """
+    Collects workers who are no longer members of the task chat
+    and removes them from tasks in batches off the request path
+    """
+
+    def __init__(self, batch=PRUNE_BATCH):
+        self.batch = batch
+        self._stale = set()  # (chat_id, user_id)
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'reported': 0, 'pruned': 0, 'failed': 0}
+
+    def report(self, chat_id, user_id):
+        """Mark user as no longer member of the chat"""
+        with self._lock:
+            if (chat_id, user_id) not in self._stale:
+                self._stale.add((chat_id, user_id))
+                self._stats['reported'] += 1
+
+    def start(self, job_queue, interval=PRUNE_INTERVAL):
+        job_queue.run_repeating(self.run, interval=interval, first=interval)
+
+    def run(self, context=None):
+        """
+        Remove reported workers from their tasks
+        :returns number of tasks workers were removed from
+        """
+        with self._lock:
+            members = [self._stale.pop()
+                       for _ in range(min(self.batch, len(self._stale)))]
+        if not members:
+            return 0
+        try:
+            pruned = db_connector.DataBaseConnector().prune_workers(members)
+        except (ValueError, ConnectionError):
+            _LOGGER.exception('Unable to prune workers')
+            with self._lock:
+                self._stale.update(members)  # Retry on the next run
+                self._stats['failed'] += 1
+            return 0
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['pruned'] += pruned
+        _LOGGER.info(f'Pruned {len(members)} stale workers '
+                     f'from {pruned} tasks')
+        return pruned
+
+    def stats(self):
+        """
+        :returns dict with keys: runs, reported, pruned (tasks updated),
+        failed (runs), queued
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._stale)
+        return stats
+
+
+PRUNER = WorkerPruner()
+
+
+def member_left(update, context):
+    """Workers who left the chat are removed from its tasks"""
+    chat_id = update.effective_chat.id
+    user_id = update.message.left_chat_member.id
+    resolver.RESOLVER.forget_member(chat_id, user_id)
+    PRUNER.report(chat_id, user_id)
@@ -1,14 +1,17 @@
 import html
+import os
 import re
 from datetime import datetime, timezone
 
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
                       ReplyKeyboardRemove, ParseMode, ForceReply)
-from telegram.error import Unauthorized
 from telegram_calendar_keyboard import calendar_keyboard
 
 import db_connector
 import logger
+from instrumentation import timed
+from bot_handler.delivery import DELIVERY
+from bot_handler.scheduler import SCHEDULER
 from bot_handler.response import DEF_TZ, CHOOSING_REMIND_DATE, \
     TYPING_REMIND_TIME, end_conversation
 
@@ -16,8 +19,64 @@ from bot_handler.response import DEF_TZ, CHOOSING_REMIND_DATE, \
 CLOSE_MSG = 'rem_msg'
 _ERR_MSG = 'Извините, операция не удалась'
 _LOGGER = logger.get_logger(__name__)
+# Number of overdue reminders fetched and delivered at once
+REMINDER_BATCH = int(os.environ.get('REMINDER_BATCH', 500))
+# Max length of the task text in the reminder
+_REM_TEXT_LEN = 200
+# Max number of reminders in one message, at most 15 reminders
+# with the longest texts fit into 4096 characters of the message
+REMINDERS_PER_MESSAGE = min(
+    max(int(os.environ.get('REMINDERS_PER_MESSAGE', 10)), 1), 15)
+# Number of combined reminder messages remembered in every chat
+_SHOWN_LIM = 50
+
+
+class ShownReminders:
+    """
+    Ids of reminders shown in every combined reminder message,
+    so buttons of one reminder can be removed from it
+
+    Kept in chat_data of the user chat: message id -> list of reminder
+    ids in the order of the message, removed ones are replaced with None.
+    Messages are sent by jobs, which have no chat_data in the context,
+    so chat_data of the dispatcher is bound on start.
+    """
+
+    key = 'rem msgs'
+
+    def __init__(self):
+        self._chat_data = None
+        self._forward = None
+
+    def bind(self, chat_data):
+        """:param chat_data: chat_data of the dispatcher"""
+        self._chat_data = chat_data
 
+    def forward(self, callback):
+        """
+        Pass messages to the process which keeps chat_data of the chat
+        :param callback: callback(chat_id, message_id, rem_ids)
+        """
+        self._forward = callback
 
+    def record(self, chat_id, message_id, rem_ids):
+        if self._forward is not None:
+            self._forward(chat_id, message_id, rem_ids)
+        elif self._chat_data is not None:
+            self.put(self._chat_data[chat_id], message_id, rem_ids)
+
+    @classmethod
+    def put(cls, chat_data, message_id, rem_ids):
+        shown = chat_data.setdefault(cls.key, {})
+        shown[message_id] = list(rem_ids)
+        while len(shown) > _SHOWN_LIM:  # Drop the oldest message
+            del shown[next(iter(shown))]
+
+
+SHOWN = ShownReminders()
+
+
+@timed
 def add_reminder(update, context):
     update.message.bot.send_message(
         update.message.chat.id, 'Пожалуйста, выберите дату',
@@ -26,6 +85,7 @@ def add_reminder(update, context):
     return CHOOSING_REMIND_DATE
 
 
+@timed
 def reminder_cal_handler(update, context):
     selected, full_date, update.message = \
         calendar_keyboard.process_calendar_selection(update, context)
@@ -51,6 +111,7 @@ def reminder_cal_handler(update, context):
         return TYPING_REMIND_TIME
 
 
+@timed
 def get_rem_time(update, context):
     user_data = context.user_data
     user_id = update.message.from_user.id
@@ -83,7 +144,10 @@ def get_rem_time(update, context):
             success = handler.reset_reminder(rem_id, user_id, date_time)
         else:
             task_id = user_data['task id']
-            success = handler.create_reminder(task_id, user_id, date_time)
+            rem_id = handler.create_reminder(task_id, user_id, date_time)
+            success = True
+        if success:
+            SCHEDULER.add(rem_id, date_time)
 
     except (ValueError, AttributeError, ConnectionError):
         update.message.reply_text(
@@ -101,6 +165,14 @@ def get_rem_time(update, context):
     return end_conversation(update, context)
 
 
+def _format_dl(deadline):
+    dl_format = ' %a %d.%m'
+    if deadline.second == 0:  # if time is not default
+        dl_format += ' %H:%M'
+    dl = deadline.astimezone(DEF_TZ).strftime(dl_format)
+    return f'<b>Срок выполнения:</b> <code>{dl}</code>'
+
+
 def _compile_rem(rem, cancel_rem=True, show_dl=False, show_dt=False):
     """
     Create reminder message text and buttons markup
@@ -115,11 +187,7 @@ def _compile_rem(rem, cancel_rem=True, show_dl=False, show_dt=False):
     task_mark = u'[\U0001F514]'
     resp_text = f'{task_mark} {html.escape(rem["task_text"])}\n'
     if show_dl and rem['deadline']:
-        dl_format = ' %a %d.%m'
-        if rem['deadline'].second == 0:  # if time is not default
-            dl_format += ' %H:%M'
-        dl = rem['deadline'].astimezone(DEF_TZ).strftime(dl_format)
-        resp_text += f'<b>Срок выполнения:</b> <code>{dl}</code>'
+        resp_text += _format_dl(rem['deadline'])
 
     if show_dt:
         today = datetime.now(timezone.utc).astimezone(DEF_TZ)
@@ -143,35 +211,146 @@ def _compile_rem(rem, cancel_rem=True, show_dl=False, show_dt=False):
     return resp_text, markup
 
 
+def _compile_rems(rems):
+    """
+    Create one message with several reminders of the user
+    Every reminder has its own snooze and close buttons
+
+    :param rems: list of reminder Dicts
+    :raises: ValueError if fields contain incorrect data
+    :raises: KeyError if required key do not exist
+    """
+    resp_text = u'[\U0001F514] <b>Напоминания</b>\n\n'
+    for ind, rem in enumerate(rems, 1):
+        task_text = rem['task_text']
+        if len(task_text) > _REM_TEXT_LEN:
+            task_text = task_text[:_REM_TEXT_LEN - 1] + u'\u2026'
+        resp_text += f'{ind}. {html.escape(task_text)}\n'
+        if rem['deadline']:
+            resp_text += _format_dl(rem['deadline']) + '\n'
+    return resp_text, _rems_markup([rem['id'] for rem in rems])
+
+
+def _rems_markup(rem_ids):
+    """
+    Buttons of the combined reminders message
+    :param rem_ids: ids in the order of the message, None for removed ones
+    """
+    keyboard = []
+    for ind, rem_id in enumerate(rem_ids, 1):
+        if rem_id is None:
+            continue
+        keyboard.append([
+            InlineKeyboardButton(f'{ind}. Отложить',
+                                 callback_data=f'pr:{rem_id}'),
+            InlineKeyboardButton(f'{ind}. Закрыть',
+                                 callback_data=f'cr:{rem_id}')])
+    keyboard.append([InlineKeyboardButton('Закрыть все',
+                                          callback_data=CLOSE_MSG)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _coalesce(reminders):
+    """
+    Group reminders of every user into messages
+    :returns list of delivery message dicts,
+    key of the message is the tuple of its reminder ids
+    """
+    by_user = {}
+    for rem in reminders:
+        by_user.setdefault(rem['user_id'], []).append(rem)
+    messages = list()
+    for user_id, rems in by_user.items():
+        rems.sort(key=lambda rem: rem['datetime'])
+        for start in range(0, len(rems), REMINDERS_PER_MESSAGE):
+            group = rems[start:start + REMINDERS_PER_MESSAGE]
+            try:
+                if len(group) == 1:
+                    resp_text, markup = _compile_rem(group[0],
+                                                     cancel_rem=False,
+                                                     show_dl=True)
+                else:
+                    resp_text, markup = _compile_rems(group)
+            except (ValueError, KeyError):
+                _LOGGER.exception('Unable to process reminders')
+                continue
+            messages.append({'key': tuple(rem['id'] for rem in group),
+                             'chat_id': user_id, 'text': resp_text,
+                             'markup': markup,
+                             'scheduled': group[0]['datetime']})
+    return messages
+
+
+@timed
 def send_reminders(context):
-    """ Sends messages with task reminders """
+    """
+    Sends messages with all overdue task reminders
+    Reminders are fetched from the DataBase in batches,
+    so a large backlog is never loaded at once
+    """
     try:
         handler = db_connector.DataBaseConnector()
-        reminders = handler.get_overdue_reminders()
+        for reminders in handler.iter_overdue_reminders(REMINDER_BATCH):
+            _deliver(context, handler, reminders)
     except (ValueError, ConnectionError) as err:
         logger.get_logger(__name__).warning(
             'Unable to fetch reminders', err)
+
+
+@timed
+def send_due_reminders(context, rem_ids):
+    """ Sends messages with reminders fired by the scheduler """
+    try:
+        handler = db_connector.DataBaseConnector()
+        reminders = handler.get_overdue_reminders(rem_ids)
+    except (ValueError, ConnectionError):
+        _LOGGER.exception('Unable to fetch reminders')
         return
+    _deliver(context, handler, reminders)
 
-    rems_to_close = list()
-    for rem in reminders:
-        try:
-            resp_text, markup = _compile_rem(rem, cancel_rem=False,
-                                             show_dl=True)
-            context.message = context.bot.send_message(
-                 chat_id=rem['user_id'], text=resp_text,
-                 reply_markup=markup, parse_mode=ParseMode.HTML)
-            rems_to_close.append(rem['id'])
-        except Unauthorized:  # User has no chat with bot
-            pass
-        except (ValueError, ConnectionError, KeyError):
-            _LOGGER.exception('Unable to process reminder')
+
+def _deliver(context, handler, reminders):
+    """
+    Sends reminders through the rate limited delivery pipeline,
+    reminders of one user are sent in one message.
+    Delivered reminders are closed at once
+    :returns batch metrics dict
+    """
+    delivered, stats = DELIVERY.send_batch(context.bot, _coalesce(reminders))
+    for key, sent in delivered.items():
+        if sent is not None and len(key) > 1:
+            SHOWN.record(sent.chat.id, sent.message_id, key)
+    rems_to_close = [rem_id for key in delivered for rem_id in key]
+    if not rems_to_close:
+        return stats
     try:
         handler.close_reminders(rems_to_close)
+        SCHEDULER.remove(rems_to_close)
     except (ValueError, ConnectionError):
         _LOGGER.exception('Unable to close reminders')
+    return stats
+
 
+def _remove_buttons(message, chat_data, rem_id):
+    """
+    Remove buttons of the reminder from the message
+    Message is deleted if it has no other reminders
+    """
+    shown = chat_data.get(ShownReminders.key, {})
+    rem_ids = shown.get(message.message_id, [])
+    rem_ids = [None if shown_id == rem_id else shown_id
+               for shown_id in rem_ids]
+    if any(rem_ids):
+        shown[message.message_id] = rem_ids
+        message.bot.edit_message_reply_markup(
+            chat_id=message.chat.id, message_id=message.message_id,
+            reply_markup=_rems_markup(rem_ids))
+    else:
+        shown.pop(message.message_id, None)
+        message.bot.delete_message(message.chat.id, message.message_id)
 
+
+@timed
 def reset_reminder(update, context):
     try:
         data = update.callback_query.data
@@ -180,36 +359,40 @@ def reset_reminder(update, context):
         context.user_data['reset'] = True
         context.bot.answer_callback_query(update.callback_query.id)
         update.message = update.callback_query.message
-        update.message.bot.delete_message(update.message.chat.id,
-                                          update.message.message_id)
+        _remove_buttons(update.message, context.chat_data, rem_id)
         return add_reminder(update, context)
     except (ValueError, KeyError, AttributeError):
         _LOGGER.exception('Unable to reset reminder')
         return end_conversation(update, context)
 
 
+@timed
 def remove_reminder(update, context):
     try:
         data = update.callback_query.data
         rem_id = int(data[data.find(':') + 1:])
         handler = db_connector.DataBaseConnector()
         handler.close_reminders([rem_id])
+        SCHEDULER.remove([rem_id])
         update.message = update.callback_query.message
-        update.message.bot.delete_message(update.message.chat.id,
-                                          update.message.message_id)
+        _remove_buttons(update.message, context.chat_data, rem_id)
     except (ValueError, AttributeError) as err:
         _LOGGER.exception('Unable to close reminder')
 
 
+@timed
 def remove_msg(update, context):
     try:
         update.message = update.callback_query.message
+        context.chat_data.get(ShownReminders.key, {}).pop(
+            update.message.message_id, None)
         update.message.bot.delete_message(update.message.chat.id,
                                           update.message.message_id)
     except (ValueError, AttributeError) as err:
         _LOGGER.exception('Unable to remove message')
 
 
+@timed
 def get_list(update, context):
     """Sends user's reminders list"""
     chat = update.message.chat
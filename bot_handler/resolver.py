@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, TelegramError, Unauthorized
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Number of concurrent requests to the Telegram API
+LOOKUP_WORKERS = int(os.environ.get('TG_LOOKUP_WORKERS', 4))
+
+
+class Resolver:
+    """
+    Fetches chats and chat members from Telegram concurrently
+    Results are cached for ttl seconds, ids which do not exist
+    (e.g. worker left the chat) are cached for neg_ttl seconds
+    """
+
+    def __init__(self, max_workers=LOOKUP_WORKERS, ttl=300, neg_ttl=60,
+                 max_entries=10000):
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='resolver')
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] < time.monotonic():
+                del self._cache[key]
+                return False, None
+            return True, entry[1]
+
+    def _store(self, key, value):
+        ttl = self.ttl if value is not None else self.neg_ttl
+        now = time.monotonic()
+        with self._lock:
+            if len(self._cache) >= self.max_entries:
+                self._cache = {k: v for k, v in self._cache.items()
+                               if v[0] >= now}
+            self._cache[key] = (now + ttl, value)
+
+    def _fetch(self, key, func, *args):
+        try:
+            value = func(*args)
+        except (BadRequest, Unauthorized):  # Chat or member does not exist
+            value = None
+        except TelegramError:  # Network problems, do not cache
+            _LOGGER.warning(f'Unable to resolve {key}')
+            raise
+        self._store(key, value)
+        return value
+
+    def resolve(self, bot, chat_id=None, member_ids=(), chat_ids=()):
+        """
+        Get members of the chat and chats info in one batch
+        Duplicate ids are requested only once
+        :returns (members, chats): dicts by id. Value is None if the member
+        is not in the chat or chat is unavailable.
+        Ids which could not be fetched due to network errors are skipped.
+        """
+        keys = {('member', chat_id, m_id) for m_id in member_ids}
+        keys.update(('chat', c_id) for c_id in chat_ids)
+
+        results = {}
+        futures = {}
+        for key in keys:
+            found, value = self._cached(key)
+            if found:
+                results[key] = value
+            elif key[0] == 'member':
+                futures[key] = self._executor.submit(
+                    self._fetch, key, bot.get_chat_member, chat_id, key[2])
+            else:
+                futures[key] = self._executor.submit(
+                    self._fetch, key, bot.get_chat, key[1])
+
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except TelegramError:
+                pass
+
+        members = {key[2]: value for key, value in results.items()
+                   if key[0] == 'member'}
+        chats = {key[1]: value for key, value in results.items()
+                 if key[0] == 'chat'}
+        return members, chats
+
+    def forget_member(self, chat_id, user_id):
+        """Drop cached member info (e.g. member left the chat)"""
+        with self._lock:
+            self._cache.pop(('member', chat_id, user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+RESOLVER = Resolver()
@@ -1,3 +1,5 @@
+import hashlib
+import os
 import pytz
 import db_connector
 import re
@@ -5,16 +7,31 @@ from datetime import datetime, timezone
 from telegram import (ParseMode, ReplyKeyboardMarkup, ReplyKeyboardRemove,
                       ForceReply, TelegramError, InlineKeyboardButton,
                       InlineKeyboardMarkup)
+from telegram.error import BadRequest
 from telegram.ext import ConversationHandler
 import html
 from telegram_calendar_keyboard import calendar_keyboard
 
 import logger
+import instrumentation
+from instrumentation import timed
+from bot_handler import resolver
+from bot_handler.admins import ADMINS
+from bot_handler.pruning import PRUNER
 
 
 DEF_TZ = pytz.timezone('Europe/Moscow')
 _ERR_MSG = 'Извините, произошла ошибка'
 _LOGGER = logger.get_logger(__name__)
+# User allowed to see bot statistics
+_OWNER_ID = int(os.environ.get('BOT_OWNER_ID', 0))
+
+# Max number of tasks added by one message
+_BULK_LIM = 50
+# Task ids of bulk commands: 12 or range 5-9
+_ID_RANGE = re.compile(r'(\d+)(?:-(\d+))?')
+# Checklist markers: '-', '*', '•', '1.', '1)', '[ ]', '[x]'
+_LIST_MARK = re.compile(r'^(?:[-*\u2022]|\d+[.)]|\[[ xX]?\])\s+')
 
 CHOOSING_COMMAND, CHOOSING_DL_DATE, CHOOSING_REMIND_DATE, \
     TYPING_REMIND_TIME, TYPING_DL_TIME, TYPING_TASK = range(6)
@@ -47,6 +64,7 @@ def end_conversation(update, context):
     return ConversationHandler.END
 
 
+@timed
 def start(update, context):
     """Send a message when the command /start is issued."""
     msg = ('Добро пожаловать в Task-O-bot.\n'
@@ -54,6 +72,7 @@ def start(update, context):
     update.message.reply_text(msg, disable_notification=True)
 
 
+@timed
 def help_msg(update, context):
     """Send a message when the command /help is issued."""
     msg = ('Я могу помочь вам управлять задачами, '
@@ -63,32 +82,102 @@ def help_msg(update, context):
            '<b>Доступные команды:</b>\n'
            '/add - создать новую задачу\n'
            '(в личной беседе можно просто написать текстовое сообщение)\n'
+           'Список, каждая строка которого начинается с маркера '
+           '(-, *, 1., [ ]), станет несколькими задачами, '
+           'любой другой текст из нескольких строк - одной задачей\n'
+           '/close 12 13 - закрыть несколько задач\n'
+           '/take 5-9 - взять несколько задач\n'
            '/list - список всех задач\n'
            '/free - список задач без исполнителя\n'
            '/my - список задач, взятых на исполнение\n'
            '(доступна в личной беседе, отображает задачи со всех чатов)\n'
+           '/find отчёт - поиск задач по словам из текста\n'
            '/rem - список напоминаний (только в личной беседе)\n'
            )
     update.message.reply_text(msg, parse_mode=ParseMode.HTML,
                               disable_notification=True)
 
 
+def stats(update, context):
+    """Send handlers, DataBase and Telegram latency to the bot owner"""
+    if not _OWNER_ID or update.effective_user.id != _OWNER_ID:
+        return
+    report = html.escape(instrumentation.render_text())
+    update.message.reply_text(f'<pre>{report}</pre>',
+                              parse_mode=ParseMode.HTML,
+                              disable_notification=True)
+
+
+@timed
 def new_task(update, context):
-    """Initiate task creation process"""
+    """
+    Initiate task creation process
+    Tasks sent along with the command are added at once
+    """
+    command_text = update.message.text.split(maxsplit=1)
+    if len(command_text) > 1:
+        return add_task(update, context, text=command_text[1])
     update.message.reply_text(
         'Введите текст задачи', disable_notification=True,
         reply_markup=ForceReply(selective=True))
     return TYPING_TASK
 
 
-def add_task(update, context):
-    """Adds new task to the list"""
+def _split_tasks(text):
+    """
+    Split checklist into task texts, list markers are removed
+    Text is a checklist if every its line starts with a list marker,
+    any other text is a single task
+    :returns list of task texts
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if len(lines) < 2 or not all(_LIST_MARK.match(line) for line in lines):
+        return [text.strip()]
+    return [_LIST_MARK.sub('', line).strip() for line in lines]
+
+
+def _add_tasks(update, context, task_texts):
+    """Adds every line of the checklist as a separate task"""
+    if len(task_texts) > _BULK_LIM:
+        update.message.reply_text(
+            f'За один раз можно добавить не более {_BULK_LIM} задач',
+            disable_notification=True)
+        return end_conversation(update, context)
+    try:
+        handler = db_connector.DataBaseConnector()
+        task_ids = handler.add_tasks(update.message.chat.id,
+                                     update.message.from_user.id, task_texts)
+    except (ValueError, ConnectionError):
+        update.message.reply_text(_ERR_MSG, disable_notification=True,
+                                  reply_markup=ReplyKeyboardRemove())
+        _LOGGER.exception('Unable to add tasks')
+        return end_conversation(update, context)
+    lines = []
+    for task_id, task_text in zip(task_ids, task_texts):
+        if len(task_text) > _LINE_LEN:
+            task_text = task_text[:_LINE_LEN - 1] + u'\u2026'
+        lines.append(f'/act_{task_id} {task_text}')
+    update.message.reply_text(f'Добавлено задач: {len(task_ids)}\n\n'
+                              + '\n'.join(lines), disable_notification=True,
+                              reply_markup=ReplyKeyboardRemove())
+    return end_conversation(update, context)
+
+
+@timed
+def add_task(update, context, text=None):
+    """
+    Adds new task to the list
+    Checklist message adds a task for every its item
+    """
     chat_id = update.message.chat.id
     creator_id = update.message.from_user.id
-    msg_text = update.message.text.strip()
+    msg_text = (text if text is not None else update.message.text).strip()
     if not msg_text:
         update.message.reply_text('Вы не можете добавить пустую задачу')
         return end_conversation(update, context)
+    task_texts = _split_tasks(msg_text)
+    if len(task_texts) > 1:
+        return _add_tasks(update, context, task_texts)
     try:
         handler = db_connector.DataBaseConnector()
         task_id = handler.add_task(chat_id, creator_id, msg_text)
@@ -100,9 +189,10 @@ def add_task(update, context):
         return end_conversation(update, context)
     update.message.reply_text('Задача успешно добавлена.\n'
                               f'Управление доступно по команде /act_{task_id}')
-    return act_task(update, context, newly_created=True)
+    return _task_menu(update, context, newly_created=True)
 
 
+@timed
 def close_task(update, context):
     """Mark the task as closed"""
     handler = db_connector.DataBaseConnector()
@@ -112,10 +202,7 @@ def close_task(update, context):
         chat_id = user_data['chat id']
     else:
         chat_id = update.message.chat.id
-    try:
-        admin = user_id in update.message.bot.get_chat_administrators(chat_id)
-    except TelegramError:
-        admin = False
+    admin = ADMINS.is_admin(update.message.bot, chat_id, user_id)
     try:
         task_id = user_data['task id']
         success = handler.close_task(task_id, chat_id, user_id, admin)
@@ -135,6 +222,85 @@ def close_task(update, context):
     return end_conversation(update, context)
 
 
+def _parse_ids(args):
+    """
+    Parse task ids of the bulk command: '12 13 14', '12,13' or '5-9'
+    :returns list of unique ids in the given order,
+    None if arguments are invalid or there are too many ids
+    """
+    task_ids = []
+    for token in ' '.join(args).replace(',', ' ').split():
+        match = _ID_RANGE.fullmatch(token)
+        if not match:
+            return None
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if not first <= last < first + _BULK_LIM:
+            return None
+        task_ids.extend(range(first, last + 1))
+    task_ids = list(dict.fromkeys(task_ids))
+    return task_ids if len(task_ids) <= _BULK_LIM else None
+
+
+def _bulk_command(update, context, command, action):
+    """
+    Apply action to all tasks given in the command arguments
+    :param action: callable(handler, task_ids, chat_id, user_id)
+    returning dict: task id -> success indicator
+    :returns (list of updated ids, list of failed ids) or None on error
+    """
+    task_ids = _parse_ids(context.args or [])
+    if not task_ids:
+        update.message.reply_text(
+            f'Укажите номера задач (не более {_BULK_LIM}), '
+            f'например: /{command} 12 13 14 или /{command} 5-9',
+            disable_notification=True)
+        return None
+    try:
+        handler = db_connector.DataBaseConnector()
+        results = action(handler, task_ids, update.message.chat.id,
+                         update.message.from_user.id)
+    except (ValueError, ConnectionError):
+        update.message.reply_text(_ERR_MSG, disable_notification=True)
+        _LOGGER.exception(f'Unable to execute /{command}')
+        return None
+    return ([t_id for t_id in task_ids if results[t_id]],
+            [t_id for t_id in task_ids if not results[t_id]])
+
+
+def _bulk_reply(update, updated, failed, done_text, failed_text):
+    msg = f'{done_text}: {len(updated)}'
+    if failed:
+        msg += f'\n{failed_text}: ' + ', '.join(map(str, failed))
+    update.message.reply_text(msg, disable_notification=True)
+
+
+@timed
+def close_tasks(update, context):
+    """Close several tasks: /close 12 13 14 or /close 5-9"""
+    def action(handler, task_ids, chat_id, user_id):
+        admin = ADMINS.is_admin(update.message.bot, chat_id, user_id)
+        return handler.close_tasks(task_ids, chat_id, user_id, admin)
+
+    result = _bulk_command(update, context, 'close', action)
+    if result is not None:
+        _bulk_reply(update, *result, 'Закрыто задач',
+                    'Не удалось закрыть задачи')
+
+
+@timed
+def take_tasks(update, context):
+    """Assign several tasks to the current user: /take 5-9"""
+    def action(handler, task_ids, chat_id, user_id):
+        return handler.assign_tasks(task_ids, chat_id, user_id, [user_id])
+
+    result = _bulk_command(update, context, 'take', action)
+    if result is not None:
+        _bulk_reply(update, *result, 'Взято задач',
+                    'Не удалось взять задачи')
+
+
+@timed
 def update_deadline(update, context):
     """Updates task deadline"""
     handler = db_connector.DataBaseConnector()
@@ -142,11 +308,7 @@ def update_deadline(update, context):
     user_data = context.user_data
     try:
         task_id = user_data['task id']
-        task_info = handler.task_info(task_id)
-
-        success = (task_info['creator_id'] == user_id
-                   or user_id in task_info['workers']
-                   or not task_info['workers'])
+        success = handler.task_access(task_id, user_id)['can_set_deadline']
     except (ValueError, ConnectionError, KeyError):
         update.message.reply_text(_ERR_MSG, disable_notification=True,
                                   reply_markup=ReplyKeyboardRemove())
@@ -165,6 +327,7 @@ def update_deadline(update, context):
         return CHOOSING_DL_DATE
 
 
+@timed
 def deadline_cal_handler(update, context):
     selected, full_date, update.message = \
         calendar_keyboard.process_calendar_selection(update, context)
@@ -213,6 +376,7 @@ def deadline_cal_handler(update, context):
             return TYPING_DL_TIME
 
 
+@timed
 def get_dl_time(update, context):
     user_data = context.user_data
     try:
@@ -249,82 +413,209 @@ def get_dl_time(update, context):
     return end_conversation(update, context)
 
 
-def _compile_list(rows, chat, bot, for_user=False):
+_LINES_LIM = 20
+_LINE_LEN = 30
+# Every task takes at least 3 lines, page can't contain more tasks
+_PAGE_TASKS_LIM = _LINES_LIM // 3
+
+
+def _resolve_rows(rows, chat, bot, for_user=False):
+    """Request chats and workers info for the rows in one batch"""
+    member_ids = {w_id for row in rows for w_id in row['workers']}
+    chat_ids = {row['chat_id'] for row in rows if 'chat_id' in row}
+    return resolver.RESOLVER.resolve(
+        bot, chat.id, member_ids, chat_ids if for_user else ())
+
+
+def _compile_task(row, chat, members, chats, for_user=False):
     """
-    Creates list of task pages for the chat
-    :raises TelegramError if some chat does not exist
+    Creates text block with the task info
+    :raises Value error if row is corrupted
+    :returns (text, number of lines it takes)
+    """
+    task_chat_id = row['chat_id'] if 'chat_id' in row else chat.id
+    resp_text = ''
+    task_lines = 0
+    task_mark = u'<b>[ ! ]</b> ' if row['marked'] else u'\u25b8 '
+    resp_text += f'{task_mark} {html.escape(row["task_text"])}\n\n'
+    task_lines += len(resp_text) // _LINE_LEN
+    task_lines += 1 if len(resp_text) % _LINE_LEN else 0
+    if for_user:
+        task_chat = chats.get(task_chat_id)
+        if task_chat is None:
+            _LOGGER.warning('Could not get chat info')
+        elif task_chat.title:
+            resp_text += f'<b>Чат:</b> {task_chat.title}\n'
+            task_lines += 1
+
+    # Parse workers list
+    if row['workers']:
+        workers = ''
+        for w_id in row['workers']:
+            if w_id not in members:  # Could not fetch member info
+                continue
+            w_info = members[w_id]
+            if w_info is None:  # Worker is no longer in this chat
+                PRUNER.report(task_chat_id, w_id)
+                continue
+            f_name = w_info['user']['first_name']
+            l_name = w_info['user']['last_name']
+            username = w_info['user']['username']
+            tg_link = f'https://t.me/{username}'
+            workers += f'<a href="{tg_link}">{l_name} {f_name}</a>\n'
+        if workers:
+            resp_text += f'<b>Исполнитель:</b> {workers}'
+            task_lines += 1
+
+    # Localize UTC time
+    if row['deadline']:
+        dl_format = ' %a %d.%m'
+        today = datetime.now(timezone.utc).astimezone(DEF_TZ)
+        if today.year != row['deadline'].year:
+            dl_format += '.%Y'
+        if row['deadline'].second == 0:  # if time is not default
+            dl_format += '.%H:%M'
+        dl = row['deadline'].astimezone(DEF_TZ).strftime(dl_format)
+        resp_text += f'<b>Срок:</b> <code>{dl}</code>\n'
+        task_lines += 1
+
+    resp_text += f'<b>Действия:</b>  /act_{row["id"]}\n'
+    resp_text += u'-' * 16 + '\n\n'
+    task_lines += 2
+    return resp_text, task_lines
+
+
+def _compile_page(rows, chat, bot, for_user=False, lookups=None):
+    """
+    Creates the page which starts from the first of sorted rows
+    :param lookups: (members, chats) already requested from Telegram
     :raises Value error if rows are corrupted
-    :returns List of strings with task info
+    :returns (page text, number of rows on the page)
     """
-    lines_lim = 20
-    line_len = 30
-    task_lst = ['']
+    if lookups is None:
+        lookups = _resolve_rows(rows[:_PAGE_TASKS_LIM], chat, bot, for_user)
+    members, chats = lookups
+    page = ''
     cur_lines = 0
-    for row in (sorted(rows, key=_row_sort_key)):
-        task_chat_id = row['chat_id'] if 'chat_id' in row else chat.id
-        resp_text = ''
-        task_lines = 0
-        task_mark = u'<b>[ ! ]</b> ' if row['marked'] else u'\u25b8 '
-        resp_text += f'{task_mark} {html.escape(row["task_text"])}\n\n'
-        task_lines += len(resp_text) // line_len
-        task_lines += 1 if len(resp_text) % line_len else 0
-        if for_user:
-            try:
-                task_chat = bot.get_chat(task_chat_id)
-                if task_chat.title:
-                    resp_text += f'<b>Чат:</b> {task_chat.title}\n'
-                    task_lines += 1
-            except TelegramError:
-                _LOGGER.exception('Could not get chat info')
-
-        # Parse workers list
-        if row['workers']:
-            workers = ''
-            for w_id in row['workers']:
-                try:
-                    w_info = chat.get_member(w_id)
-                    f_name = w_info['user']['first_name']
-                    l_name = w_info['user']['last_name']
-                    username = w_info['user']['username']
-                    tg_link = f'https://t.me/{username}'
-                    workers += f'<a href="{tg_link}">{l_name} {f_name}</a>\n'
-                except TelegramError:  # Worker is no longer in this chat
-                    try:
-                        handler = db_connector.DataBaseConnector()
-                        handler.rem_worker(row['id'], task_chat_id, w_id)
-                    except (ValueError, ConnectionError):
-                        _LOGGER.exception('Could not remove invalid worker')
-            if workers:
-                resp_text += f'<b>Исполнитель:</b> {workers}'
-                task_lines += 1
-
-        # Localize UTC time
-        if row['deadline']:
-            dl_format = ' %a %d.%m'
-            today = datetime.now(timezone.utc).astimezone(DEF_TZ)
-            if today.year != row['deadline'].year:
-                dl_format += '.%Y'
-            if row['deadline'].second == 0:  # if time is not default
-                dl_format += '.%H:%M'
-            dl = row['deadline'].astimezone(DEF_TZ).strftime(dl_format)
-            resp_text += f'<b>Срок:</b> <code>{dl}</code>\n'
-            task_lines += 1
+    count = 0
+    for row in rows:
+        resp_text, task_lines = _compile_task(row, chat, members, chats,
+                                              for_user=for_user)
+        if cur_lines and cur_lines + task_lines > _LINES_LIM:
+            break
+        page += resp_text
+        cur_lines += task_lines
+        count += 1
+    return page, count
+
+
+def _render_page(task_lst, chat, bot):
+    """
+    Renders current page of the stored list cursor
+    Only tasks of this page are fetched from the DataBase,
+    cursor of the next page is saved to the list
+    :raises ValueError, ConnectionError if unable to fetch tasks
+    :returns page text, empty if there are no tasks on the page
+    """
+    ind = task_lst['page ind']
+    cursors = task_lst['cursors']
+    handler = db_connector.DataBaseConnector()
+    # One extra task shows whether the next page exists
+    limit = _PAGE_TASKS_LIM + 1
+    if task_lst['for user']:
+        rows = handler.get_user_tasks_page(chat.id, cursors[ind], limit)
+    else:
+        rows = handler.get_tasks_page(chat.id, cursors[ind], limit,
+                                      free_only=task_lst['free only'])
+
+    page, count = _compile_page(rows[:_PAGE_TASKS_LIM], chat, bot,
+                                task_lst['for user'])
+    # Tasks might be added or closed since next pages were shown
+    del cursors[ind + 1:]
+    if count < len(rows):
+        cursors.append(db_connector.task_cursor(rows[count - 1]))
+    return page
+
+
+def _nav_markup(task_lst):
+    """Creates navigation buttons for the current page of the list"""
+    ind = task_lst['page ind']
+    if ind > 0:
+        l_nav, l_text = 'nav:l', '<<'
+    else:
+        l_nav, l_text = 'nav:-', '  '
+    if ind < len(task_lst['cursors']) - 1:
+        r_nav, r_text = 'nav:r', '>>'
+    else:
+        r_nav, r_text = 'nav:-', '  '
+    keyboard = [[InlineKeyboardButton(l_text, callback_data=l_nav),
+                 InlineKeyboardButton('Закрыть', callback_data='nav:cl'),
+                 InlineKeyboardButton(r_text, callback_data=r_nav)]]
+    return InlineKeyboardMarkup(keyboard)
 
-        resp_text += f'<b>Действия:</b>  /act_{row["id"]}\n'
-        resp_text += u'-' * 16 + '\n\n'
-        task_lines += 2
 
-        if cur_lines and cur_lines + task_lines > lines_lim:
-            task_lst.append(resp_text)
-            cur_lines = task_lines
-        else:
-            task_lst[-1] += resp_text
-            cur_lines += task_lines
-    return task_lst
+def _list_digest(text, markup):
+    """Hash of the list message content"""
+    content = text + markup.to_json()
+    return hashlib.md5(content.encode()).hexdigest()
 
 
+def _show_list(update, context, text, markup, message=None):
+    """
+    Shows the list page in the list message of the chat
+    The message is edited only if the page differs from the shown one,
+    it is replaced with a new message if Telegram can't edit it
+    Other list messages are deleted with the next replaced one
+    :param message: message to edit, the stored list message by default
+    """
+    bot = update.message.bot
+    chat_id = update.message.chat.id
+    digest = _list_digest(text, markup)
+    shown = context.chat_data.get('list msg')
+    if message is not None:
+        msg_id = message.message_id
+    elif shown is not None:
+        msg_id = shown['id']
+    else:
+        msg_id = None
+    if shown is not None and (shown['id'], shown['digest']) == (msg_id,
+                                                                digest):
+        return  # Message already shows this page
+
+    stale = context.chat_data.setdefault('rem lst', set())
+    if shown is not None and shown['id'] != msg_id:
+        stale.add(shown['id'])
+    if msg_id is not None:
+        try:
+            bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=msg_id,
+                parse_mode=ParseMode.HTML, disable_web_page_preview=True,
+                reply_markup=markup)
+            edited = True
+        except BadRequest as err:
+            # Message was deleted or can't be edited anymore
+            edited = 'not modified' in err.message.lower()
+        if edited:
+            context.chat_data['list msg'] = {'id': msg_id, 'digest': digest}
+            return
+        stale.add(msg_id)
+
+    _clean_msg(update, context, keys=('rem lst', ))
+    msg = bot.send_message(
+        chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True, disable_notification=True,
+        reply_markup=markup
+    )
+    context.chat_data['list msg'] = {'id': msg.message_id, 'digest': digest}
+
+
+@timed
 def get_list(update, context, for_user=False, free_only=False):
-    """Sends the task list"""
+    """
+    Shows the first page of the task list in the list message of the chat
+    Only cursors of the pages are stored,
+    next pages are fetched and rendered on demand by list_nav
+    """
     chat = update.message.chat
     user_id = update.message.from_user.id
 
@@ -333,46 +624,29 @@ def get_list(update, context, for_user=False, free_only=False):
         update.message.reply_text(msg)
         return
 
+    task_lst = {'cursors': [None], 'page ind': 0, 'for user': for_user,
+                'free only': free_only}
     try:
-        handler = db_connector.DataBaseConnector()
-        if for_user:
-            rows = handler.get_user_tasks(user_id)
-        else:
-            rows = handler.get_tasks(chat.id, free_only=free_only)
+        page = _render_page(task_lst, chat, update.message.bot)
     except (ValueError, ConnectionError):
         update.message.reply_text(_ERR_MSG, disable_notification=True)
         _LOGGER.exception('Unable to get list of tasks')
         return
 
-    if not rows:
+    if not page:
         resp_text = 'Ваш список задач пуст!'
         update.message.bot.send_message(chat_id=chat.id, text=resp_text,
                                         disable_notification=True)
         return
 
-    tasks_lst = _compile_list(rows, chat, update.message.bot, for_user=for_user)
-    context.chat_data['pages'] = tasks_lst
-    context.chat_data['page ind'] = 0
-    if len(tasks_lst) > 1:
-        r_nav = 'nav:r'
-        r_text = '>>'
-    else:
-        r_nav = 'nav:-'
-        r_text = '  '
-    cl_nav = 'nav:cl'
-    keyboard = [[InlineKeyboardButton('  ', callback_data='-'),
-                 InlineKeyboardButton('Закрыть', callback_data=cl_nav),
-                 InlineKeyboardButton(r_text, callback_data=r_nav)]]
-    markup = InlineKeyboardMarkup(keyboard)
-    _clean_msg(update, context, keys=('rem lst', ))
-    msg = update.message.bot.send_message(
-        chat_id=chat.id, text=tasks_lst[0], parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True, disable_notification=True,
-        reply_markup=markup
-    )
-    context.chat_data['rem lst'] = {msg.message_id}
+    context.chat_data['list'] = task_lst
+    # Drop pages rendered by the previous versions
+    context.chat_data.pop('pages', None)
+    context.chat_data.pop('page ind', None)
+    _show_list(update, context, page, _nav_markup(task_lst))
 
 
+@timed
 def list_nav(update, context):
     """Parse callback from tasks list and flip pages"""
     data = update.callback_query.data
@@ -384,74 +658,89 @@ def list_nav(update, context):
         return
     update.message = update.callback_query.message
 
-    r_nav = 'nav:r'
-    r_text = '>>'
-    l_nav = 'nav:l'
-    l_text = '<<'
-    cl_nav = 'nav:cl'
-    cl_text = 'Закрыть'
-    alter = False
-
     if command == 'cl':
         update.message.bot.delete_message(update.message.chat.id,
                                           update.message.message_id)
-        if 'pages' in context.chat_data:
-            del context.chat_data['pages']
-        if 'page ind' in context.chat_data:
-            del context.chat_data['page ind']
+        if 'list' in context.chat_data:
+            del context.chat_data['list']
+        shown = context.chat_data.get('list msg')
+        if shown is not None and shown['id'] == update.message.message_id:
+            del context.chat_data['list msg']
         return
 
     try:
-        pages = context.chat_data['pages']
-        page_ind = context.chat_data['page ind']
-        total = len(pages)
+        task_lst = context.chat_data['list']
+        page_ind = task_lst['page ind']
+        total = len(task_lst['cursors'])
     except (KeyError, ValueError):
         context.bot.answer_callback_query(update.callback_query.id)
         _LOGGER.exception('Invalid callback data')
         return
 
+    alter = False
     if command == 'l' and page_ind > 0:
-        if page_ind == 1:
-            l_nav = 'nav:-'
-            l_text = '  '
         alter = True
         page_ind -= 1
-
     elif command == 'r' and page_ind < total - 1:
-        if page_ind == total - 2:
-            r_nav = 'nav:-'
-            r_text = '  '
         alter = True
         page_ind += 1
 
     context.bot.answer_callback_query(update.callback_query.id)
     if alter:
-        keyboard = [[InlineKeyboardButton(l_text, callback_data=l_nav),
-                     InlineKeyboardButton(cl_text, callback_data=cl_nav),
-                     InlineKeyboardButton(r_text, callback_data=r_nav)]]
-        markup = InlineKeyboardMarkup(keyboard)
-        context.chat_data['page ind'] = page_ind
-        update.message.bot.edit_message_text(
-            text=pages[page_ind], chat_id=update.message.chat.id,
-            message_id=update.message.message_id, parse_mode=ParseMode.HTML,
-            disable_web_page_preview=True, disable_notification=True,
-            reply_markup=markup
-        )
-
-
-def _row_sort_key(row):
-    """Sort tasks by marked flag and deadline"""
-    # Sort works in ascending order
-    # To show marked tasks first m_key must be False
-    m_key = False if row['marked'] else True
-    dl_key = row['deadline']
-    if not dl_key:  # If deadline is None
-        dl_key = datetime.max
-        tz = pytz.timezone('UTC')
-        dl_key = tz.localize(dl_key)
-    return m_key, dl_key
+        task_lst['page ind'] = page_ind
+        try:
+            page = _render_page(task_lst, update.message.chat,
+                                update.message.bot)
+        except (ValueError, ConnectionError):
+            _LOGGER.exception('Unable to render list page')
+            return
+        if not page:
+            page = 'Задачи на этой странице уже закрыты'
+        _show_list(update, context, page, _nav_markup(task_lst),
+                   message=update.message)
+
+
+@timed
+def find_tasks(update, context):
+    """
+    Full-text search of open tasks: /find words
+    In the personal chat tasks assigned to the user in any chat are found
+    """
+    query = ' '.join(context.args or [])
+    if not query:
+        update.message.reply_text(
+            'Укажите слова для поиска, например: /find отчёт',
+            disable_notification=True)
+        return
+    chat = update.message.chat
+    user_id = update.message.from_user.id
+    for_user = user_id == chat.id
+    try:
+        handler = db_connector.DataBaseConnector()
+        rows = handler.search_tasks(chat.id, query,
+                                    limit=_PAGE_TASKS_LIM + 1,
+                                    worker_id=user_id if for_user else None)
+        page, count = _compile_page(rows, chat, update.message.bot,
+                                    for_user=for_user)
+    except (ValueError, ConnectionError):
+        update.message.reply_text(_ERR_MSG, disable_notification=True)
+        _LOGGER.exception('Unable to find tasks')
+        return
+
+    if not rows:
+        update.message.reply_text('Ничего не найдено',
+                                  disable_notification=True)
+        return
+    resp_text = f'<b>Найдено по запросу</b> «{html.escape(query)}»:\n\n'
+    resp_text += page
+    if count < len(rows):
+        resp_text += 'Показаны наиболее подходящие задачи, уточните запрос'
+    update.message.bot.send_message(
+        chat_id=chat.id, text=resp_text, parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True, disable_notification=True)
 
 
+@timed
 def take_task(update, context):
     """Assign task to the current user"""
     user_id = update.message.from_user.id
@@ -481,6 +770,7 @@ def take_task(update, context):
     return end_conversation(update, context)
 
 
+@timed
 def ret_task(update, context):
     """Return task to the vacant pool"""
     user_data = context.user_data
@@ -510,6 +800,7 @@ def ret_task(update, context):
     return end_conversation(update, context)
 
 
+@timed
 def rem_deadline(update, context):
     """Removes task deadline"""
     user_data = context.user_data
@@ -538,6 +829,7 @@ def rem_deadline(update, context):
     return end_conversation(update, context)
 
 
+@timed
 def done(update, context):
     """Finish act conversation"""
     msg = update.message.reply_text(u'\u2800', disable_notification=True,
@@ -546,7 +838,9 @@ def done(update, context):
     return end_conversation(update, context)
 
 
+@timed
 def set_marked_status(update, context):
+    """Toggle task marked status"""
     user_data = context.user_data
     if 'chat id' in user_data:
         chat_id = user_data['chat id']
@@ -556,36 +850,35 @@ def set_marked_status(update, context):
     try:
         task_id = user_data['task id']
         handler = db_connector.DataBaseConnector()
-        marked = not handler.task_info(task_id)['marked']
-        success = handler.set_marked_status(task_id, chat_id, user_id, marked)
-    except (ValueError, ConnectionError):
+        marked = handler.toggle_marked(task_id, chat_id, user_id)
+    except (ValueError, ConnectionError, KeyError):
         update.message.reply_text(_ERR_MSG, disable_notification=True,
                                   reply_markup=ReplyKeyboardRemove())
         _LOGGER.exception('Unable to update task marked status')
         return end_conversation(update, context)
-    if not success:
-        if marked:
-            update.message.reply_text('Вы не можете отметить эту задачу',
-                                      disable_notification=True,
-                                      reply_markup=ReplyKeyboardRemove())
-        else:
-            update.message.reply_text('Вы не можете снять отметку '
-                                      'с этой задачи',
-                                      disable_notification=True,
-                                      reply_markup=ReplyKeyboardRemove())
+    if marked is None:
+        update.message.reply_text('Вы не можете изменить отметку '
+                                  'этой задачи',
+                                  disable_notification=True,
+                                  reply_markup=ReplyKeyboardRemove())
+    elif marked:
+        update.message.reply_text('Отметка успешно добавлена',
+                                  disable_notification=True,
+                                  reply_markup=ReplyKeyboardRemove())
     else:
-        if marked:
-            update.message.reply_text('Отметка успешно добавлена',
-                                      disable_notification=True,
-                                      reply_markup=ReplyKeyboardRemove())
-        else:
-            update.message.reply_text('Отметка успешно удалена',
-                                      disable_notification=True,
-                                      reply_markup=ReplyKeyboardRemove())
+        update.message.reply_text('Отметка успешно удалена',
+                                  disable_notification=True,
+                                  reply_markup=ReplyKeyboardRemove())
     return end_conversation(update, context)
 
 
-def act_task(update, context, newly_created=False):
+@timed
+def act_task(update, context):
+    return _task_menu(update, context)
+
+
+def _task_menu(update, context, newly_created=False):
+    """Show the task menu, task id is taken from the command"""
     handler = db_connector.DataBaseConnector()
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
@@ -597,42 +890,36 @@ def act_task(update, context, newly_created=False):
             user_data['task id'] = task_id
         else:
             task_id = user_data['task id']
-        task_info = handler.task_info(task_id)
+        task_info = handler.task_access(task_id, user_id)
         user_data['chat id'] = task_info['chat_id']
-        task_chat = update.message.bot.get_chat(task_info['chat_id'])
 
-        if task_chat.id != chat_id and user_id not in task_info['workers']:
+        if task_info['chat_id'] != chat_id and not task_info['is_worker']:
             update.message.reply_text('Вы не можете управлять этой задачей',
                                       disable_notification=True,
                                       reply_markup=ReplyKeyboardRemove())
             return end_conversation(update, context)
 
-        if task_chat.type == 'private':
-            is_admin = False
-        else:
-            is_admin = user_id in [
-                admin.user.id for admin in
-                update.message.bot.get_chat_administrators(task_info['chat_id'])
-            ]
+        is_admin = ADMINS.is_admin(update.message.bot, task_info['chat_id'],
+                                   user_id)
         buttons = [[]]
         cols = 0
-        if (user_id in task_info['workers'] or is_admin
-                or task_info['chat_id'] == chat_id and not task_info['workers']
-                or task_info['creator_id'] == user_id):
+        if (task_info['is_worker'] or is_admin
+                or task_info['chat_id'] == chat_id and task_info['is_vacant']
+                or task_info['is_creator']):
             buttons[-1] += ['Закрыть задачу']
             cols += 1
 
-        if user_id in task_info['workers']:
+        if task_info['is_worker']:
             cols += 1
             buttons[-1] += ['Отказаться']
 
-        elif task_info['chat_id'] == chat_id and not task_info['workers']:
+        elif task_info['chat_id'] == chat_id and task_info['is_vacant']:
             if not cols % 2:
                 buttons.append([])
             cols += 1
             buttons[-1] += ['Взять']
 
-        if task_info['creator_id'] == user_id or is_admin:
+        if task_info['is_creator'] or is_admin:
             if task_info['deadline']:
                 buttons.append([])
                 buttons[-1] += ['Изменить срок']
@@ -0,0 +1,158 @@
+import heapq
+import os
+import threading
+from datetime import datetime, timezone
+
+import db_connector
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Interval of the full reconciliation with the DataBase, seconds
+SWEEP_INTERVAL = int(os.environ.get('REMINDER_SWEEP_INTERVAL', 900))
+# Reminders due within this number of seconds after the earliest one
+# are delivered together, so they can be sent in one message
+COALESCE_WINDOW = float(os.environ.get('REMINDER_COALESCE_WINDOW', 0))
+
+
+class ReminderScheduler:
+    """
+    Keeps pending reminders in a min-heap ordered by trigger time
+    and fires each at its datetime via the job queue,
+    delayed by the coalescing window if it is set
+
+    Heap is warmed from the DataBase on start and kept in sync by
+    add/remove. Outdated heap entries are skipped lazily.
+    Periodic sweep delivers anything missed and rebuilds the heap.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self.window = window
+        self._heap = []  # (datetime, reminder id)
+        self._pending = {}  # reminder id -> actual datetime
+        self._lock = threading.RLock()
+        self._job_queue = None
+        self._job = None  # Job scheduled for the earliest reminder
+        self._job_time = None
+        self._deliver = None
+        self._sweep = None
+        # Changes made while the heap is being loaded from the DataBase
+        self._changes = None
+        self._forward = None
+
+    def start(self, job_queue, deliver, sweep):
+        """
+        :param deliver: callback(context, rem_ids) sending due reminders
+        :param sweep: callback(context) sending all overdue reminders
+        """
+        self._job_queue = job_queue
+        self._deliver = deliver
+        self._sweep = sweep
+        self.warm()
+        job_queue.run_repeating(self._reconcile, interval=SWEEP_INTERVAL,
+                                first=SWEEP_INTERVAL)
+
+    def forward(self, callback):
+        """
+        Pass changes to the scheduler of another process instead
+        :param callback: callback(method name, *args)
+        """
+        self._forward = callback
+
+    def warm(self):
+        """Load all pending reminders from the DataBase"""
+        with self._lock:
+            self._changes = {}
+        try:
+            handler = db_connector.DataBaseConnector()
+            rems = handler.get_pending_reminders()
+        except (ValueError, ConnectionError):
+            _LOGGER.exception('Unable to load reminders')
+            with self._lock:
+                self._changes = None
+            return
+        with self._lock:
+            self._pending = {rem['id']: rem['datetime'] for rem in rems}
+            for rem_id, date_time in self._changes.items():
+                if date_time is None:
+                    self._pending.pop(rem_id, None)
+                else:
+                    self._pending[rem_id] = date_time
+            self._changes = None
+            self._heap = [(dt, rem_id) for rem_id, dt in self._pending.items()]
+            heapq.heapify(self._heap)
+            self._schedule()
+
+    def add(self, rem_id, date_time):
+        """Schedule new reminder or move the existing one"""
+        if self._forward is not None:
+            self._forward('add', rem_id, date_time)
+            return
+        with self._lock:
+            if self._changes is not None:
+                self._changes[rem_id] = date_time
+            self._pending[rem_id] = date_time
+            heapq.heappush(self._heap, (date_time, rem_id))
+            self._schedule()
+
+    def remove(self, rem_ids):
+        if self._forward is not None:
+            self._forward('remove', list(rem_ids))
+            return
+        with self._lock:
+            for rem_id in rem_ids:
+                if self._changes is not None:
+                    self._changes[rem_id] = None
+                self._pending.pop(rem_id, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _schedule(self):
+        """Make sure the job is set for the earliest pending reminder"""
+        while self._heap:
+            date_time, rem_id = self._heap[0]
+            if self._pending.get(rem_id) == date_time:
+                break
+            heapq.heappop(self._heap)  # Reminder was moved or closed
+        if not self._heap or self._job_queue is None:
+            return
+
+        next_time = self._heap[0][0]
+        if self._job is not None and not self._job.removed:
+            if self._job_time <= next_time:
+                return
+            self._job.schedule_removal()
+        delay = (next_time - datetime.now(timezone.utc)).total_seconds()
+        self._job = self._job_queue.run_once(self._fire,
+                                             max(delay, 0) + self.window)
+        self._job_time = next_time
+
+    def _pop_due(self):
+        now = datetime.now(timezone.utc)
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                date_time, rem_id = heapq.heappop(self._heap)
+                if self._pending.get(rem_id) == date_time:
+                    del self._pending[rem_id]
+                    due.append(rem_id)
+        return due
+
+    def _fire(self, context):
+        due = self._pop_due()
+        try:
+            if due:
+                self._deliver(context, due)
+        finally:
+            with self._lock:
+                self._job = None
+                self._schedule()
+
+    def _reconcile(self, context):
+        """Deliver reminders missed by the heap and rebuild it"""
+        self._sweep(context)
+        self.warm()
+
+
+SCHEDULER = ReminderScheduler()
@@ -0,0 +1,201 @@
+import os
+import queue
+import signal
+import threading
+import time
+
+from telegram import Update
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Number of worker processes, 1 keeps the single process mode
+SHARDS = int(os.environ.get('SHARDS', 1))
+# Max number of updates waiting in the inbox of every shard
+SHARD_QUEUE = int(os.environ.get('SHARD_QUEUE', 1000))
+# Update is dropped if the shard inbox stays full for this number of seconds
+SHARD_PUT_TIMEOUT = float(os.environ.get('SHARD_PUT_TIMEOUT', 1))
+# How often worker processes are checked, seconds
+SHARD_WATCH_INTERVAL = float(os.environ.get('SHARD_WATCH_INTERVAL', 5))
+# Workers still running this number of seconds after stop are terminated
+SHARD_STOP_TIMEOUT = float(os.environ.get('SHARD_STOP_TIMEOUT', 30))
+
+
+def chat_shard(chat_id, shards):
+    return chat_id % shards
+
+
+def shard_of(update, shards):
+    """
+    Updates of one chat always go to the same shard,
+    so its conversations and chat_data are kept by one process
+    """
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return chat_shard(key, shards)
+
+
+class ShardRouter:
+    """
+    Sends updates received by the front process to the shard inboxes
+    Inbox messages are ('update', update dict), ('schedule', change),
+    ('shown', reminder message), ('cache', task change)
+    or None to stop the worker
+    """
+
+    def __init__(self, dispatcher, inboxes, timeout=SHARD_PUT_TIMEOUT):
+        self.inboxes = inboxes
+        self.timeout = timeout
+        self._process_update = dispatcher.process_update
+        # Dispatcher loop calls process_update for every received update
+        dispatcher.process_update = self.process_update
+        self._routed = [0] * len(inboxes)
+        self._dropped = [0] * len(inboxes)
+        self._lock = threading.Lock()
+
+    def process_update(self, update):
+        if not isinstance(update, Update):  # Polling errors
+            self._process_update(update)
+            return
+        shard = shard_of(update, len(self.inboxes))
+        try:
+            # Waits while the shard is behind by SHARD_QUEUE updates,
+            # but a stuck shard must not stop routing to the others
+            self.inboxes[shard].put(('update', update.to_dict()),
+                                    timeout=self.timeout)
+        except queue.Full:
+            _LOGGER.error(f'Inbox of shard {shard} is full, '
+                          f'update {update.update_id} dropped')
+            with self._lock:
+                self._dropped[shard] += 1
+            return
+        with self._lock:
+            self._routed[shard] += 1
+
+    def stats(self):
+        """:returns dict with numbers of routed and dropped updates"""
+        with self._lock:
+            stats = {f'shard_{shard}': routed
+                     for shard, routed in enumerate(self._routed)}
+            stats['dropped'] = sum(self._dropped)
+        return stats
+
+
+class ShardWorkers:
+    """
+    Worker processes of the shards
+    Worker which exited is logged and started again,
+    it continues with the updates left in its inbox
+    """
+
+    def __init__(self, context, inboxes, interval=SHARD_WATCH_INTERVAL):
+        """:param context: multiprocessing context to make processes"""
+        self.inboxes = inboxes
+        self.interval = interval
+        self._context = context
+        self._processes = [None] * len(inboxes)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._restarts = 0
+
+    def _spawn(self, shard):
+        process = self._context.Process(target=run_shard,
+                                        args=(shard, self.inboxes),
+                                        name=f'shard-{shard}')
+        process.start()
+        self._processes[shard] = process
+
+    def start(self):
+        with self._lock:
+            for shard in range(len(self.inboxes)):
+                self._spawn(shard)
+        threading.Thread(target=self._watch, name='shard-watch',
+                         daemon=True).start()
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Restart workers which exited"""
+        with self._lock:
+            if self._stopping.is_set():
+                return
+            for shard, process in enumerate(self._processes):
+                if not process.is_alive():
+                    _LOGGER.error(f'Shard {shard} exited with code '
+                                  f'{process.exitcode}, restarting')
+                    self._restarts += 1
+                    self._spawn(shard)
+
+    def stop(self, timeout=SHARD_STOP_TIMEOUT):
+        """
+        Let workers process their inboxes and stop,
+        workers still running after timeout are terminated
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._stopping.set()
+        for inbox in self.inboxes:
+            try:
+                inbox.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                pass
+        for shard, process in enumerate(self._processes):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                _LOGGER.error(f'Shard {shard} did not stop, terminating')
+                process.terminate()
+                process.join()
+
+    def stats(self):
+        with self._lock:
+            return {'restarts': self._restarts,
+                    'alive': sum(process.is_alive()
+                                 for process in self._processes)}
+
+
+def run_shard(shard, inboxes):
+    """
+    Entry point of the worker process
+    Reminders of all shards are delivered by shard 0,
+    other shards pass reminder changes to its inbox.
+    Task changes are passed to the task caches of all other shards,
+    since tasks of a chat may be changed from a personal chat
+    handled by another shard
+    """
+    # Workers are stopped by the front process after it flushed updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    from bot_handler import bot_handler, reminders, scheduler
+    from db_connector import cache
+    if shard:
+        scheduler.SCHEDULER.forward(
+            lambda *change: inboxes[0].put(('schedule', change)))
+
+    def forward_change(*change):
+        for other, inbox in enumerate(inboxes):
+            if other == shard:
+                continue
+            try:
+                inbox.put(('cache', change), timeout=SHARD_PUT_TIMEOUT)
+            except queue.Full:
+                _LOGGER.warning(f'Inbox of shard {other} is full, its task '
+                                f'cache may miss {change[0]} for '
+                                f'TASK_CACHE_TTL seconds')
+
+    cache.get_cache().forward(forward_change)
+
+    def forward_shown(chat_id, message_id, rem_ids):
+        """chat_data of the user chat is kept by its shard"""
+        inbox = inboxes[chat_shard(chat_id, len(inboxes))]
+        inbox.put(('shown', (chat_id, message_id, rem_ids)))
+
+    reminders.SHOWN.forward(forward_shown)
+    bot = bot_handler.BotHandler(shard=shard)
+    bot.serve_shard(inboxes[shard])
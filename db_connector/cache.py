@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def _copy_row(row):
+    row = row.copy()
+    row['workers'] = list(row['workers'])
+    return row
+
+
+class TaskCache:
+    """
+    In-process cache of open tasks
+
+    Keeps two LRU indexes: tasks of the chat and tasks assigned to the user.
+    Entries are patched in place or invalidated by the DataBaseConnector
+    after every successful update, so readers never see their own
+    writes delayed. Changes may be passed to the caches of other processes
+    (see forward), otherwise ttl bounds staleness caused by them.
+    """
+
+    # Changes which are passed to the caches of other processes
+    _CHANGES = ('task_added', 'task_closed', 'task_updated',
+                'worker_removed', 'invalidate_chat')
+
+    def __init__(self, max_chats=1000, max_users=1000, ttl=300):
+        self.max_chats = max_chats
+        self.max_users = max_users
+        self.ttl = ttl
+        self._chats = OrderedDict()  # chat_id -> (loaded at, {task_id: row})
+        self._users = OrderedDict()  # user_id -> (loaded at, {task_id: row})
+        self._lock = threading.Lock()
+        # Incremented on every write. Result of the query which was started
+        # before some write is not stored as it may be already outdated
+        self._epoch = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'invalidations': 0}
+        self._forward = None
+
+    @property
+    def enabled(self):
+        return self.max_chats > 0
+
+    def forward(self, callback):
+        """
+        Pass every change to the caches of other processes too
+        :param callback: callback(method name, args, fields),
+        the receiving cache calls apply with them
+        """
+        self._forward = callback
+
+    def apply(self, method, args, fields):
+        """Apply the change made by the cache of another process"""
+        if method not in self._CHANGES:
+            raise ValueError(f'Unknown cache change {method}')
+        getattr(self, '_' + method)(*args, **fields)
+
+    def _pass(self, method, *args, **fields):
+        if self._forward is not None and self.enabled:
+            self._forward(method, args, fields)
+
+    def epoch(self):
+        """Get token to pass to put_* after the DB query"""
+        with self._lock:
+            return self._epoch
+
+    def _get(self, index, key):
+        entry = index.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del index[key]
+            entry = None
+        if entry is None:
+            self._stats['misses'] += 1
+            return None
+        index.move_to_end(key)
+        self._stats['hits'] += 1
+        return [_copy_row(row) for row in entry[1].values()]
+
+    def _put(self, index, limit, key, rows, epoch):
+        if epoch != self._epoch or limit <= 0:
+            return
+        index[key] = (time.monotonic(),
+                      {row['id']: _copy_row(row) for row in rows})
+        index.move_to_end(key)
+        while len(index) > limit:
+            index.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get_chat(self, chat_id):
+        """:returns list of open tasks of the chat or None on cache miss"""
+        with self._lock:
+            return self._get(self._chats, chat_id)
+
+    def put_chat(self, chat_id, rows, epoch):
+        with self._lock:
+            self._put(self._chats, self.max_chats, chat_id, rows, epoch)
+
+    def get_user(self, user_id):
+        """:returns list of tasks assigned to the user or None on cache miss"""
+        with self._lock:
+            return self._get(self._users, user_id)
+
+    def put_user(self, user_id, rows, epoch):
+        with self._lock:
+            self._put(self._users, self.max_users, user_id, rows, epoch)
+
+    def _drop_users(self, user_ids=(), task_id=None):
+        """Invalidate user entries by id or containing the task"""
+        for user_id in list(self._users):
+            if user_id in user_ids or task_id in self._users[user_id][1]:
+                del self._users[user_id]
+                self._stats['invalidations'] += 1
+
+    def task_added(self, chat_id, row):
+        """Patch cache after the new task was created"""
+        self._task_added(chat_id, row)
+        self._pass('task_added', chat_id, row)
+
+    def _task_added(self, chat_id, row):
+        with self._lock:
+            self._epoch += 1
+            if chat_id in self._chats:
+                self._chats[chat_id][1][row['id']] = _copy_row(row)
+            self._drop_users(row['workers'])
+
+    def task_closed(self, task_id, chat_id):
+        """Patch cache after the task was closed"""
+        self._task_closed(task_id, chat_id)
+        self._pass('task_closed', task_id, chat_id)
+
+    def _task_closed(self, task_id, chat_id):
+        with self._lock:
+            self._epoch += 1
+            if chat_id in self._chats:
+                self._chats[chat_id][1].pop(task_id, None)
+            self._drop_users(task_id=task_id)
+
+    def task_updated(self, task_id, chat_id, **fields):
+        """
+        Patch cache after the task fields were updated
+        Changing the workers invalidates entries of all affected users
+        """
+        self._task_updated(task_id, chat_id, **fields)
+        self._pass('task_updated', task_id, chat_id, **fields)
+
+    def _task_updated(self, task_id, chat_id, **fields):
+        with self._lock:
+            self._epoch += 1
+            workers = set(fields.get('workers', ()))
+            tasks = self._chats.get(chat_id, (None, {}))[1]
+            if task_id in tasks:
+                if 'workers' in fields:
+                    workers.update(tasks[task_id]['workers'])
+                tasks[task_id].update(fields)
+            if 'workers' in fields:
+                self._drop_users(workers, task_id=task_id)
+                return
+            for _, user_tasks in self._users.values():
+                if task_id in user_tasks:
+                    user_tasks[task_id].update(fields)
+
+    def worker_removed(self, task_id, chat_id, user_id):
+        """Patch cache after the worker was removed from the task"""
+        self._worker_removed(task_id, chat_id, user_id)
+        self._pass('worker_removed', task_id, chat_id, user_id)
+
+    def _worker_removed(self, task_id, chat_id, user_id):
+        with self._lock:
+            self._epoch += 1
+            tasks = self._chats.get(chat_id, (None, {}))[1]
+            if task_id in tasks and user_id in tasks[task_id]['workers']:
+                tasks[task_id]['workers'].remove(user_id)
+            self._drop_users((user_id, ), task_id=task_id)
+
+    def invalidate_chat(self, chat_id):
+        self._invalidate_chat(chat_id)
+        self._pass('invalidate_chat', chat_id)
+
+    def _invalidate_chat(self, chat_id):
+        with self._lock:
+            self._epoch += 1
+            if self._chats.pop(chat_id, None) is not None:
+                self._stats['invalidations'] += 1
+            for user_id in list(self._users):
+                tasks = self._users[user_id][1].values()
+                if any(task['chat_id'] == chat_id for task in tasks):
+                    del self._users[user_id]
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._chats.clear()
+            self._users.clear()
+
+    def stats(self):
+        """:returns dict with cache metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['chats'] = len(self._chats)
+            stats['users'] = len(self._users)
+        return stats
+
+
+def get_cache():
+    """
+    Get process-wide task cache
+    Size is set by TASK_CACHE_SIZE environment variable (0 disables cache)
+    """
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                size = int(os.environ.get('TASK_CACHE_SIZE', 1000))
+                _CACHE = TaskCache(
+                    max_chats=size, max_users=size,
+                    ttl=int(os.environ.get('TASK_CACHE_TTL', 300)))
+    return _CACHE
@@ -1,23 +1,59 @@
-import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import execute_values
 from datetime import datetime, timezone
 import logger
+from instrumentation import timed_methods
+from db_connector import cache, migrations, pool
+from db_connector.rows import make_rows
 
+_NO_DEADLINE = datetime.max.replace(tzinfo=timezone.utc)
 
+# Task lists order: marked tasks first, then by deadline (none last), by id
+# Must match task_sort_key and tasks_open_chat_order_idx
+_ORDER_SQL = '''
+ORDER BY NOT marked, COALESCE(deadline, 'infinity'), id LIMIT (%s)
+'''
+_AFTER_SQL = '''
+AND (NOT marked, COALESCE(deadline, 'infinity'), id) > (NOT (%s),
+    COALESCE(CAST((%s) AS TIMESTAMP WITH TIME ZONE), 'infinity'), (%s))
+'''
+
+
+def task_sort_key(row):
+    """Sort key of the task row in the order of task lists"""
+    return not row['marked'], row['deadline'] or _NO_DEADLINE, row['id']
+
+
+def task_cursor(row):
+    """Cursor to get tasks following the row: (marked, deadline, id)"""
+    return row['marked'], row['deadline'], row['id']
+
+
+def _page_of(rows, after, limit):
+    """Sort rows and take the page following the cursor"""
+    rows = sorted(rows, key=task_sort_key)
+    if after is not None:
+        after_key = task_sort_key(dict(zip(('marked', 'deadline', 'id'),
+                                           after)))
+        rows = [row for row in rows if task_sort_key(row) > after_key]
+    return rows[:limit]
+
+
+_OVERDUE_SQL = '''
+SELECT rem.id, rem.user_id, rem.datetime, rem.task_id,
+t.task_text, t.deadline
+FROM reminders AS rem, tasks as t
+WHERE rem.datetime <= (%s) AND rem.canceled = (%s)
+AND rem.task_id = t.id
+'''
+
+
+@timed_methods('db')
 class DataBaseConnector:
     def __init__(self):
-        self._db_url = os.environ['DATABASE_URL']
         self._log = logger.get_logger(__name__)
-        self._conn = None
-        self._cur = None
-
-    def _close_conn(self):
-        """Ensure the connection is closed"""
-        if self._cur is not None:
-            self._cur.close()
-        if self._conn is not None:
-            self._conn.close()
+        self._pool = pool.get_pool()
+        self._cache = cache.get_cache()
 
     def _commit(self, *args, fetch_data=False):
         """
@@ -27,27 +63,20 @@ class DataBaseConnector:
         :raises ConnectionError: if couldn't connect to DB
         :raises ValueError: if couldn't execute SQL
         """
-        self._conn = None
-        try:
-            self._conn = psycopg2.connect(self._db_url, sslmode='require')
-        except (Exception, psycopg2.DatabaseError):
-            self._close_conn()
-            self._log.exception('Unable to connect to the DataBase')
-            raise ConnectionError('Unable to connect to the DataBase')
-
-        self._cur = self._conn.cursor()
         row = None
         try:
-            self._cur.execute(*args)
-            self._conn.commit()
-            if fetch_data:
-                row = self._cur.fetchone()
+            with self._pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(*args)
+                    if fetch_data:
+                        row = cur.fetchone()
+                    rows_num = cur.rowcount
+                conn.commit()
+        except ConnectionError:
+            raise
         except (Exception, psycopg2.DatabaseError):
-            self._close_conn()
             self._log.exception('Unable to execute SQL')
             raise ValueError('Unable to execute SQL')
-        rows_num = self._cur.rowcount
-        self._close_conn()
         if fetch_data:
             return rows_num, row
         return rows_num
@@ -55,30 +84,83 @@ class DataBaseConnector:
     def _fetch_success(self, *args):
         """
         Executes SQL query and fetches result
-        :returns DictRow of affected rows
+        Query is repeated once on a fresh connection
+        if the pooled one turned out to be broken
+        :returns list of Row (compact rows with key and attribute access)
+        :raises ConnectionError: if couldn't connect to DB
+        :raises ValueError: if couldn't execute SQL
+        """
+        for attempt in range(2):
+            try:
+                with self._pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(*args)
+                        fetched = make_rows(cur, cur.fetchall())
+                    conn.commit()
+                return fetched
+            except ConnectionError:
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                if attempt:
+                    self._log.exception('Unable to execute SQL')
+                    raise ValueError('Unable to execute SQL', err)
+                self._log.warning('DataBase connection lost, reconnecting')
+            except (Exception, psycopg2.DatabaseError) as err:
+                self._log.exception('Unable to execute SQL')
+                raise ValueError('Unable to execute SQL', err)
+
+    def _commit_values(self, sql_str, values, template=None):
+        """
+        Execute query with VALUES %s for all values in one statement
+        :param template: SQL of one row, e.g. '(%s, %s)'
+        :returns list of rows returned by the query
         :raises ConnectionError: if couldn't connect to DB
         :raises ValueError: if couldn't execute SQL
         """
-        self._conn = None
         try:
-            self._conn = psycopg2.connect(self._db_url, sslmode='require',
-                                          cursor_factory=RealDictCursor)
-        except (Exception, psycopg2.DatabaseError) as err:
-            self._close_conn()
+            with self._pool.connection() as conn:
+                with conn.cursor() as cur:
+                    rows = execute_values(cur, sql_str, values, template,
+                                          page_size=len(values), fetch=True)
+                conn.commit()
+        except ConnectionError:
+            raise
+        except (Exception, psycopg2.DatabaseError):
             self._log.exception('Unable to execute SQL')
-            raise ConnectionError('Unable to connect to the DataBase', err)
+            raise ValueError('Unable to execute SQL')
+        return rows
 
-        self._cur = self._conn.cursor()
+    def apply_migrations(self):
+        """
+        Bring DataBase schema up to date
+        :returns list of applied migration versions
+        :raises ConnectionError: if couldn't connect to DB
+        :raises ValueError: if migration failed
+        """
         try:
-            self._cur.execute(*args)
-            rows = self._cur.fetchall()
+            with self._pool.connection() as conn:
+                return migrations.migrate(conn)
+        except ConnectionError:
+            raise
         except (Exception, psycopg2.DatabaseError) as err:
-            self._close_conn()
-            self._log.exception('Unable to execute SQL')
-            raise ValueError('Unable to execute SQL', err)
+            self._log.exception('Unable to apply migrations')
+            raise ValueError('Unable to apply migrations', err)
 
-        self._close_conn()
-        return rows
+    def pool_stats(self):
+        """
+        Get connection pool metrics
+        :returns dict with keys: checkouts, waits, wait_time,
+        reconnects, discarded, size, idle
+        """
+        return self._pool.stats()
+
+    def cache_stats(self):
+        """
+        Get task cache metrics
+        :returns dict with keys: hits, misses, evictions,
+        invalidations, chats, users
+        """
+        return self._cache.stats()
 
     def add_task(self, chat_id, creator_id, task_text, marked=False,
                  deadline=None, workers: list = None):
@@ -103,8 +185,37 @@ class DataBaseConnector:
             task_id = int(info[0])
         except (ValueError, ConnectionError):  # Pass the exception up
             raise
+        self._cache.task_added(chat_id, {
+            'id': task_id, 'creator_id': creator_id, 'task_text': task_text,
+            'marked': marked, 'deadline': deadline, 'workers': workers})
         return task_id
 
+    def add_tasks(self, chat_id, creator_id, task_texts: list):
+        """
+        Add several tasks to the chat in one statement
+        :returns list of new task ids in the order of task_texts
+        :raises ConnectionError: if DB exception occurred
+        :raises ValueError: if couldn't add tasks to DB
+        """
+        if not task_texts:
+            return []
+        sql_str = '''
+        INSERT INTO tasks (chat_id, creator_id, task_text) VALUES %s
+        RETURNING id;
+        '''
+        values = [(chat_id, creator_id, text) for text in task_texts]
+        try:
+            rows = self._commit_values(sql_str, values)
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+        task_ids = [int(row[0]) for row in rows]
+        for task_id, task_text in zip(task_ids, task_texts):
+            self._cache.task_added(chat_id, {
+                'id': task_id, 'creator_id': creator_id,
+                'task_text': task_text, 'marked': False, 'deadline': None,
+                'workers': []})
+        return task_ids
+
     def close_task(self, task_id, chat_id, user_id, admin=False):
         """
         Close task if possible
@@ -143,8 +254,48 @@ class DataBaseConnector:
 
         if update_res is None or update_res == -1 or update_res == 0:
             return False
+        self._cache.task_closed(task_id, chat_id)
         return True
 
+    def close_tasks(self, task_ids: list, chat_id, user_id, admin=False):
+        """
+        Close several tasks in one statement
+        Rules of close_task apply to the tasks of the chat,
+        tasks of other chats can be closed by their workers
+        Also cancels all the connected reminders
+        :param admin: user is administrator of the chat
+        :returns dict: task id -> success indicator
+        :raises ConnectionError: if DB exception occurred
+        :raises ValueError: if couldn't update tasks in the DB
+        """
+        sql_str = '''
+        WITH src AS(
+        UPDATE tasks
+        SET closed = (%s)
+        WHERE id = ANY(%s) AND closed = (%s)
+        AND ((%s) = ANY(workers) OR (chat_id = (%s)
+        AND ((%s) OR workers = (%s) OR creator_id = (%s))))
+        RETURNING id, chat_id
+        ), rem AS (
+        UPDATE reminders
+        SET canceled = (%s)
+        WHERE task_id IN (SELECT id FROM src)
+        )
+        SELECT id, chat_id FROM src
+        '''
+        sql_val = (True, list(task_ids), False, user_id, chat_id, admin, [],
+                   user_id, True)
+        try:
+            closed = self._fetch_success(sql_str, sql_val)
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+
+        results = dict.fromkeys(task_ids, False)
+        for row in closed:
+            results[row['id']] = True
+            self._cache.task_closed(row['id'], row['chat_id'])
+        return results
+
     def assign_task(self, task_id, chat_id, user_id, workers: list, admin=False):
         """
         Assign worker to the task
@@ -178,8 +329,47 @@ class DataBaseConnector:
 
         if update_res is None or update_res == -1 or update_res == 0:
             return False
+        self._cache.task_updated(task_id, chat_id, workers=workers)
         return True
 
+    def assign_tasks(self, task_ids: list, chat_id, user_id, workers: list,
+                     admin=False):
+        """
+        Assign workers to several tasks of the chat in one statement
+        Rules of assign_task apply
+        :returns dict: task id -> success indicator
+        :raises ConnectionError: if DB exception occurred
+        :raises ValueError: if couldn't update tasks in the DB
+        """
+        results = dict.fromkeys(task_ids, False)
+        take_flag = len(workers) == 1 and workers[0] == user_id
+        if not take_flag and not admin:
+            return results
+
+        sql_str = '''
+                UPDATE tasks
+                SET workers = (%s), assigned = (%s)
+                WHERE id = ANY(%s) AND chat_id = (%s)
+                AND closed = (%s)
+                '''
+        sql_val = (workers, admin, list(task_ids), chat_id, False)
+
+        if take_flag:
+            # Assert total number of workers equals zero
+            sql_str += 'AND cardinality(workers) = (%s)'
+            sql_val += (0, )
+        sql_str += 'RETURNING id'
+
+        try:
+            assigned = self._fetch_success(sql_str, sql_val)
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+
+        for row in assigned:
+            results[row['id']] = True
+            self._cache.task_updated(row['id'], chat_id, workers=workers)
+        return results
+
     def rem_worker(self, task_id, chat_id, user_id):
         """
         Remove user from workers list
@@ -202,8 +392,46 @@ class DataBaseConnector:
 
         if update_res is None or update_res == -1 or update_res == 0:
             return False
+        self._cache.worker_removed(task_id, chat_id, user_id)
         return True
 
+    def prune_workers(self, members: list):
+        """
+        Remove users who left chats from workers of the chat tasks
+        Like rem_worker, workers assigned by admin are kept
+        :param members: list of (chat_id, user_id)
+        :returns number of updated tasks
+        :raises ConnectionError: if DB exception occurred
+        :raises ValueError: if couldn't update tasks in the DB
+        """
+        if not members:
+            return 0
+        sql_str = '''
+        UPDATE tasks AS t
+        SET workers = COALESCE((
+            SELECT array_agg(w) FROM unnest(t.workers) AS w
+            WHERE w <> ALL(m.users)), '{}')
+        FROM (
+            SELECT chat_id, array_agg(user_id) AS users
+            FROM (VALUES %s) AS v (chat_id, user_id) GROUP BY chat_id
+        ) AS m
+        WHERE t.chat_id = m.chat_id AND t.workers && m.users
+        AND t.assigned = FALSE AND t.closed = FALSE
+        RETURNING t.id, t.chat_id
+        '''
+        try:
+            rows = self._commit_values(
+                sql_str, list(members), '(CAST(%s AS BigInt), CAST(%s AS BigInt))')
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+        users = {}
+        for chat_id, user_id in members:
+            users.setdefault(chat_id, []).append(user_id)
+        for task_id, chat_id in rows:
+            for user_id in users[chat_id]:
+                self._cache.worker_removed(task_id, chat_id, user_id)
+        return len(rows)
+
     def set_deadline(self, task_id, chat_id, user_id, deadline: datetime = None):
         """
         Update task deadline if possible
@@ -229,12 +457,14 @@ class DataBaseConnector:
 
         if update_res is None or update_res == -1 or update_res == 0:
             return False
+        self._cache.task_updated(task_id, chat_id, deadline=deadline)
         return True
 
     def get_tasks(self, chat_id, free_only=False):
         """
         Get all tasks from the given chat
         if free_only flag is set, only vacant tasks are returned
+        Result is served from the task cache when possible
         :returns DictRow (list of tasks which belong to this chat)
         Each task is represented by dict
         dict keys: id, creator_id, task_text, marked, deadline, workers
@@ -242,23 +472,27 @@ class DataBaseConnector:
         :raises ValueError: if unable to fetch tasks from the DataBase
         :raises ConnectionError: if DB exception occurred
         """
-        sql_str = '''
-        SELECT id, creator_id, task_text, marked, deadline, workers 
-        FROM tasks WHERE chat_id = (%s)  AND closed = (%s)
-        '''
-        sql_val = (chat_id, False)
+        select_res = self._cache.get_chat(chat_id)
+        if select_res is None:
+            sql_str = '''
+            SELECT id, creator_id, task_text, marked, deadline, workers 
+            FROM tasks WHERE chat_id = (%s)  AND closed = (%s)
+            '''
+            sql_val = (chat_id, False)
+            epoch = self._cache.epoch()
+            try:
+                select_res = self._fetch_success(sql_str, sql_val)
+            except (ValueError, ConnectionError):  # Pass the exception up
+                raise
+            self._cache.put_chat(chat_id, select_res, epoch)
         if free_only:
-            sql_str += 'AND workers = (%s)'
-            sql_val += ([],)
-        try:
-            select_res = self._fetch_success(sql_str, sql_val)
-        except (ValueError, ConnectionError):  # Pass the exception up
-            raise
+            select_res = [row for row in select_res if not row['workers']]
         return select_res
 
     def get_user_tasks(self, user_id):
         """
         Get all tasks assigned to the user
+        Result is served from the task cache when possible
         :returns DictRow (list of tasks)
         Each task is represented by dict
         dict keys: id, chat_id, creator_id, task_text, marked, deadline, workers
@@ -268,9 +502,117 @@ class DataBaseConnector:
         """
         sql_str = '''
         SELECT id, chat_id, creator_id, task_text, marked, deadline, workers 
-        FROM tasks WHERE (%s) = ANY(workers) AND closed = (%s)
+        FROM tasks WHERE workers @> ARRAY[CAST((%s) AS BigInt)]
+        AND closed = (%s)
+        '''
+        sql_val = (user_id, False)
+        select_res = self._cache.get_user(user_id)
+        if select_res is not None:
+            return select_res
+        epoch = self._cache.epoch()
+        try:
+            select_res = self._fetch_success(sql_str, sql_val)
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+        self._cache.put_user(user_id, select_res, epoch)
+        return select_res
+
+    def _fetch_page(self, sql_str, sql_val, after, limit):
+        if after is not None:
+            sql_str += _AFTER_SQL
+            sql_val += tuple(after)
+        try:
+            return self._fetch_success(sql_str + _ORDER_SQL,
+                                       sql_val + (limit, ))
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+
+    def get_tasks_page(self, chat_id, after=None, limit=10, free_only=False):
+        """
+        Get the page of the chat tasks sorted by task_sort_key
+        Result is served from the task cache when possible
+        :param after: task_cursor of the last task of the previous page
+        :returns DictRow (list of at most limit tasks)
+        dict keys: id, creator_id, task_text, marked, deadline, workers
+
+        :raises ValueError: if unable to fetch tasks from the DataBase
+        :raises ConnectionError: if DB exception occurred
+        """
+        cached = self._cache.get_chat(chat_id)
+        if cached is not None:
+            if free_only:
+                cached = [row for row in cached if not row['workers']]
+            return _page_of(cached, after, limit)
+
+        sql_str = '''
+        SELECT id, creator_id, task_text, marked, deadline, workers
+        FROM tasks WHERE chat_id = (%s) AND closed = (%s)
+        '''
+        sql_val = (chat_id, False)
+        if free_only:
+            sql_str += "AND workers = '{}'"
+        epoch = self._cache.epoch()
+        select_res = self._fetch_page(sql_str, sql_val, after, limit)
+        if after is None and not free_only and len(select_res) < limit:
+            # The whole list fits the first page
+            self._cache.put_chat(chat_id, select_res, epoch)
+        return select_res
+
+    def get_user_tasks_page(self, user_id, after=None, limit=10):
+        """
+        Get the page of tasks assigned to the user sorted by task_sort_key
+        Result is served from the task cache when possible
+        :param after: task_cursor of the last task of the previous page
+        :returns DictRow (list of at most limit tasks)
+        dict keys: id, chat_id, creator_id, task_text, marked, deadline, workers
+
+        :raises ValueError: if unable to fetch tasks from the DataBase
+        :raises ConnectionError: if DB exception occurred
+        """
+        cached = self._cache.get_user(user_id)
+        if cached is not None:
+            return _page_of(cached, after, limit)
+
+        sql_str = '''
+        SELECT id, chat_id, creator_id, task_text, marked, deadline, workers
+        FROM tasks WHERE workers @> ARRAY[CAST((%s) AS BigInt)]
+        AND closed = (%s)
         '''
         sql_val = (user_id, False)
+        epoch = self._cache.epoch()
+        select_res = self._fetch_page(sql_str, sql_val, after, limit)
+        if after is None and len(select_res) < limit:
+            self._cache.put_user(user_id, select_res, epoch)
+        return select_res
+
+    def search_tasks(self, chat_id, query, limit=10, worker_id=None):
+        """
+        Full-text search of open tasks of the chat
+        Results are ranked by relevance
+        :param worker_id: also search tasks of other chats
+        assigned to this user
+        :returns DictRow (list of at most limit tasks)
+        dict keys: id, chat_id, creator_id, task_text, marked, deadline, workers
+
+        :raises ValueError: if unable to fetch tasks from the DataBase
+        :raises ConnectionError: if DB exception occurred
+        """
+        sql_str = '''
+        SELECT id, chat_id, creator_id, task_text, marked, deadline, workers
+        FROM tasks, plainto_tsquery('russian', (%s)) AS query
+        WHERE text_search @@ query AND closed = (%s)
+        '''
+        sql_val = (query, False)
+        if worker_id is None:
+            sql_str += 'AND chat_id = (%s)'
+            sql_val += (chat_id, )
+        else:
+            sql_str += 'AND (chat_id = (%s) OR (%s) = ANY(workers))'
+            sql_val += (chat_id, worker_id)
+        sql_str += '''
+        ORDER BY ts_rank(text_search, query) DESC, id DESC LIMIT (%s)
+        '''
+        sql_val += (limit, )
         try:
             select_res = self._fetch_success(sql_str, sql_val)
         except (ValueError, ConnectionError):  # Pass the exception up
@@ -323,12 +665,76 @@ class DataBaseConnector:
 
         if update_res is None or update_res == -1 or update_res == 0:
             return False
+        self._cache.task_updated(task_id, chat_id, marked=marked)
         return True
 
+    def toggle_marked(self, task_id, chat_id, user_id):
+        """
+        Invert marked status ([ ! ]) in one statement
+        Permissions are the same as in set_marked_status
+        :returns new marked status or None if task can't be updated
+        :raises ConnectionError: if DB exception occurred
+        :raises ValueError: if couldn't update task in the DB
+        """
+        sql_str = '''
+        UPDATE tasks
+        SET marked = NOT marked
+        WHERE id = (%s)  AND chat_id = (%s)
+        AND (workers = (%s) OR creator_id = (%s) OR (%s) = ANY(workers))
+        AND closed = (%s)
+        RETURNING marked
+        '''
+        sql_val = (task_id, chat_id, [], user_id, user_id, False)
+
+        try:
+            update_res, row = self._commit(sql_str, sql_val, fetch_data=True)
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+
+        if row is None:
+            return None
+        self._cache.task_updated(task_id, chat_id, marked=row[0])
+        return row[0]
+
+    def task_access(self, task_id, user_id):
+        """
+        Get task data together with the user's relation to it
+        :return: RealDictRow:(id, chat_id, creator_id, task_text,
+                              marked, deadline, workers,
+                              is_creator, is_worker, is_vacant,
+                              can_close, can_mark, can_set_deadline)
+        can_* flags reflect permissions of the non-admin user
+        :raises ValueError: if task does not exist or is closed
+        :raises ConnectionError: if DB exception occurred
+        """
+        sql_str = '''
+        SELECT *,
+        is_creator OR is_worker OR is_vacant AS can_close,
+        is_creator OR is_worker OR is_vacant AS can_mark,
+        is_creator OR is_worker AS can_set_deadline
+        FROM (
+            SELECT id, chat_id, creator_id, task_text, marked, deadline,
+            workers,
+            creator_id = (%s) AS is_creator,
+            (%s) = ANY(workers) AS is_worker,
+            cardinality(workers) = 0 AS is_vacant
+            FROM tasks WHERE id = (%s) AND closed = (%s)
+        ) AS t
+        '''
+        sql_val = (user_id, user_id, task_id, False)
+
+        try:
+            task = self._fetch_success(sql_str, sql_val)[0]
+        except IndexError:
+            raise ValueError('Could not find task')
+        except (ValueError, ConnectionError):
+            raise  # Pass the exception up
+        return task
+
     def create_reminder(self, task_id, user_id, date_time):
         """
         Add new reminder to the database.
-        :returns Success indicator
+        :returns New reminder id
         :raises ConnectionError: if DB exception occurred
         :raises ValueError: if couldn't add task to DB
         """
@@ -341,10 +747,11 @@ class DataBaseConnector:
         sql_val = (task_id, user_id, date_time)
 
         try:
-            res = self._commit(sql_str, sql_val)
+            count, info = self._commit(sql_str, sql_val, fetch_data=True)
+            rem_id = int(info[0])
         except (ValueError, ConnectionError):  # Pass the exception up
             raise
-        return res
+        return rem_id
 
     def reset_reminder(self, rem_id, user_id, date_time):
         """
@@ -367,23 +774,67 @@ class DataBaseConnector:
             return False
         return True
 
-    def get_overdue_reminders(self):
+    def get_overdue_reminders(self, rem_ids: list = None):
         """
         Get all reminders which are ready to be triggered
+        If rem_ids is given, only reminders with these ids are checked
         :returns DictRow (list of reminders)
         Each task is represented by dict
-        dict keys: id, user_id, task_id, task_text, deadline
+        dict keys: id, user_id, datetime, task_id, task_text, deadline
 
         :raises ValueError: if unable to fetch tasks from the DataBase
         :raises ConnectionError: if DB exception occurred
         """
+        sql_str = _OVERDUE_SQL
+        sql_val = (datetime.now(timezone.utc), False)
+        if rem_ids is not None:
+            sql_str += 'AND rem.id = ANY(%s)'
+            sql_val += (list(rem_ids), )
+        try:
+            select_res = self._fetch_success(sql_str, sql_val)
+        except (ValueError, ConnectionError):  # Pass the exception up
+            raise
+        return select_res
+
+    def iter_overdue_reminders(self, batch_size=500):
+        """
+        Get all reminders which are ready to be triggered in batches
+        Every batch is fetched by its own query after the last id of the
+        previous one, so no connection is held while a batch is processed
+        :returns generator of lists of at most batch_size reminders
+        dict keys: id, user_id, datetime, task_id, task_text, deadline
+
+        :raises ValueError: if unable to fetch tasks from the DataBase
+        :raises ConnectionError: if DB exception occurred
+        """
+        sql_str = _OVERDUE_SQL + 'AND rem.id > (%s) ORDER BY rem.id LIMIT (%s)'
+        now = datetime.now(timezone.utc)
+        last_id = 0
+        while True:
+            try:
+                batch = self._fetch_success(
+                    sql_str, (now, False, last_id, batch_size))
+            except (ValueError, ConnectionError):  # Pass the exception up
+                raise
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1]['id']
+
+    def get_pending_reminders(self):
+        """
+        Get trigger time of all reminders which are not canceled
+        :returns DictRow (list of reminders)
+        dict keys: id, datetime
+
+        :raises ValueError: if unable to fetch reminders from the DataBase
+        :raises ConnectionError: if DB exception occurred
+        """
         sql_str = '''
-                SELECT rem.id, rem.user_id, rem.task_id, t.task_text, t.deadline 
-                FROM reminders AS rem, tasks as t
-                WHERE rem.datetime <= (%s) AND rem.canceled = (%s)
-                AND rem.task_id = t.id
+                SELECT id, datetime FROM reminders WHERE canceled = (%s)
                 '''
-        sql_val = (datetime.now(timezone.utc), False)
+        sql_val = (False, )
         try:
             select_res = self._fetch_success(sql_str, sql_val)
         except (ValueError, ConnectionError):  # Pass the exception up
@@ -0,0 +1,100 @@
+"""
+Versioned DataBase schema migrations
+
+Every migration is applied once in its own transaction and recorded
+in the schema_migrations table. New migrations must be appended
+to the end of MIGRATIONS with the next version number.
+"""
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Key of the advisory lock which prevents concurrent migration
+_LOCK_KEY = 0x7461736b
+
+MIGRATIONS = [
+    (1, 'Initial schema', '''
+    CREATE TABLE IF NOT EXISTS tasks (
+        id SERIAL PRIMARY KEY,
+        chat_id BigInt NOT NULL,
+        creator_id BigInt NOT NULL,
+        task_text TEXT NOT NULL,
+        marked BOOLEAN NOT NULL DEFAULT FALSE,
+        deadline TIMESTAMP WITH TIME ZONE,
+        workers BigInt[] NOT NULL DEFAULT '{}',
+        assigned BOOLEAN NOT NULL DEFAULT FALSE,
+        closed BOOLEAN NOT NULL DEFAULT FALSE
+    );
+    CREATE TABLE IF NOT EXISTS reminders (
+        id SERIAL PRIMARY KEY,
+        task_id INTEGER NOT NULL REFERENCES tasks (id),
+        user_id BigInt NOT NULL,
+        datetime TIMESTAMP WITH TIME ZONE NOT NULL,
+        canceled BOOLEAN NOT NULL DEFAULT FALSE
+    );
+    '''),
+    (2, 'Indexes for task lists and reminders', '''
+    CREATE INDEX IF NOT EXISTS tasks_open_chat_idx
+        ON tasks (chat_id) WHERE closed = FALSE;
+    CREATE INDEX IF NOT EXISTS tasks_open_workers_idx
+        ON tasks USING GIN (workers) WHERE closed = FALSE;
+    CREATE INDEX IF NOT EXISTS reminders_pending_idx
+        ON reminders (datetime) WHERE canceled = FALSE;
+    CREATE INDEX IF NOT EXISTS reminders_task_idx
+        ON reminders (task_id);
+    '''),
+    (3, 'Index for keyset pagination of task lists', '''
+    CREATE INDEX IF NOT EXISTS tasks_open_chat_order_idx
+        ON tasks (chat_id, (NOT marked), (COALESCE(deadline, 'infinity')), id)
+        WHERE closed = FALSE;
+    '''),
+    (4, 'Full-text search of tasks', '''
+    ALTER TABLE tasks ADD COLUMN IF NOT EXISTS text_search tsvector
+        GENERATED ALWAYS AS (to_tsvector('russian', task_text)) STORED;
+    CREATE INDEX IF NOT EXISTS tasks_text_search_idx
+        ON tasks USING GIN (text_search) WHERE closed = FALSE;
+    '''),
+]
+
+
+def current_version(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    )
+    ''')
+    cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+    return cur.fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Apply all pending migrations
+    :returns list of applied versions
+    :raises psycopg2.DatabaseError: if migration failed,
+    failed migration is rolled back
+    """
+    applied = []
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_lock(%s)', (_LOCK_KEY, ))
+        try:
+            version = current_version(cur)
+            conn.commit()
+            for mig_version, name, sql_str in MIGRATIONS:
+                if mig_version <= version:
+                    continue
+                cur.execute(sql_str)
+                cur.execute('INSERT INTO schema_migrations (version, name) '
+                            'VALUES (%s, %s)', (mig_version, name))
+                conn.commit()
+                applied.append(mig_version)
+                _LOGGER.info(f'Applied migration {mig_version}: {name}')
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute('SELECT pg_advisory_unlock(%s)', (_LOCK_KEY, ))
+            conn.commit()
+    return applied
@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+import logger
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of long-lived DataBase connections
+
+    Connections are checked for health on checkout and silently
+    replaced if the server has dropped them
+    """
+
+    def __init__(self, db_url, min_size=1, max_size=10, timeout=30,
+                 check_after=30, **conn_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size')
+        self._db_url = db_url
+        self._conn_kwargs = conn_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        # Idle time after which connection is pinged before use
+        self.check_after = check_after
+        self._log = logger.get_logger(__name__)
+
+        self._idle = []  # (connection, time it was returned to the pool)
+        self._size = 0  # Number of opened connections (idle + in use)
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0,
+                       'reconnects': 0, 'discarded': 0}
+
+        for _ in range(min_size):
+            try:
+                self._idle.append((self._connect(), time.monotonic()))
+            except ConnectionError:
+                break  # Pool will try again on checkout
+            self._size += 1
+
+    def _connect(self):
+        """
+        Open new connection
+        :raises ConnectionError: if couldn't connect to DB
+        """
+        try:
+            return psycopg2.connect(self._db_url, **self._conn_kwargs)
+        except (Exception, psycopg2.DatabaseError):
+            self._log.exception('Unable to connect to the DataBase')
+            raise ConnectionError('Unable to connect to the DataBase')
+
+    def _is_alive(self, conn, idle_since):
+        """Check that connection is opened and server still answers"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+        except (Exception, psycopg2.Error):
+            return False
+        return True
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except (Exception, psycopg2.Error):
+            pass
+
+    def getconn(self):
+        """
+        Take connection from the pool
+        Blocks if all connections are in use and pool is full
+        :raises ConnectionError: if couldn't connect to DB
+        or no connection was released in time
+        """
+        started = None
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                if started is None:
+                    started = time.monotonic()
+                    self._stats['waits'] += 1
+                left = self.timeout - (time.monotonic() - started)
+                if left <= 0 or not self._cond.wait(left):
+                    self._stats['wait_time'] += time.monotonic() - started
+                    raise ConnectionError('DataBase connection pool exhausted')
+            if started is not None:
+                self._stats['wait_time'] += time.monotonic() - started
+            self._stats['checkouts'] += 1
+            conn, idle_since = self._idle.pop() if self._idle else (None, 0)
+            if conn is None:
+                self._size += 1  # Reserve slot for the new connection
+
+        if conn is not None and self._is_alive(conn, idle_since):
+            return conn
+
+        if conn is not None:
+            self._close(conn)
+            with self._cond:
+                self._stats['reconnects'] += 1
+        try:
+            return self._connect()
+        except ConnectionError:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, discard=False):
+        """
+        Return connection to the pool
+        Broken connections and connections with failed
+        transaction are closed instead
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()  # Clean up any unfinished transaction
+            except (Exception, psycopg2.Error):
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            with self._cond:
+                self._stats['discarded'] += 1
+            self._release_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager which checks out connection
+        and returns it to the pool afterwards
+        Connection is discarded if it was broken inside the block
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close all idle connections"""
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop()[0])
+                self._size -= 1
+
+    def stats(self):
+        """:returns dict with pool metrics"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+        return stats
+
+
+def get_pool():
+    """
+    Get process-wide connection pool
+    Pool is created on first call using DATABASE_URL
+    and DB_POOL_MIN/DB_POOL_MAX environment variables
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+                    max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+                    sslmode=os.environ.get('DB_SSLMODE', 'require'))
+    return _POOL
@@ -0,0 +1,115 @@
+import keyword
+import threading
+
+_CLASSES = {}
+_CLASSES_LOCK = threading.Lock()
+
+
+class Row:
+    """
+    Compact DataBase row
+
+    Fields are kept in slots of the class made for every query shape
+    instead of a dict per row. Supports both key (row['id']) and
+    attribute (row.id) access and the read methods of dict.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, key):
+        # Keys are column names, which never clash with the methods
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Row, dict)):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return f'Row({dict(self.items())})'
+
+    def __reduce__(self):
+        return _restore, (self._fields, self.values())
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [getattr(self, name) for name in self._fields]
+
+    def items(self):
+        return list(zip(self._fields, self.values()))
+
+    def update(self, fields=(), **kwargs):
+        for key, value in dict(fields, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        """:returns shallow copy of the row"""
+        return _restore(self._fields, self.values())
+
+
+def _init_source(fields):
+    """Source of __init__ setting every field, as namedtuple makes it"""
+    args = ', '.join(fields)
+    body = ''.join(f'    self.{name} = {name}\n' for name in fields)
+    return f'def __init__(self, {args}):\n{body or "    pass"}\n'
+
+
+def row_class(fields):
+    """
+    Get the Row class of the query shape
+    :param fields: tuple of column names
+    :raises ValueError: if the column name can't be a Row field
+    """
+    cls = _CLASSES.get(fields)
+    if cls is not None:
+        return cls
+    for name in fields:
+        if (not name.isidentifier() or keyword.iskeyword(name)
+                or name.startswith('_') or hasattr(Row, name)):
+            raise ValueError(f'Column {name} can not be a Row field')
+    if len(set(fields)) != len(fields):
+        raise ValueError(f'Duplicate columns in {fields}')
+    namespace = {}
+    exec(_init_source(fields), namespace)
+    with _CLASSES_LOCK:
+        if fields not in _CLASSES:
+            _CLASSES[fields] = type('Row', (Row, ), {
+                '__slots__': fields, '_fields': fields,
+                '__init__': namespace['__init__']})
+        return _CLASSES[fields]
+
+
+def _restore(fields, values):
+    return row_class(fields)(*values)
+
+
+def make_rows(cursor, rows):
+    """
+    Convert tuples fetched by the cursor to Row objects
+    :returns list of Row
+    """
+    cls = row_class(tuple(column.name for column in cursor.description))
+    return [cls(*values) for values in rows]
@@ -0,0 +1,311 @@
+"""
+Lightweight latency instrumentation
+
+Every timed operation keeps a rolling window of its latest durations
+along with total count and number of failed calls. Snapshots are shown
+by the /stats command and may be exported in Prometheus text format.
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logger
+
+_LOGGER = logger.get_logger(__name__)
+
+# Number of latest durations used to compute percentiles
+WINDOW = int(os.environ.get('STATS_WINDOW', 1024))
+# Port of the Prometheus text endpoint, disabled if not set
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+
+class Histogram:
+    """Rolling window of durations of one operation"""
+
+    def __init__(self, window=WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def add(self, duration, error=False):
+        with self._lock:
+            self._samples.append(duration)
+            self.count += 1
+            self.total += duration
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        """
+        :returns dict with keys: count, errors, total (seconds),
+        p50, p95, p99 (seconds, over the rolling window)
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+            snap = {'count': self.count, 'errors': self.errors,
+                    'total': self.total}
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            snap[name] = (samples[min(int(len(samples) * fraction),
+                                      len(samples) - 1)]
+                          if samples else None)
+        return snap
+
+
+class Registry:
+    """Histograms of timed operations and sources of other counters"""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._histograms = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+        # Labels of the process, e.g. shard number in the sharded mode
+        self.labels = {}
+
+    def set_labels(self, **labels):
+        """
+        Label all metrics of the process, so metrics of several processes
+        can be told apart and aggregated
+        """
+        self.labels = {key: str(value) for key, value in labels.items()}
+
+    def histogram(self, name):
+        hist = self._histograms.get(name)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(name,
+                                                   Histogram(self.window))
+        return hist
+
+    def observe(self, name, duration, error=False):
+        self.histogram(name).add(duration, error)
+
+    def add_source(self, name, func):
+        """
+        Register function returning dict of counters, e.g. pool stats
+        Numeric values are exported along with the histograms
+        """
+        with self._lock:
+            self._sources[name] = func
+
+    def snapshot(self):
+        """:returns (dict of histogram snapshots, dict of source stats)"""
+        with self._lock:
+            histograms = dict(self._histograms)
+            sources = dict(self._sources)
+        ops = {name: hist.snapshot() for name, hist in histograms.items()}
+        stats = {}
+        for name, func in sources.items():
+            try:
+                stats[name] = func()
+            except Exception:
+                _LOGGER.exception(f'Unable to collect {name} stats')
+        return ops, stats
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+REGISTRY = Registry()
+
+
+def _op_name(func):
+    module = func.__module__.rsplit('.', 1)[-1]
+    return f'{module}.{func.__qualname__}'
+
+
+def timed(func=None, name=None, registry=REGISTRY):
+    """
+    Decorator which records duration of every call
+    Calls ended with an exception are counted as errors
+    Usage: @timed or @timed(name='operation')
+    """
+    if func is None:
+        return functools.partial(timed, name=name, registry=registry)
+    op_name = name or _op_name(func)
+    if inspect.isgeneratorfunction(func):
+        return _timed_generator(func, op_name, registry)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            registry.observe(op_name, time.perf_counter() - start, error)
+    return wrapper
+
+
+def _timed_generator(func, op_name, registry):
+    """
+    Generator is timed over its whole iteration,
+    time spent by the caller between items is not counted
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        items = func(*args, **kwargs)
+        elapsed = 0.0
+        error = True
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    error = False
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        except GeneratorExit:  # Caller stopped the iteration
+            error = False
+            raise
+        finally:
+            items.close()
+            registry.observe(op_name, elapsed, error)
+    return wrapper
+
+
+def timed_methods(prefix, registry=REGISTRY):
+    """Class decorator timing all public methods as '<prefix>.<method>'"""
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith('_') or not callable(value):
+                continue
+            setattr(cls, attr, timed(value, name=f'{prefix}.{attr}',
+                                     registry=registry))
+        return cls
+    return decorate
+
+
+def instrument_bot(bot, registry=REGISTRY):
+    """
+    Time every Bot API request made by the bot
+    Operations are named after API methods, e.g. 'telegram.sendMessage'
+    """
+    request = bot.request
+
+    def wrap(method):
+        @functools.wraps(method)
+        def wrapper(url, *args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = method(url, *args, **kwargs)
+                error = False
+                return result
+            finally:
+                registry.observe('telegram.' + url.rsplit('/', 1)[-1],
+                                 time.perf_counter() - start, error)
+        return wrapper
+
+    request.post = wrap(request.post)
+    request.get = wrap(request.get)
+
+
+def _fmt_ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+def render_text(registry=REGISTRY, limit=30):
+    """
+    Human readable report, operations with the largest total time first
+    :returns str
+    """
+    ops, stats = registry.snapshot()
+    lines = []
+    if registry.labels:
+        process = ', '.join(f'{key}={value}'
+                            for key, value in registry.labels.items())
+        lines.append(f'process: {process} (other processes not included)')
+    lines.append(f'{"operation":<32} {"count":>7} {"err":>4} '
+                 f'{"p50":>5} {"p95":>5} {"p99":>5}')
+    top = sorted(ops.items(), key=lambda item: -item[1]['total'])[:limit]
+    for name, snap in top:
+        lines.append(f'{name[:32]:<32} {snap["count"]:>7} '
+                     f'{snap["errors"]:>4} {_fmt_ms(snap["p50"]):>5} '
+                     f'{_fmt_ms(snap["p95"]):>5} {_fmt_ms(snap["p99"]):>5}')
+    if len(ops) > limit:
+        lines.append(f'... {len(ops) - limit} more')
+    for name, values in sorted(stats.items()):
+        counters = ', '.join(f'{key}={value}'
+                             for key, value in values.items())
+        lines.append(f'{name}: {counters}')
+    return '\n'.join(lines)
+
+
+def _label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"')
+
+
+def render_prometheus(registry=REGISTRY, prefix='taskbot'):
+    """:returns metrics in Prometheus text exposition format"""
+    ops, stats = registry.snapshot()
+    process = ''.join(f',{key}="{_label(value)}"'
+                      for key, value in registry.labels.items())
+    lines = [f'# TYPE {prefix}_latency_seconds summary']
+    for name, snap in sorted(ops.items()):
+        label = f'op="{_label(name)}"{process}'
+        for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'),
+                              ('0.99', 'p99')):
+            value = snap[key]
+            if value is not None:
+                lines.append(f'{prefix}_latency_seconds'
+                             f'{{{label},quantile="{quantile}"}} {value}')
+        lines.append(f'{prefix}_latency_seconds_sum{{{label}}} '
+                     f'{snap["total"]}')
+        lines.append(f'{prefix}_latency_seconds_count{{{label}}} '
+                     f'{snap["count"]}')
+    lines.append(f'# TYPE {prefix}_errors_total counter')
+    for name, snap in sorted(ops.items()):
+        lines.append(f'{prefix}_errors_total{{op="{_label(name)}"{process}}} '
+                     f'{snap["errors"]}')
+    process = f'{{{process[1:]}}}' if process else ''
+    for source, values in sorted(stats.items()):
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'{prefix}_{source}_{key}{process} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus(self.registry).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port, registry=REGISTRY):
+    """
+    Serve /metrics endpoint on the background thread
+    :returns HTTP server, call shutdown() to stop it
+    """
+    handler = type('MetricsHandler', (_MetricsHandler, ),
+                   {'registry': registry})
+    server = ThreadingHTTPServer(('0.0.0.0', int(port)), handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics', daemon=True)
+    thread.start()
+    _LOGGER.info(f'Serving metrics on port {port}')
+    return server
@@ -1,10 +1,17 @@
+import sys
+
 import bot_handler
+from bot_handler import sharding
 
 
 def main():
     """Launch the bot."""
-    bot = bot_handler.BotHandler()
-    bot.start()
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    if sharding.SHARDS > 1:
+        bot = bot_handler.ShardedBotHandler(sharding.SHARDS)
+    else:
+        bot = bot_handler.BotHandler()
+    bot.start(port)
 
 
 if __name__ == '__main__':
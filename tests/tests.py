@@ -1,8 +1,23 @@
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
 from datetime import datetime, timezone
 from unittest import TestCase, main
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+
+from telegram import Message, Update
+from telegram.ext import Dispatcher, TypeHandler
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 
 import db_connector
+import instrumentation
+from db_connector import rows
+from bot_handler import (admins, bot_handler, delivery, dispatching,
+                         persistence, pruning, reminders, resolver, response,
+                         scheduler, sharding)
 
 
 class TaskCreateDestroyTest(TestCase):
@@ -36,6 +51,54 @@ class TaskCreateDestroyTest(TestCase):
         with self.assertRaises(ValueError):
             self.db.add_task(chat_id, user_id, task_text)
 
+    def test_tasks_bulk_add(self):
+        chat_id = 1
+        user_id = 1
+        task_texts = [f'Test task {ind}' for ind in range(3)]
+        task_ids = self.db.add_tasks(chat_id, user_id, task_texts)
+        self.assertEqual(3, len(task_ids))
+        for task_id, task_text in zip(task_ids, task_texts):
+            self.assertEqual(task_text, self.db.task_info(task_id)['task_text'])
+            self.assertTrue(self.db.close_task(task_id, chat_id, user_id))
+
+    def test_tasks_bulk_add_invalid_text(self):
+        with self.assertRaises(ValueError):
+            self.db.add_tasks(1, 1, ['Test task', None])
+
+    def test_tasks_bulk_close(self):
+        chat_id = 1
+        user_id = 1
+        own_ids = self.db.add_tasks(chat_id, user_id, ['Test 1', 'Test 2'])
+        other_id = self.db.add_task(chat_id, user_id + 1, 'Test task',
+                                    workers=[user_id + 1])
+        results = self.db.close_tasks(own_ids + [other_id, 0], chat_id,
+                                      user_id)
+        self.assertEqual({own_ids[0]: True, own_ids[1]: True,
+                          other_id: False, 0: False}, results)
+        self.assertEqual({other_id: True}, self.db.close_tasks(
+            [other_id], chat_id, user_id, admin=True))
+
+    def test_tasks_bulk_take(self):
+        chat_id = 1
+        user_id = 1
+        task_ids = self.db.add_tasks(chat_id, user_id, ['Test 1', 'Test 2'])
+        self.assertTrue(self.db.assign_task(task_ids[1], chat_id, user_id + 1,
+                                            [user_id + 1]))
+        results = self.db.assign_tasks(task_ids, chat_id, user_id, [user_id])
+        self.assertEqual({task_ids[0]: True, task_ids[1]: False}, results)
+        self.assertEqual([user_id], self.db.task_info(task_ids[0])['workers'])
+        self.db.close_tasks(task_ids, chat_id, user_id, admin=True)
+
+    def test_prune_workers(self):
+        chat_id = 1
+        user_id = 1
+        task_id = self.db.add_task(chat_id, user_id, 'Test task',
+                                   workers=[user_id + 1, user_id + 2])
+        self.assertEqual(1, self.db.prune_workers([(chat_id, user_id + 1),
+                                                   (chat_id + 1, user_id)]))
+        self.assertEqual([user_id + 2], self.db.task_info(task_id)['workers'])
+        self.db.close_task(task_id, chat_id, user_id)
+
     def test_task_close_base(self):
         chat_id = 1
         user_id = 1
@@ -160,6 +223,26 @@ class TaskModifyTest(TestCase):
         info = self.db.task_info(self.task_id)
         self.assertFalse(info['marked'])
 
+    def test_toggle_marked(self):
+        marked = self.db.task_info(self.task_id)['marked']
+        self.assertEqual(not marked, self.db.toggle_marked(
+            self.task_id, self.chat_id, self.user_id))
+        self.assertEqual(marked, self.db.toggle_marked(
+            self.task_id, self.chat_id, self.user_id))
+
+    def test_toggle_marked_wrong_chat(self):
+        self.assertIsNone(self.db.toggle_marked(
+            self.task_id, self.chat_id + 1, self.user_id))
+
+    def test_task_access(self):
+        info = self.db.task_access(self.task_id, self.user_id)
+        self.assertTrue(info['is_creator'])
+        self.assertTrue(info['can_set_deadline'])
+        info = self.db.task_access(self.task_id, self.user_id + 1)
+        self.assertFalse(info['is_creator'])
+        self.assertFalse(info['is_worker'])
+        self.assertEqual(info['is_vacant'], info['can_close'])
+
     def test_marked_status_invalid(self):
         with self.assertRaises(ValueError):
             self.db.set_marked_status(self.task_id, self.chat_id, self.user_id,
@@ -170,5 +253,946 @@ class TaskModifyTest(TestCase):
         cls.db.close_task(cls.task_id, cls.chat_id, cls.user_id)
 
 
+class TaskPageTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = db_connector.DataBaseConnector()
+        cls.db._log = MagicMock()
+        cls.chat_id = 2
+        cls.user_id = 1
+        now = datetime.now(timezone.utc)
+        cls.task_ids = []
+        for ind in range(5):
+            deadline = now.replace(microsecond=ind) if ind % 2 else None
+            cls.task_ids.append(cls.db.add_task(
+                cls.chat_id, cls.user_id, 'Test task', marked=ind == 3,
+                deadline=deadline))
+
+    def setUp(self):
+        self.db._cache.clear()
+
+    def _pages(self, limit):
+        pages = []
+        after = None
+        while True:
+            rows = self.db.get_tasks_page(self.chat_id, after, limit)
+            if not rows:
+                return pages
+            pages.append([row['id'] for row in rows])
+            after = db_connector.task_cursor(rows[-1])
+
+    def test_pages_sorted(self):
+        rows = sorted(self.db.get_tasks(self.chat_id),
+                      key=db_connector.task_sort_key)
+        pages = self._pages(limit=2)
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        self.assertEqual([row['id'] for row in rows],
+                         [t_id for page in pages for t_id in page])
+
+    def test_cached_pages_match(self):
+        pages = self._pages(limit=2)
+        self.db.get_tasks(self.chat_id)  # Fill the cache
+        self.assertEqual(pages, self._pages(limit=2))
+
+    @classmethod
+    def tearDownClass(cls):
+        for task_id in cls.task_ids:
+            cls.db.close_task(task_id, cls.chat_id, cls.user_id)
+
+
+class BulkParseTest(TestCase):
+    def test_checklist_split(self):
+        text = '- Buy milk\n* Call Bob\n\n1. Send report\n[x] Fix bug'
+        self.assertEqual(['Buy milk', 'Call Bob', 'Send report', 'Fix bug'],
+                         response._split_tasks(text))
+
+    def test_plain_lines_kept(self):
+        text = 'Prepare release\nsee notes in the wiki'
+        self.assertEqual([text], response._split_tasks(text))
+
+    def test_partly_marked_kept(self):
+        text = 'Plan:\n- step one\n- step two'
+        self.assertEqual([text], response._split_tasks(text))
+
+    def test_single_item_kept(self):
+        self.assertEqual(['- one'], response._split_tasks(' - one '))
+
+    def test_ids_parsed(self):
+        self.assertEqual([12, 13, 5, 6, 7],
+                         response._parse_ids(['12,13', '5-7', '12']))
+
+    def test_invalid_ids(self):
+        self.assertIsNone(response._parse_ids(['12', 'abc']))
+        self.assertIsNone(response._parse_ids(['9-5']))
+        self.assertIsNone(response._parse_ids(['1-1000']))
+        self.assertEqual([], response._parse_ids([]))
+
+
+class TaskSearchTest(TestCase):
+    def setUp(self):
+        self.db = db_connector.DataBaseConnector()
+        self.db._log = MagicMock()
+        self.chat_id = 4
+        self.user_id = 1
+        self.task_ids = self.db.add_tasks(
+            self.chat_id, self.user_id,
+            ['Купить молоко', 'Позвонить маме', 'Купить молоко и хлеб'])
+
+    def test_search_stemmed(self):
+        rows = self.db.search_tasks(self.chat_id, 'молока')
+        self.assertEqual({self.task_ids[0], self.task_ids[2]},
+                         {row['id'] for row in rows})
+
+    def test_search_other_chat(self):
+        self.assertFalse(self.db.search_tasks(self.chat_id + 1, 'маме'))
+
+    def test_search_limit(self):
+        self.assertEqual(1, len(self.db.search_tasks(self.chat_id, 'купить',
+                                                     limit=1)))
+
+    def test_closed_not_found(self):
+        self.db.close_task(self.task_ids[1], self.chat_id, self.user_id)
+        self.assertFalse(self.db.search_tasks(self.chat_id, 'маме'))
+
+    def tearDown(self):
+        self.db.close_tasks(self.task_ids, self.chat_id, self.user_id)
+
+
+class ReminderStreamTest(TestCase):
+    def setUp(self):
+        self.db = db_connector.DataBaseConnector()
+        self.db._log = MagicMock()
+        self.task_id = self.db.add_task(1, 1, 'Test task')
+        past = datetime.now(timezone.utc).replace(year=2000)
+        self.rem_ids = [self.db.create_reminder(self.task_id, 1, past)
+                        for _ in range(3)]
+
+    def test_batches(self):
+        batches = list(self.db.iter_overdue_reminders(batch_size=2))
+        self.assertTrue(all(0 < len(batch) <= 2 for batch in batches))
+        streamed = [rem['id'] for batch in batches for rem in batch]
+        self.assertEqual(len(set(streamed)), len(streamed))
+        self.assertTrue(set(self.rem_ids) <= set(streamed))
+
+    def test_connection_released(self):
+        idle = self.db.pool_stats()['idle']
+        stream = self.db.iter_overdue_reminders(batch_size=1)
+        next(stream)
+        # Batch is processed without holding a pooled connection
+        self.assertEqual(idle, self.db.pool_stats()['idle'])
+        stream.close()
+
+    def test_closed_not_fetched_again(self):
+        stream = self.db.iter_overdue_reminders(batch_size=1)
+        first = next(stream)[0]['id']
+        self.db.close_reminders([first])
+        streamed = [rem['id'] for batch in stream for rem in batch]
+        self.assertNotIn(first, streamed)
+        self.assertTrue(set(self.rem_ids) - {first} <= set(streamed))
+
+    def tearDown(self):
+        self.db.close_reminders(self.rem_ids)
+        self.db.close_task(self.task_id, 1, 1)
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.db = db_connector.DataBaseConnector()
+        self.db._log = MagicMock()
+
+    def test_connection_reused(self):
+        before = self.db.pool_stats()
+        self.db.get_tasks(1)
+        self.db.get_tasks(1)
+        after = self.db.pool_stats()
+        self.assertEqual(before['checkouts'] + 2, after['checkouts'])
+        self.assertLessEqual(after['size'], self.db._pool.max_size)
+
+    def test_reconnect_on_broken_connection(self):
+        conn = self.db._pool.getconn()
+        self.db._pool.putconn(conn)
+        conn.close()  # Simulate connection dropped by the server
+        before = self.db.pool_stats()
+        self.assertIsInstance(self.db.get_tasks(1), list)
+        after = self.db.pool_stats()
+        self.assertEqual(before['reconnects'] + 1, after['reconnects'])
+
+
+class MigrationsTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = db_connector.DataBaseConnector()
+        cls.db._log = MagicMock()
+        cls.db.apply_migrations()
+
+    def setUp(self):
+        self.db._cache.clear()
+
+    def _plan(self, method, *args):
+        """Get plan of the query made by connector method"""
+        queries = []
+        with patch.object(self.db, '_fetch_success',
+                          side_effect=lambda *q: queries.append(q) or []):
+            method(*args)
+        sql_str, sql_val = queries[0]
+        with self.db._pool.connection() as conn:
+            with conn.cursor() as cur:
+                # Tables are small, force planner to consider indexes
+                cur.execute('SET enable_seqscan = off')
+                cur.execute('EXPLAIN ' + sql_str, sql_val)
+                return '\n'.join(row[0] for row in cur.fetchall())
+
+    def test_migrations_idempotent(self):
+        self.assertEqual([], self.db.apply_migrations())
+
+    def test_chat_tasks_use_index(self):
+        plan = self._plan(self.db.get_tasks, 1)
+        self.assertIn('tasks_open_chat_idx', plan)
+
+    def test_chat_tasks_page_use_index(self):
+        plan = self._plan(self.db.get_tasks_page, 1, (False, None, 1))
+        self.assertIn('tasks_open_chat_order_idx', plan)
+
+    def test_user_tasks_use_index(self):
+        plan = self._plan(self.db.get_user_tasks, 1)
+        self.assertIn('tasks_open_workers_idx', plan)
+
+    def test_overdue_reminders_use_index(self):
+        plan = self._plan(self.db.get_overdue_reminders)
+        self.assertIn('reminders_pending_idx', plan)
+
+
+class RowTest(TestCase):
+    def setUp(self):
+        cls = rows.row_class(('id', 'task_text', 'workers'))
+        self.row = cls(1, 'Test task', [1])
+
+    def test_access(self):
+        self.assertEqual(1, self.row['id'])
+        self.assertEqual('Test task', self.row.task_text)
+        self.assertIn('workers', self.row)
+        self.assertNotIn('chat_id', self.row)
+        self.assertIsNone(self.row.get('chat_id'))
+        self.assertRaises(KeyError, lambda: self.row['chat_id'])
+        self.assertEqual({'id': 1, 'task_text': 'Test task', 'workers': [1]},
+                         dict(self.row))
+
+    def test_update(self):
+        copy = self.row.copy()
+        copy['task_text'] = 'New text'
+        copy.update(workers=[])
+        self.assertEqual('Test task', self.row['task_text'])
+        self.assertEqual([], copy.workers)
+        with self.assertRaises(KeyError):
+            copy['chat_id'] = 1
+
+    def test_pickle(self):
+        self.assertEqual(self.row, pickle.loads(pickle.dumps(self.row)))
+
+
+class TaskCacheTest(TestCase):
+    def setUp(self):
+        self.cache = db_connector.cache.TaskCache(max_chats=2, max_users=2)
+        self.row = {'id': 1, 'creator_id': 1, 'task_text': 'Test task',
+                    'marked': False, 'deadline': None, 'workers': []}
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(self.cache.get_chat(1))
+        self.cache.put_chat(1, [self.row], self.cache.epoch())
+        self.assertEqual([self.row], self.cache.get_chat(1))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_patched_by_writes(self):
+        self.cache.put_chat(1, [self.row], self.cache.epoch())
+        self.cache.task_updated(1, 1, marked=True)
+        self.assertTrue(self.cache.get_chat(1)[0]['marked'])
+        self.cache.task_updated(1, 1, workers=[2])
+        self.assertEqual([2], self.cache.get_chat(1)[0]['workers'])
+        self.cache.worker_removed(1, 1, 2)
+        self.assertEqual([], self.cache.get_chat(1)[0]['workers'])
+        self.cache.task_closed(1, 1)
+        self.assertEqual([], self.cache.get_chat(1))
+
+    def test_outdated_result_not_stored(self):
+        epoch = self.cache.epoch()
+        self.cache.task_closed(1, 1)
+        self.cache.put_chat(1, [self.row], epoch)
+        self.assertIsNone(self.cache.get_chat(1))
+
+    def test_worker_index_invalidation(self):
+        row = dict(self.row, chat_id=1, workers=[2])
+        self.cache.put_user(2, [row], self.cache.epoch())
+        self.cache.task_updated(1, 1, deadline=datetime.now(timezone.utc))
+        self.assertIsNotNone(self.cache.get_user(2)[0]['deadline'])
+        self.cache.task_closed(1, 1)
+        self.assertIsNone(self.cache.get_user(2))
+
+    def test_lru_eviction(self):
+        for chat_id in (1, 2, 3):
+            self.cache.put_chat(chat_id, [], self.cache.epoch())
+        self.assertIsNone(self.cache.get_chat(1))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_changes_forwarded(self):
+        other = db_connector.cache.TaskCache(max_chats=2, max_users=2)
+        other.put_chat(1, [self.row], other.epoch())
+        other.put_user(2, [dict(self.row, chat_id=1)], other.epoch())
+        changes = []
+        self.cache.forward(lambda *change: changes.append(
+            pickle.loads(pickle.dumps(change))))
+        self.cache.task_updated(1, 1, marked=True)
+        self.cache.task_closed(1, 1)
+        self.assertEqual(['task_updated', 'task_closed'],
+                         [change[0] for change in changes])
+        other.apply(*changes[0])
+        self.assertTrue(other.get_chat(1)[0]['marked'])
+        other.apply(*changes[1])
+        self.assertEqual([], other.get_chat(1))
+        self.assertIsNone(other.get_user(2))
+        with self.assertRaises(ValueError):
+            other.apply('clear', (), {})
+
+    def test_applied_change_not_forwarded(self):
+        changes = []
+        self.cache.forward(lambda *change: changes.append(change))
+        self.cache.apply('task_closed', (1, 1), {})
+        self.assertEqual([], changes)
+
+
+class SQLitePersistenceTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, 'states.sqlite')
+        self.states = persistence.SQLitePersistence(self.fname)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_states_restored(self):
+        self.states.update_chat_data(1, {'page ind': 1})
+        self.states.update_user_data(2, {'task id': 3})
+        self.states.update_conversation('handler', (1, 2), 0)
+        restored = persistence.SQLitePersistence(self.fname)
+        self.assertEqual({'page ind': 1}, restored.get_chat_data()[1])
+        self.assertEqual({'task id': 3}, restored.get_user_data()[2])
+        self.assertEqual({(1, 2): 0}, restored.get_conversations('handler'))
+
+    def test_finished_conversation_removed(self):
+        self.states.update_conversation('handler', (1, 2), 0)
+        self.states.update_conversation('handler', (1, 2), None)
+        restored = persistence.SQLitePersistence(self.fname)
+        self.assertEqual({}, restored.get_conversations('handler'))
+        self.assertTrue(restored.is_empty())
+
+
+class KeyedExecutorTest(TestCase):
+    def test_order_within_key(self):
+        executor = dispatching.KeyedExecutor(workers=4)
+        done = {}
+        lock = threading.Lock()
+        finished = threading.Event()
+
+        def task(key, ind):
+            time.sleep(0.001)
+            with lock:
+                done.setdefault(key, []).append(ind)
+                if sum(map(len, done.values())) == 100:
+                    finished.set()
+
+        for ind in range(100):
+            key = ind % 3
+            executor.submit([('chat', key)], task, key, ind)
+        self.assertTrue(finished.wait(10))
+        executor.shutdown()
+        for key, order in done.items():
+            self.assertEqual(sorted(order), order)
+        self.assertEqual(100, executor.stats()['done'])
+
+
+class ShardingTest(TestCase):
+    def _update(self, chat_id, user_id=1):
+        update = MagicMock(update_id=1)
+        update.effective_chat.id = chat_id
+        update.effective_user.id = user_id
+        return update
+
+    def test_chat_on_one_shard(self):
+        shards = {sharding.shard_of(self._update(-100, user_id), 4)
+                  for user_id in range(10)}
+        self.assertEqual(1, len(shards))
+        self.assertEqual(4, len({sharding.shard_of(self._update(chat_id), 4)
+                                 for chat_id in range(-8, 0)}))
+
+    def test_scheduler_forwarded(self):
+        changes = []
+        sched = scheduler.ReminderScheduler()
+        sched.forward(lambda *change: changes.append(change))
+        now = datetime.now(timezone.utc)
+        sched.add(1, now)
+        sched.remove([1])
+        self.assertEqual([('add', 1, now), ('remove', [1])], changes)
+        self.assertEqual(0, len(sched))
+
+
+def _update_dict(update_id, chat_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'group'},
+                        'from': {'id': 1, 'is_bot': False,
+                                 'first_name': 'Name'},
+                        'text': 'Test task'}}
+
+
+class ShardRouterTest(TestCase):
+    def setUp(self):
+        self.dispatcher = MagicMock()
+        self.inboxes = [queue.Queue(1), queue.Queue(1)]
+        self.router = sharding.ShardRouter(self.dispatcher, self.inboxes,
+                                           timeout=0.01)
+
+    def test_routed_by_chat(self):
+        self.dispatcher.process_update(
+            Update.de_json(_update_dict(1, -3), None))
+        kind, data = self.inboxes[1].get_nowait()
+        self.assertEqual('update', kind)
+        self.assertEqual(-3, data['message']['chat']['id'])
+        self.assertTrue(self.inboxes[0].empty())
+
+    def test_full_inbox_dropped(self):
+        for update_id in range(3):
+            self.dispatcher.process_update(
+                Update.de_json(_update_dict(update_id, -3), None))
+        self.dispatcher.process_update(
+            Update.de_json(_update_dict(4, -2), None))
+        self.assertEqual({'shard_0': 1, 'shard_1': 1, 'dropped': 2},
+                         self.router.stats())
+
+
+class _FakeProcess:
+    def __init__(self, target, args, name, hangs=False):
+        self.exitcode = None
+        self.terminated = False
+        self.hangs = hangs
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def join(self, timeout=None):
+        if not self.hangs:
+            self.exitcode = 0
+
+    def terminate(self):
+        self.terminated = True
+        self.exitcode = -15
+
+
+class ShardWorkersTest(TestCase):
+    def setUp(self):
+        self.processes = []
+        self.hangs = False
+        context = MagicMock()
+        context.Process.side_effect = self._process
+        self.inboxes = [queue.Queue(1), queue.Queue(1)]
+        self.workers = sharding.ShardWorkers(context, self.inboxes,
+                                             interval=60)
+
+    def _process(self, **kwargs):
+        process = _FakeProcess(hangs=self.hangs, **kwargs)
+        self.processes.append(process)
+        return process
+
+    def test_exited_restarted(self):
+        self.workers.start()
+        self.processes[1].exitcode = 1
+        self.workers.check()
+        self.assertEqual(3, len(self.processes))
+        self.assertEqual({'restarts': 1, 'alive': 2}, self.workers.stats())
+        self.workers.stop(timeout=0.01)
+
+    def test_stop(self):
+        self.hangs = True
+        self.workers.start()
+        self.inboxes[0].put('update')  # Inbox is full
+        self.workers.stop(timeout=0.01)
+        self.assertIsNone(self.inboxes[1].get_nowait())
+        self.assertTrue(all(process.terminated
+                            for process in self.processes))
+        self.workers.check()  # Stopped workers are not restarted
+        self.assertEqual(2, len(self.processes))
+
+
+class ServeShardTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, 'states-1.sqlite')
+        self.bot = bot_handler.BotHandler.__new__(bot_handler.BotHandler)
+        self.bot.log = MagicMock()
+        self.bot.shard = 1
+        self.bot.dispatching = None
+        self.bot.updater = MagicMock()
+        self.bot.dp = Dispatcher(
+            MagicMock(), queue.Queue(), workers=1, use_context=True,
+            persistence=persistence.SQLitePersistence(self.fname))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_processed_before_stop(self):
+        processed = []
+
+        def handle(update, context):
+            processed.append(update.update_id)
+            context.chat_data['seen'] = True
+
+        self.bot.dp.add_handler(TypeHandler(Update, handle))
+        inbox = queue.Queue()
+        for update_id in range(1, 4):
+            inbox.put(('update', _update_dict(update_id, -1)))
+        inbox.put(('unknown', None))
+        inbox.put(None)
+        self.bot.serve_shard(inbox)
+        self.assertEqual([1, 2, 3], processed)
+        self.bot.updater.job_queue.stop.assert_called_once()
+        restored = persistence.SQLitePersistence(self.fname)
+        self.assertEqual({'seen': True}, restored.get_chat_data()[-1])
+
+    @patch('db_connector.cache.get_cache')
+    def test_cache_change_applied(self, get_cache):
+        inbox = queue.Queue()
+        inbox.put(('cache', ('task_closed', (1, -1), {})))
+        inbox.put(None)
+        self.bot.serve_shard(inbox)
+        get_cache.return_value.apply.assert_called_once_with(
+            'task_closed', (1, -1), {})
+
+
+class WebhookTest(TestCase):
+    def setUp(self):
+        self.updater = MagicMock()
+
+    @patch.dict(os.environ, {'BOT_TOKEN': 'token', 'PORT': '5000',
+                             'WEBHOOK_URL': 'https://bot.example/'})
+    def test_webhook_registered(self):
+        os.environ.pop('WEBHOOK_SECRET', None)
+        self.assertEqual(5000, bot_handler._receive_updates(self.updater))
+        secret = self.updater.start_webhook.call_args[1]['url_path']
+        self.assertEqual(64, len(secret))
+        self.updater.start_webhook.assert_called_once_with(
+            listen='0.0.0.0', port=5000, url_path=secret)
+        self.updater.bot.set_webhook.assert_called_once_with(
+            url=f'https://bot.example/{secret}')
+        self.updater.start_polling.assert_not_called()
+
+    @patch.dict(os.environ, {'BOT_TOKEN': 'token', 'WEBHOOK_SECRET': 'path',
+                             'WEBHOOK_URL': 'https://bot.example'})
+    def test_port_and_secret_given(self):
+        self.assertEqual(80, bot_handler._receive_updates(self.updater, 80))
+        self.updater.start_webhook.assert_called_once_with(
+            listen='0.0.0.0', port=80, url_path='path')
+        self.updater.bot.set_webhook.assert_called_once_with(
+            url='https://bot.example/path')
+
+    @patch.dict(os.environ, {'BOT_TOKEN': 'token'})
+    def test_polling_without_url(self):
+        os.environ.pop('WEBHOOK_URL', None)
+        self.assertIsNone(bot_handler._receive_updates(self.updater, 80))
+        self.updater.start_polling.assert_called_once_with()
+        self.updater.start_webhook.assert_not_called()
+
+
+class ResolverTest(TestCase):
+    def setUp(self):
+        self.bot = MagicMock()
+        self.bot.get_chat_member.side_effect = lambda chat_id, user_id: (
+            f'member {user_id}')
+        self.bot.get_chat.side_effect = lambda chat_id: f'chat {chat_id}'
+        self.resolver = resolver.Resolver(max_workers=2, ttl=300, neg_ttl=60)
+
+    def test_batch_deduplicated(self):
+        members, chats = self.resolver.resolve(
+            self.bot, -1, member_ids=[1, 2, 1], chat_ids=[-1, -2, -1])
+        self.assertEqual({1: 'member 1', 2: 'member 2'}, members)
+        self.assertEqual({-1: 'chat -1', -2: 'chat -2'}, chats)
+        self.assertEqual(2, self.bot.get_chat_member.call_count)
+        self.assertEqual(2, self.bot.get_chat.call_count)
+
+    def test_cached(self):
+        self.resolver.resolve(self.bot, -1, member_ids=[1], chat_ids=[-1])
+        members, chats = self.resolver.resolve(self.bot, -1, member_ids=[1],
+                                               chat_ids=[-1])
+        self.assertEqual({1: 'member 1'}, members)
+        self.assertEqual({-1: 'chat -1'}, chats)
+        self.bot.get_chat_member.assert_called_once_with(-1, 1)
+        self.bot.get_chat.assert_called_once_with(-1)
+
+    @patch('bot_handler.resolver.time')
+    def test_expired(self, clock):
+        clock.monotonic.return_value = 0
+        self.resolver.resolve(self.bot, -1, member_ids=[1])
+        clock.monotonic.return_value = 301
+        self.resolver.resolve(self.bot, -1, member_ids=[1])
+        self.assertEqual(2, self.bot.get_chat_member.call_count)
+
+    @patch('bot_handler.resolver.time')
+    def test_missing_cached_shorter(self, clock):
+        clock.monotonic.return_value = 0
+        self.bot.get_chat_member.side_effect = BadRequest('User not found')
+        members, _ = self.resolver.resolve(self.bot, -1, member_ids=[1])
+        self.assertEqual({1: None}, members)
+        clock.monotonic.return_value = 30
+        self.resolver.resolve(self.bot, -1, member_ids=[1])
+        self.assertEqual(1, self.bot.get_chat_member.call_count)
+        clock.monotonic.return_value = 61
+        self.resolver.resolve(self.bot, -1, member_ids=[1])
+        self.assertEqual(2, self.bot.get_chat_member.call_count)
+
+    def test_network_error_not_cached(self):
+        self.bot.get_chat.side_effect = NetworkError('Timed out')
+        _, chats = self.resolver.resolve(self.bot, chat_ids=[-1])
+        self.assertEqual({}, chats)
+        self.resolver.resolve(self.bot, chat_ids=[-1])
+        self.assertEqual(2, self.bot.get_chat.call_count)
+
+    def test_forget_member(self):
+        self.resolver.resolve(self.bot, -1, member_ids=[1])
+        self.resolver.forget_member(-1, 1)
+        self.resolver.resolve(self.bot, -1, member_ids=[1])
+        self.assertEqual(2, self.bot.get_chat_member.call_count)
+
+
+class AdminCacheTest(TestCase):
+    def setUp(self):
+        self.bot = MagicMock()
+        self.bot.get_chat_administrators.return_value = [
+            MagicMock(user=MagicMock(id=1)), MagicMock(user=MagicMock(id=2))]
+        self.admins = admins.AdminCache(ttl=600)
+
+    def test_cached(self):
+        self.assertTrue(self.admins.is_admin(self.bot, -1, 1))
+        self.assertFalse(self.admins.is_admin(self.bot, -1, 3))
+        self.bot.get_chat_administrators.assert_called_once_with(-1)
+
+    @patch('bot_handler.admins.time')
+    def test_expired(self, clock):
+        clock.monotonic.return_value = 0
+        self.admins.get_admin_ids(self.bot, -1)
+        clock.monotonic.return_value = 599
+        self.admins.get_admin_ids(self.bot, -1)
+        self.assertEqual(1, self.bot.get_chat_administrators.call_count)
+        clock.monotonic.return_value = 601
+        self.admins.get_admin_ids(self.bot, -1)
+        self.assertEqual(2, self.bot.get_chat_administrators.call_count)
+
+    def test_invalidated(self):
+        self.admins.get_admin_ids(self.bot, -1)
+        self.bot.get_chat_administrators.return_value = [
+            MagicMock(user=MagicMock(id=3))]
+        admins.ADMINS, saved = self.admins, admins.ADMINS
+        try:
+            admins.refresh_admins(MagicMock(effective_chat=MagicMock(id=-1)),
+                                  MagicMock())
+        finally:
+            admins.ADMINS = saved
+        self.assertEqual(frozenset({3}),
+                         self.admins.get_admin_ids(self.bot, -1))
+
+    def test_private_chat(self):
+        self.assertEqual(frozenset(), self.admins.get_admin_ids(self.bot, 1))
+        self.bot.get_chat_administrators.assert_not_called()
+
+    def test_error_not_cached(self):
+        self.bot.get_chat_administrators.side_effect = TimedOut()
+        self.assertEqual(frozenset(), self.admins.get_admin_ids(self.bot, -1))
+        self.bot.get_chat_administrators.side_effect = None
+        self.assertTrue(self.admins.is_admin(self.bot, -1, 1))
+        self.assertEqual(2, self.bot.get_chat_administrators.call_count)
+
+
+class WorkerPrunerTest(TestCase):
+    def setUp(self):
+        self.pruner = pruning.WorkerPruner(batch=2)
+
+    @patch('db_connector.DataBaseConnector')
+    def test_batches(self, connector):
+        connector.return_value.prune_workers.return_value = 1
+        for user_id in (1, 2, 2, 3):
+            self.pruner.report(-1, user_id)
+        self.assertEqual(1, self.pruner.run())
+        self.assertEqual(1, self.pruner.run())
+        self.assertEqual(0, self.pruner.run())
+        members = [member for call in
+                   connector.return_value.prune_workers.call_args_list
+                   for member in call[0][0]]
+        self.assertEqual([(-1, 1), (-1, 2), (-1, 3)], sorted(members))
+
+    @patch('db_connector.DataBaseConnector')
+    def test_failed_run_retried(self, connector):
+        connector.return_value.prune_workers.side_effect = ConnectionError
+        self.pruner.report(-1, 1)
+        self.assertEqual(0, self.pruner.run())
+        self.assertEqual(1, self.pruner.stats()['queued'])
+
+
+class TokenBucketTest(TestCase):
+    def test_rate_limited(self):
+        bucket = delivery.TokenBucket(rate=10, capacity=2)
+        self.assertEqual([0, 0], [bucket.reserve() for _ in range(2)])
+        self.assertAlmostEqual(0.1, bucket.reserve(), places=2)
+        self.assertAlmostEqual(0.2, bucket.reserve(), places=2)
+
+    def test_pause(self):
+        bucket = delivery.TokenBucket(rate=10, capacity=2)
+        bucket.pause(1)
+        self.assertAlmostEqual(1.1, bucket.reserve(), places=2)
+        self.assertFalse(bucket.idle())
+
+
+class DeliveryTest(TestCase):
+    def setUp(self):
+        self.delivery = delivery.Delivery(workers=2, global_rate=1000,
+                                          chat_rate=1000, max_retries=2)
+        self.bot = MagicMock()
+        self.messages = [{'key': (1, ), 'chat_id': 1, 'text': 'Reminder'}]
+
+    def _send(self, *errors):
+        self.bot.send_message.side_effect = list(errors) + [MagicMock()]
+        return self.delivery.send_batch(self.bot, self.messages)
+
+    def test_sent(self):
+        delivered, stats = self._send()
+        self.assertEqual([(1, )], list(delivered))
+        self.assertEqual(1, stats['sent'])
+
+    def test_rejected_not_retried(self):
+        delivered, stats = self._send(BadRequest('Chat not found'))
+        self.assertEqual({(1, ): None}, delivered)
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(1, self.bot.send_message.call_count)
+
+    def test_timed_out_not_retried(self):
+        delivered, stats = self._send(TimedOut())
+        self.assertEqual([(1, )], list(delivered))
+        self.assertEqual(1, stats['timed_out'])
+        self.assertEqual(1, self.bot.send_message.call_count)
+
+    def test_retry_after_pauses_all(self):
+        started = time.monotonic()
+        delivered, stats = self._send(RetryAfter(0.2))
+        self.assertEqual([(1, )], list(delivered))
+        self.assertEqual(1, stats['throttled'])
+        self.assertGreaterEqual(self.delivery._global.reserve(), 0)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_busy_chat_does_not_hold_workers(self):
+        self.delivery = delivery.Delivery(workers=1, global_rate=1000,
+                                          chat_rate=2)
+        self.messages = [{'key': (ind, ), 'chat_id': 1, 'text': 'Reminder'}
+                         for ind in range(3)]
+        self.messages.append({'key': (3, ), 'chat_id': 2, 'text': 'Other'})
+        self.bot.send_message.side_effect = None
+        self.delivery.send_batch(self.bot, self.messages)
+        chats = [call[1]['chat_id']
+                 for call in self.bot.send_message.call_args_list]
+        self.assertEqual([1, 2, 1, 1], chats)
+
+
+class ReminderCoalesceTest(TestCase):
+    def _rem(self, rem_id, user_id):
+        return {'id': rem_id, 'user_id': user_id, 'task_id': rem_id,
+                'datetime': datetime.now(timezone.utc),
+                'task_text': f'Test task {rem_id}', 'deadline': None}
+
+    def test_grouped_by_user(self):
+        rems = [self._rem(1, 1), self._rem(2, 2), self._rem(3, 1)]
+        messages = reminders._coalesce(rems)
+        self.assertEqual({(1, 3), (2, )},
+                         {msg['key'] for msg in messages})
+        combined = next(msg for msg in messages if msg['chat_id'] == 1)
+        buttons = [btn.callback_data for row in
+                   combined['markup'].inline_keyboard for btn in row]
+        self.assertEqual(['pr:1', 'cr:1', 'pr:3', 'cr:3',
+                          reminders.CLOSE_MSG], buttons)
+
+    def test_message_size_limited(self):
+        rems = [self._rem(rem_id, 1) for rem_id in range(25)]
+        messages = reminders._coalesce(rems)
+        self.assertEqual([10, 10, 5], [len(msg['key']) for msg in messages])
+
+    @patch.object(reminders, 'REMINDERS_PER_MESSAGE', 4)
+    def test_message_size_configured(self):
+        rems = [self._rem(rem_id, 1) for rem_id in range(10)]
+        messages = reminders._coalesce(rems)
+        self.assertEqual([4, 4, 2], [len(msg['key']) for msg in messages])
+
+
+class ListMessageTest(TestCase):
+    def setUp(self):
+        self.bot = MagicMock()
+        self.bot.send_message.return_value.message_id = 1
+        self.update = MagicMock()
+        self.update.message.bot = self.bot
+        self.update.message.chat.id = 1
+        self.context = MagicMock(chat_data={})
+        self.markup = response._nav_markup({'cursors': [None],
+                                            'page ind': 0})
+
+    def test_unchanged_not_edited(self):
+        response._show_list(self.update, self.context, 'Page', self.markup)
+        response._show_list(self.update, self.context, 'Page', self.markup)
+        self.assertEqual(1, self.bot.send_message.call_count)
+        self.bot.edit_message_text.assert_not_called()
+
+    def test_changed_edited(self):
+        response._show_list(self.update, self.context, 'Page', self.markup)
+        response._show_list(self.update, self.context, 'New', self.markup)
+        self.assertEqual(1, self.bot.send_message.call_count)
+        self.bot.edit_message_text.assert_called_once()
+
+    def test_not_editable_replaced(self):
+        response._show_list(self.update, self.context, 'Page', self.markup)
+        self.bot.edit_message_text.side_effect = BadRequest(
+            "Message can't be edited")
+        response._show_list(self.update, self.context, 'New', self.markup)
+        self.assertEqual(2, self.bot.send_message.call_count)
+        self.bot.delete_message.assert_called_once_with(1, 1)
+
+    def test_not_modified_kept(self):
+        response._show_list(self.update, self.context, 'Page', self.markup)
+        self.bot.edit_message_text.side_effect = BadRequest(
+            'Message is not modified')
+        response._show_list(self.update, self.context, 'New', self.markup)
+        self.assertEqual(1, self.bot.send_message.call_count)
+        self.bot.delete_message.assert_not_called()
+
+    def test_moved_list_cleaned(self):
+        response._show_list(self.update, self.context, 'Page', self.markup)
+        older = MagicMock(message_id=2)
+        response._show_list(self.update, self.context, 'New', self.markup,
+                            message=older)
+        self.assertEqual(2, self.context.chat_data['list msg']['id'])
+        self.assertEqual({1}, self.context.chat_data['rem lst'])
+
+
+class ReminderButtonsTest(TestCase):
+    def setUp(self):
+        self.bot = MagicMock()
+        self.message = Message.de_json(
+            {'message_id': 5, 'date': int(time.time()),
+             'chat': {'id': 1, 'type': 'private'}, 'text': 'Напоминания'},
+            self.bot)
+        self.chat_data = {}
+        reminders.ShownReminders.put(self.chat_data, 5, (10, 11))
+
+    def _buttons(self):
+        markup = self.bot.edit_message_reply_markup.call_args[1][
+            'reply_markup']
+        return [btn.callback_data for row in markup.inline_keyboard
+                for btn in row]
+
+    def test_buttons_removed(self):
+        reminders._remove_buttons(self.message, self.chat_data, 10)
+        self.assertEqual(['pr:11', 'cr:11', reminders.CLOSE_MSG],
+                         self._buttons())
+        self.bot.delete_message.assert_not_called()
+
+    def test_last_reminder_deletes_message(self):
+        reminders._remove_buttons(self.message, self.chat_data, 10)
+        reminders._remove_buttons(self.message, self.chat_data, 11)
+        self.bot.delete_message.assert_called_once_with(1, 5)
+        self.assertEqual({}, self.chat_data[reminders.ShownReminders.key])
+
+    def test_unknown_message_deleted(self):
+        self.chat_data.clear()
+        reminders._remove_buttons(self.message, self.chat_data, 10)
+        self.bot.delete_message.assert_called_once_with(1, 5)
+
+    def test_delivered_recorded(self):
+        shown = reminders.ShownReminders()
+        chat_data = {}
+        shown.bind({1: chat_data})
+        shown.record(1, 5, (10, 11))
+        self.assertEqual({5: [10, 11]},
+                         chat_data[reminders.ShownReminders.key])
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.registry = instrumentation.Registry(window=100)
+
+    def test_percentiles(self):
+        for ms in range(1, 101):
+            self.registry.observe('op', ms / 1000)
+        ops, _ = self.registry.snapshot()
+        self.assertEqual(100, ops['op']['count'])
+        self.assertEqual(0.051, ops['op']['p50'])
+        self.assertEqual(0.1, ops['op']['p99'])
+
+    def test_errors_counted(self):
+        @instrumentation.timed(name='fail', registry=self.registry)
+        def fail():
+            raise ValueError
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                fail()
+        ops, _ = self.registry.snapshot()
+        self.assertEqual(2, ops['fail']['errors'])
+
+    def test_generator_timed_over_iteration(self):
+        @instrumentation.timed(name='gen', registry=self.registry)
+        def gen():
+            time.sleep(0.01)
+            yield 1
+            time.sleep(0.01)
+            yield 2
+
+        items = gen()
+        self.assertEqual(0, self.registry.snapshot()[0].get(
+            'gen', {'count': 0})['count'])
+        self.assertEqual([1, 2], list(items))
+        ops, _ = self.registry.snapshot()
+        self.assertEqual(1, ops['gen']['count'])
+        self.assertEqual(0, ops['gen']['errors'])
+        self.assertGreaterEqual(ops['gen']['p50'], 0.02)
+
+    def test_generator_closed_early(self):
+        @instrumentation.timed(name='gen', registry=self.registry)
+        def gen():
+            yield from range(10)
+
+        for _ in gen():
+            break
+        ops, _ = self.registry.snapshot()
+        self.assertEqual(1, ops['gen']['count'])
+        self.assertEqual(0, ops['gen']['errors'])
+
+    def test_prometheus_format(self):
+        self.registry.observe('db.get_tasks', 0.5)
+        self.registry.add_source('pool', lambda: {'size': 2, 'wait': None})
+        text = instrumentation.render_prometheus(self.registry)
+        self.assertIn('taskbot_latency_seconds{op="db.get_tasks",'
+                      'quantile="0.5"} 0.5', text)
+        self.assertIn('taskbot_pool_size 2', text)
+        self.assertNotIn('taskbot_pool_wait', text)
+
+    def test_process_labels(self):
+        self.registry.set_labels(shard=1)
+        self.registry.observe('db.get_tasks', 0.5)
+        self.registry.add_source('pool', lambda: {'size': 2})
+        text = instrumentation.render_prometheus(self.registry)
+        self.assertIn('taskbot_latency_seconds_count{op="db.get_tasks",'
+                      'shard="1"} 1', text)
+        self.assertIn('taskbot_errors_total{op="db.get_tasks",'
+                      'shard="1"} 0', text)
+        self.assertIn('taskbot_pool_size{shard="1"} 2', text)
+        report = instrumentation.render_text(self.registry)
+        self.assertTrue(report.startswith('process: shard=1 '))
+
+
 if __name__ == '__main__':
     main()